@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar store for dataset annotation json file. Annotation fields are kept
+as numpy arrays (plus an interned image path table) instead of a list of
+dicts, and cached on disk as .npz next to the json file, so a large dataset
+(like MSCOCO) could be loaded quickly with small memory footprint.
+
+Records are still accessible as read-only dict like objects with same
+values as json loaded ones, so code for annotation dicts could keep working.
+"""
+import os, json
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+# annotation fields stored as numeric column
+ANNOTATION_COLUMNS = ['joint_self', 'objpos', 'scale_provided', 'headboxes', 'isValidation']
+# bump it when cache file format changes
+CACHE_VERSION = 1
+
+
+class AnnotationStore(object):
+    def __init__(self, columns, paths, path_index, dataset_name=None):
+        """
+        # Arguments
+            columns: dict of field name to numpy array, first dim is record number
+            paths: array of unique image paths
+            path_index: index of record image path in paths, shape=(num_records,)
+            dataset_name: dataset name of the annotation records
+        """
+        self.columns = columns
+        self.paths = paths
+        self.path_index = path_index
+        self.dataset_name = dataset_name
+
+    @classmethod
+    def from_records(cls, records):
+        # only keep fields existing in every record
+        column_names = [name for name in ANNOTATION_COLUMNS if all(name in record for record in records)]
+        columns = {name: np.array([record[name] for record in records], dtype=np.float64) for name in column_names}
+
+        # intern image paths, since person records
+        # on same image share one path
+        paths, path_index = np.unique(np.array([record['img_paths'] for record in records], dtype=np.str_), return_inverse=True)
+
+        dataset_name = records[0]['dataset'] if len(records) > 0 else None
+        return cls(columns, paths, path_index.astype(np.int32), dataset_name)
+
+    @classmethod
+    def load(cls, json_file, use_cache=True):
+        """
+        load annotation json file, with .npz cache file next to it. cache
+        is rebuilt when json file is changed (by size & modify time), and
+        skipped if the dataset path is not writable
+        """
+        cache_file = os.path.splitext(json_file)[0] + '.npz'
+        file_stat = os.stat(json_file)
+        signature = np.array([CACHE_VERSION, file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)
+
+        if use_cache and os.path.isfile(cache_file):
+            with np.load(cache_file, allow_pickle=False) as cache:
+                if np.array_equal(cache['signature'], signature):
+                    columns = {name: cache['column_'+name] for name in ANNOTATION_COLUMNS if 'column_'+name in cache}
+                    dataset_name = str(cache['dataset_name']) if cache['dataset_name'].size else None
+                    return cls(columns, cache['paths'], cache['path_index'], dataset_name)
+
+        with open(json_file) as anno_file:
+            store = cls.from_records(json.load(anno_file))
+
+        if use_cache:
+            try:
+                store.save(cache_file, signature)
+            except OSError:
+                pass
+        return store
+
+    def save(self, cache_file, signature):
+        dataset_name = np.array(self.dataset_name if self.dataset_name is not None else [], dtype=np.str_)
+        columns = {'column_'+name: column for name, column in self.columns.items()}
+        # write to temp file first, in case of concurrent loading
+        temp_file = cache_file + '.tmp.{}.npz'.format(os.getpid())
+        np.savez(temp_file, signature=signature, paths=self.paths, path_index=self.path_index, dataset_name=dataset_name, **columns)
+        os.replace(temp_file, cache_file)
+
+    def __len__(self):
+        return len(self.path_index)
+
+    def keys(self):
+        return ['dataset', 'img_paths'] + list(self.columns.keys())
+
+    def get_value(self, index, key):
+        if key == 'img_paths':
+            return str(self.paths[self.path_index[index]])
+        if key == 'dataset':
+            return self.dataset_name
+        # convert to python float/list, same as json loaded value
+        return self.columns[key][index].tolist()
+
+
+class AnnotationRecord(Mapping):
+    """
+    read-only dict like view of one annotation record in store
+    """
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key):
+        if key not in self.store.keys():
+            raise KeyError(key)
+        return self.store.get_value(self.index, key)
+
+    def __iter__(self):
+        return iter(self.store.keys())
+
+    def __len__(self):
+        return len(self.store.keys())
+
+    def __reduce__(self):
+        # pickle as plain dict, to avoid sending whole store
+        # to data loader worker with each record
+        return (dict, (dict(self),))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class AnnotationList(Sequence):
+    """
+    list like view of annotation records in store, with own record order.
+    item assignment is supported (within same store) so that it could be
+    shuffled in place with random.shuffle(). Slice returns list of records
+    """
+    def __init__(self, store, indexes):
+        self.store = store
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [AnnotationRecord(self.store, index) for index in self.indexes[i]]
+        return AnnotationRecord(self.store, self.indexes[i])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            self.indexes[i] = [record.index for record in value]
+        else:
+            self.indexes[i] = value.index
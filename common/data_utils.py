@@ -43,6 +43,33 @@ def random_horizontal_flip(image, keypoints, center, matchpoints=None, prob=.5):
     if not flip:
         return image, keypoints, center
 
+    org_height, org_width, channels = image.shape
+
+    # horizontal flip image: flipCode=1
+    flip_image = cv2.flip(image, flipCode=1)
+
+    keypoints, flip_center = horizontal_flip_keypoints(keypoints, center, org_width, matchpoints)
+
+    return flip_image, keypoints, flip_center
+
+
+def horizontal_flip_keypoints(keypoints, center, image_width, matchpoints=None):
+    """
+    Horizontal flip keypoints and center on image with provided width,
+    without touching image data
+
+    # Arguments
+        keypoints: keypoints numpy array, shape=(num_keypoints, 3)
+            each keypoints with format (x, y, visibility)
+        center: center points array with format (x, y)
+        image_width: width of origin image
+        matchpoints: list of tuple for keypoint pair index,
+            which need to swap in horizontal flip
+
+    # Returns
+        keypoints: fliped keypoints numpy array
+        flip_center: fliped center points numpy array
+    """
     keypoints = np.copy(keypoints)
 
     # some keypoint pairs also need to be fliped
@@ -56,13 +83,8 @@ def random_horizontal_flip(image, keypoints, center, matchpoints=None, prob=.5):
         #[12, 13]  # shoulder
     #)
 
-    org_height, org_width, channels = image.shape
-
-    # horizontal flip image: flipCode=1
-    flip_image = cv2.flip(image, flipCode=1)
-
     # horizontal flip each keypoints
-    keypoints[:, 0] = org_width - keypoints[:, 0]
+    keypoints[:, 0] = image_width - keypoints[:, 0]
 
     # horizontal swap matched keypoints
     if matchpoints and len(matchpoints) != 0:
@@ -73,9 +95,9 @@ def random_horizontal_flip(image, keypoints, center, matchpoints=None, prob=.5):
 
     # horizontal flip center
     flip_center = center
-    flip_center[0] = org_width - center[0]
+    flip_center[0] = image_width - center[0]
 
-    return flip_image, keypoints, flip_center
+    return keypoints, flip_center
 
 
 def random_vertical_flip(image, keypoints, center, matchpoints=None, prob=.5):
@@ -102,18 +124,40 @@ def random_vertical_flip(image, keypoints, center, matchpoints=None, prob=.5):
     if not flip:
         return image, keypoints, center
 
-    keypoints = np.copy(keypoints)
-
-    # some keypoint pairs also need to be fliped
-    # on new image
-
     org_height, org_width, channels = image.shape
 
     # vertical flip image: flipCode=0
     flip_image = cv2.flip(image, flipCode=0)
 
+    keypoints, flip_center = vertical_flip_keypoints(keypoints, center, org_height, matchpoints)
+
+    return flip_image, keypoints, flip_center
+
+
+def vertical_flip_keypoints(keypoints, center, image_height, matchpoints=None):
+    """
+    Vertical flip keypoints and center on image with provided height,
+    without touching image data
+
+    # Arguments
+        keypoints: keypoints numpy array, shape=(num_keypoints, 3)
+            each keypoints with format (x, y, visibility)
+        center: center points array with format (x, y)
+        image_height: height of origin image
+        matchpoints: list of tuple for keypoint pair index,
+            which need to swap in vertical flip
+
+    # Returns
+        keypoints: fliped keypoints numpy array
+        flip_center: fliped center points numpy array
+    """
+    keypoints = np.copy(keypoints)
+
+    # some keypoint pairs also need to be fliped
+    # on new image
+
     # vertical flip each keypoints
-    keypoints[:, 1] = org_height - keypoints[:, 1]
+    keypoints[:, 1] = image_height - keypoints[:, 1]
 
     # vertical flip matched keypoints
     if matchpoints and len(matchpoints) != 0:
@@ -124,9 +168,9 @@ def random_vertical_flip(image, keypoints, center, matchpoints=None, prob=.5):
 
     # vertical flip center
     flip_center = center
-    flip_center[1] = org_height - center[1]
+    flip_center[1] = image_height - center[1]
 
-    return flip_image, keypoints, flip_center
+    return keypoints, flip_center
 
 
 def random_brightness(image, jitter=.5):
@@ -287,6 +331,137 @@ def random_grayscale(image, prob=.1):
     return image
 
 
+def get_photometric_params(jitter=.5, grayscale_prob=.1, blur_prob=.2, histeq_prob=.2):
+    """
+    Sample random photometric augment parameters up front, with the same
+    range and random draw order as the legacy chain of random_brightness(),
+    random_chroma(), random_contrast(), random_sharpness(), random_grayscale(),
+    random_blur() and random_histeq()
+
+    # Arguments
+        jitter: jitter range for random brightness/chroma/contrast/sharpness
+        grayscale_prob: probability for grayscale convert
+        blur_prob: probability for gaussian blur
+        histeq_prob: probability for histogram equalization
+
+    # Returns
+        params: dict of photometric augment parameters
+    """
+    params = {}
+    params['brightness'] = rand(jitter, 1/jitter)
+    params['chroma'] = rand(jitter, 1/jitter)
+    params['contrast'] = rand(jitter, 1/jitter)
+    params['sharpness'] = rand(jitter, 1/jitter)
+    params['grayscale'] = rand() < grayscale_prob
+    params['blur'] = rand() < blur_prob
+    params['histeq'] = rand() < histeq_prob
+
+    return params
+
+
+# PIL "L" mode weights, used by ImageEnhance.Color/Contrast
+PIL_GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114])
+# PIL ImageFilter.SMOOTH kernel, used by ImageEnhance.Sharpness
+PIL_SMOOTH_KERNEL = np.array([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]]) / 13.
+
+
+def apply_photometric(image, params, blur_size=5, histeq_size=8):
+    """
+    Apply photometric augment on uint8 RGB image with pre-sampled params.
+    Brightness is applied as a lookup table. Chroma and contrast are both
+    affine on pixel value, so they are merged into one 3x4 color matrix
+    and applied with a single cv2.transform(). Sharpness (and gaussian
+    blur) are merged into one filter kernel. So there are 3 passes (plus
+    grayscale & CLAHE when picked) and no PIL round trip, with output
+    matching the legacy chain except for intermediate uint8 rounding &
+    saturation
+
+    # Arguments
+        image: origin image, uint8 RGB numpy array
+        params: photometric augment parameters from get_photometric_params()
+        blur_size: kernel size for gaussian blur
+        histeq_size: grid size for CLAHE
+
+    # Returns
+        image: adjusted numpy array image.
+    """
+    # brightness: blend with black image. it saturates a lot
+    # on high brightness, so apply as a clipped lookup table.
+    # PIL blend truncate the result, so we follow it here and
+    # in the following steps to keep same output distribution
+    brightness_lut = np.clip(np.arange(256) * params['brightness'], 0, 255).astype(np.uint8)
+    image = cv2.LUT(image, brightness_lut)
+
+    # chroma: blend with grayscale image, which keep gray level
+    color_matrix = params['chroma'] * np.eye(3) + (1 - params['chroma']) * np.tile(PIL_GRAY_WEIGHTS, (3, 1))
+
+    # contrast: blend with mean gray level of chroma adjusted
+    # image, which is just mean gray level of current image
+    channel_mean = np.array(cv2.mean(image)[0:3])
+    gray_mean = int(np.dot(PIL_GRAY_WEIGHTS, channel_mean) + 0.5)
+
+    contrast = params['contrast']
+    color_matrix = contrast * color_matrix
+    # cv2.transform() round the result, so shift by truncate error
+    # of chroma & contrast blend
+    color_offset = np.full(3, (1 - contrast) * gray_mean - 0.5 * (contrast + 1))
+
+    transform_matrix = np.concatenate([color_matrix, color_offset[:, np.newaxis]], axis=1)
+    image = cv2.transform(image, transform_matrix)
+
+    if params['grayscale']:
+        # same as random_grayscale(): cv2 BGR2GRAY & GRAY2BGR. it's
+        # applied on the clipped image like the legacy chain, since
+        # chroma & contrast saturate channels differently
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+    # sharpness: blend with smoothed image, as a filter kernel
+    sharpness = params['sharpness']
+    kernel = (1 - sharpness) * PIL_SMOOTH_KERNEL
+    kernel[1, 1] += sharpness
+
+    if params['blur']:
+        # merge gaussian blur into the kernel by kernel convolution
+        gaussian_1d = cv2.getGaussianKernel(blur_size, 0)
+        gaussian_kernel = np.dot(gaussian_1d, gaussian_1d.T)
+        merged_kernel = np.zeros((blur_size + 2, blur_size + 2))
+        for i in range(3):
+            for j in range(3):
+                merged_kernel[i:i+blur_size, j:j+blur_size] += kernel[i, j] * gaussian_kernel
+        kernel = merged_kernel
+
+    # shift by truncate error of sharpness blend
+    image = cv2.filter2D(image, -1, kernel, delta=-0.5)
+
+    if params['histeq']:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(histeq_size, histeq_size))
+        img_yuv = cv2.cvtColor(image, cv2.COLOR_BGR2YUV)
+        img_yuv[:,:,0] = clahe.apply(img_yuv[:,:,0])
+        image = cv2.cvtColor(img_yuv, cv2.COLOR_YUV2BGR) # to BGR
+
+    return image
+
+
+def random_photometric(image, jitter=.5, grayscale_prob=.1, blur_prob=.2, histeq_prob=.2):
+    """
+    Random photometric augment for image, fused version of the
+    random_brightness/chroma/contrast/sharpness/grayscale/blur/histeq chain
+
+    # Arguments
+        image: origin image, uint8 RGB numpy array
+        jitter: jitter range for random brightness/chroma/contrast/sharpness
+        grayscale_prob: probability for grayscale convert
+        blur_prob: probability for gaussian blur
+        histeq_prob: probability for histogram equalization
+
+    # Returns
+        image: adjusted numpy array image.
+    """
+    params = get_photometric_params(jitter, grayscale_prob, blur_prob, histeq_prob)
+    return apply_photometric(image, params)
+
+
 def random_rotate_angle(rotate_range, prob=0.5):
     """
     Random rotate angle for image and keypoints transform
@@ -411,28 +586,220 @@ def crop_image(img, center, scale, shape, rotate_angle=0):
     return new_img
 
 
-def transform_keypoints(keypoints, center, scale, shape, rotate_angle):
+def get_crop_matrix(center, scale, shape, rotate_angle=0, image_shape=None, h_flip=False, v_flip=False):
     """
-    Transform keypoints to single object image reference
+    Get 2x3 affine matrix which map origin image pixel to the cropped,
+    rotated & resized single object image, with the same crop box and
+    rotation as crop_image(). Horizontal/vertical flip of origin image
+    could also be merged into the matrix, in which case center should be
+    the fliped one (as random_horizontal_flip()/random_vertical_flip() do)
+
+    # Arguments
+        center: object center point array with format (x, y)
+        scale: object scale factor
+        shape: target image shape as (height, width)
+        rotate_angle: rotate angle in degree
+        image_shape: origin image shape
+        h_flip: whether to horizontal flip origin image first
+        v_flip: whether to vertical flip origin image first
+
+    # Returns
+        matrix: 2x3 affine matrix for cv2.warpAffine()
+    """
+    height, width = image_shape[0:2]
+
+    # matrix is formed on continuous coordinate (pixel i cover [i, i+1)),
+    # and convert to pixel index coordinate at last
+    t = np.eye(3)
+
+    # flip origin image, same as cv2.flip()
+    if h_flip:
+        t = np.dot(np.array([[-1., 0., width], [0., 1., 0.], [0., 0., 1.]]), t)
+    if v_flip:
+        t = np.dot(np.array([[1., 0., 0.], [0., -1., height], [0., 0., 1.]]), t)
+
+    # crop_image() downsize image first for large object
+    scale_factor = scale * MPII_SCALE_REFERENCE / shape[0]
+    if scale_factor >= 2:
+        new_height = int(np.math.floor(height / scale_factor))
+        new_width = int(np.math.floor(width / scale_factor))
+        t = np.dot(np.diag([new_width / float(width), new_height / float(height), 1.]), t)
+        center = np.asarray(center) * 1.0 / scale_factor
+        scale = scale / scale_factor
+
+    # crop box on origin image, same as crop_image()
+    upper_left = np.array(transform([0, 0], center, scale, shape, invert=1))
+    bottom_right = np.array(transform([shape[1], shape[0]], center, scale, shape, invert=1))
+    box_size = (bottom_right - upper_left).astype(np.float64)
+    t = np.dot(np.array([[1., 0., -upper_left[0]], [0., 1., -upper_left[1]], [0., 0., 1.]]), t)
+
+    # rotate around crop box center, counterclockwise as PIL Image.rotate()
+    if not rotate_angle == 0:
+        rot_rad = rotate_angle * np.pi / 180
+        sn, cs = np.sin(rot_rad), np.cos(rot_rad)
+        box_center = box_size / 2
+        t_mat = np.array([[1., 0., -box_center[0]], [0., 1., -box_center[1]], [0., 0., 1.]])
+        rot_mat = np.array([[cs, sn, 0.], [-sn, cs, 0.], [0., 0., 1.]])
+        t_inv = np.array([[1., 0., box_center[0]], [0., 1., box_center[1]], [0., 0., 1.]])
+        t = np.dot(t_inv, np.dot(rot_mat, np.dot(t_mat, t)))
+
+    # resize crop box to target shape
+    t = np.dot(np.diag([shape[1] / box_size[0], shape[0] / box_size[1], 1.]), t)
+
+    # convert to pixel index coordinate
+    index_to_cont = np.array([[1., 0., 0.5], [0., 1., 0.5], [0., 0., 1.]])
+    cont_to_index = np.array([[1., 0., -0.5], [0., 1., -0.5], [0., 0., 1.]])
+    t = np.dot(cont_to_index, np.dot(t, index_to_cont))
+
+    return t[0:2, :]
+
+
+def crop_image_affine(img, center, scale, shape, rotate_angle=0, h_flip=False, v_flip=False, interpolation=cv2.INTER_CUBIC, origin_shape=None):
+    """
+    Fused version of crop_image(): flip, crop, rotate and resize origin image
+    to model input size with a single cv2.warpAffine(), instead of several
+    full size copies. Keypoints should still be transformed with
+    transform_keypoints() using the same (fliped) center/scale/angle.
+
+    For large downscale (>= 2x, where crop_image() resize whole image first)
+    only the source region of the crop is area-resized ahead of the warp
+    to avoid aliasing.
+
+    img could also be a reduced resolution decode of the origin image (like
+    JPEG draft mode decode). Then origin_shape should be provided, and
+    center/scale are still on origin image reference.
+
+    # Arguments
+        img: origin image numpy array (not fliped)
+        center: object center point array with format (x, y), fliped
+            if h_flip/v_flip is used
+        scale: object scale factor
+        shape: target image shape as (height, width)
+        rotate_angle: rotate angle in degree
+        h_flip: whether to horizontal flip origin image
+        v_flip: whether to vertical flip origin image
+        interpolation: interpolation flag for cv2.warpAffine()
+        origin_shape: origin image shape if img is in reduced resolution
+
+    # Returns
+        new_img: cropped image numpy array with target shape
+    """
+    height, width = img.shape[0:2]
+    scale_factor = scale * MPII_SCALE_REFERENCE / shape[0]
+
+    if origin_shape is None:
+        matrix = get_crop_matrix(center, scale, shape, rotate_angle, img.shape, h_flip, v_flip)
+    else:
+        matrix = get_crop_matrix(center, scale, shape, rotate_angle, origin_shape, h_flip, v_flip)
+
+        # map reduced image pixel back to origin image pixel
+        ratio_x = origin_shape[1] / float(width)
+        ratio_y = origin_shape[0] / float(height)
+        reduce_matrix = np.array([[ratio_x, 0., 0.5 * ratio_x - 0.5],
+                                  [0., ratio_y, 0.5 * ratio_y - 0.5],
+                                  [0., 0., 1.]])
+        matrix = np.dot(matrix, reduce_matrix)
+        scale_factor = scale_factor / ratio_y
+    if scale_factor >= 2:
+        # source region of the output image, with some
+        # margin for interpolation kernel
+        inv_matrix = cv2.invertAffineTransform(matrix)
+        corners = np.array([[0, 0, 1], [shape[1], 0, 1], [0, shape[0], 1], [shape[1], shape[0], 1]], dtype=np.float64)
+        src_corners = np.dot(corners, inv_matrix.T)
+        margin = int(np.ceil(scale_factor)) * 2
+        xmin = int(max(0, np.floor(src_corners[:, 0].min()) - margin))
+        ymin = int(max(0, np.floor(src_corners[:, 1].min()) - margin))
+        xmax = int(min(width, np.ceil(src_corners[:, 0].max()) + margin))
+        ymax = int(min(height, np.ceil(src_corners[:, 1].max()) + margin))
+
+        if xmax > xmin and ymax > ymin:
+            roi = img[ymin:ymax, xmin:xmax]
+            roi_width = max(1, int(round((xmax - xmin) / scale_factor)))
+            roi_height = max(1, int(round((ymax - ymin) / scale_factor)))
+            img = cv2.resize(roi, (roi_width, roi_height), interpolation=cv2.INTER_AREA)
+
+            # map downsized roi pixel back to origin image pixel
+            ratio_x = (xmax - xmin) / float(roi_width)
+            ratio_y = (ymax - ymin) / float(roi_height)
+            roi_matrix = np.array([[ratio_x, 0., xmin + 0.5 * ratio_x - 0.5],
+                                   [0., ratio_y, ymin + 0.5 * ratio_y - 0.5],
+                                   [0., 0., 1.]])
+            matrix = np.dot(matrix, roi_matrix)
+
+    new_img = cv2.warpAffine(img, matrix, (shape[1], shape[0]), flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return new_img
+
+
+def apply_keypoints_transform(keypoints, t):
+    """
+    Apply 3x3 transform matrix on valid keypoints, with same pixel
+    convention & rounding as transform(). Support both single sample
+    keypoints (num_keypoints, 3) with matrix (3, 3), and batch keypoints
+    (batch_size, num_keypoints, 3) with matrix (batch_size, 3, 3)
     """
     new_keypoints = np.copy(keypoints)
-    for i in range(keypoints.shape[0]):
-        if keypoints[i, 0] > 0 and keypoints[i, 1] > 0:
-            _x = transform(new_keypoints[i, 0:2] + 1, center=center, scale=scale, shape=shape, invert=0, rot=rotate_angle)
-            new_keypoints[i, 0:2] = _x
+    # only pick valid keypoint
+    valid = (keypoints[..., 0] > 0) & (keypoints[..., 1] > 0)
+
+    # keep the "+1" in caller and "-1" in transform()
+    x = (keypoints[..., 0] + 1) - 1
+    y = (keypoints[..., 1] + 1) - 1
+    if t.ndim == 3:
+        # expand matrix elements to (batch_size, 1) for broadcast
+        t = t[:, np.newaxis, :, :]
+    new_x = t[..., 0, 0] * x + t[..., 0, 1] * y + t[..., 0, 2]
+    new_y = t[..., 1, 0] * x + t[..., 1, 1] * y + t[..., 1, 2]
+
+    new_keypoints[..., 0] = np.where(valid, new_x.astype(int) + 1, keypoints[..., 0])
+    new_keypoints[..., 1] = np.where(valid, new_y.astype(int) + 1, keypoints[..., 1])
     return new_keypoints
 
 
+def get_batch_transform(centers, scales, shape, rotate_angles=0, invert=False):
+    """
+    Stack transform matrix of a batch of samples, with shape (batch_size, 3, 3)
+    """
+    batch_size = len(scales)
+    rotate_angles = np.broadcast_to(rotate_angles, (batch_size,))
+
+    t = np.stack([get_transform(centers[i], scales[i], shape, rot=rotate_angles[i]) for i in range(batch_size)])
+    if invert:
+        t = np.linalg.inv(t)
+    return t
+
+
+def transform_keypoints(keypoints, center, scale, shape, rotate_angle):
+    """
+    Transform keypoints to single object image reference
+    """
+    t = get_transform(center, scale, shape, rot=rotate_angle)
+    return apply_keypoints_transform(keypoints, t)
+
+
 def invert_transform_keypoints(keypoints, center, scale, shape, rotate_angle):
     """
     Inverted transform keypoints back to origin image reference
     """
-    new_keypoints = np.copy(keypoints)
-    for i in range(keypoints.shape[0]):
-        if keypoints[i, 0] > 0 and keypoints[i, 1] > 0:
-            _x = transform(new_keypoints[i, 0:2] + 1, center=center, scale=scale, shape=shape, invert=1, rot=rotate_angle)
-            new_keypoints[i, 0:2] = _x
-    return new_keypoints
+    t = np.linalg.inv(get_transform(center, scale, shape, rot=rotate_angle))
+    return apply_keypoints_transform(keypoints, t)
+
+
+def batch_invert_transform_keypoints(batch_keypoints, centers, scales, shape, rotate_angles=0):
+    """
+    Inverted transform a batch of keypoints back to origin image reference
+
+    # Arguments
+        batch_keypoints: keypoints array, shape=(batch_size, num_keypoints, 3)
+        centers: object center array, shape=(batch_size, 2)
+        scales: object scale array, shape=(batch_size,)
+        shape: transformed shape as (height, width)
+        rotate_angles: rotate angle scalar or array with shape (batch_size,)
+
+    # Returns
+        new_keypoints: reverted keypoints array, shape=(batch_size, num_keypoints, 3)
+    """
+    t = get_batch_transform(centers, scales, shape, rotate_angles, invert=True)
+    return apply_keypoints_transform(np.asarray(batch_keypoints), t)
 
 # End of Option 1
 ###############################
@@ -447,40 +814,89 @@ def revert_keypoints(keypoints, center, scale, image_shape, input_shape, output_
     or rotate
     """
     height, width, channels = image_shape
+    return batch_revert_keypoints(keypoints[np.newaxis], [center], [scale], [(height, width)], input_shape, output_stride)[0]
 
-    obj_height = scale * MPII_SCALE_REFERENCE
+
+def batch_revert_keypoints(batch_keypoints, centers, scales, image_shapes, input_shape, output_stride=4):
+    """
+    Revert a batch of transform/predict keypoints back to origin image reference
+
+    # Arguments
+        batch_keypoints: keypoints array, shape=(batch_size, num_keypoints, 3)
+        centers: object center array, shape=(batch_size, 2)
+        scales: object scale array, shape=(batch_size,)
+        image_shapes: origin image shape array, shape=(batch_size, 2+)
+            with format (height, width, ...)
+        input_shape: model input shape as (height, width)
+        output_stride: stride between model input and output heatmap
+
+    # Returns
+        new_keypoints: reverted keypoints array, shape=(batch_size, num_keypoints, 3)
+    """
+    batch_keypoints = np.asarray(batch_keypoints)
+    centers = np.asarray(centers, dtype=np.float64)
+    scales = np.asarray(scales, dtype=np.float64)
+    image_shapes = np.asarray(image_shapes)
+    height = image_shapes[:, 0:1]
+    width = image_shapes[:, 1:2]
+
+    obj_height = scales * MPII_SCALE_REFERENCE
     # get object width same aspect ratio as target shape
     obj_width = obj_height * (float(input_shape[1]) / float(input_shape[0]))
 
-    # obj bbox
-    obj_xmin = int(max(0, center[0] - (obj_width // 2)))
-    obj_xmax = int(min(width, center[0] + (obj_width // 2)))
-    obj_ymin = int(max(0, center[1] - (obj_height // 2)))
-    obj_ymax = int(min(height, center[1] + (obj_height // 2)))
+    # obj bbox, shape=(batch_size, 1) for broadcast
+    obj_xmin = np.maximum(0, centers[:, 0] - (obj_width // 2)).astype(int)[:, np.newaxis]
+    obj_xmax = np.minimum(width[:, 0], centers[:, 0] + (obj_width // 2)).astype(int)[:, np.newaxis]
+    obj_ymin = np.maximum(0, centers[:, 1] - (obj_height // 2)).astype(int)[:, np.newaxis]
+    obj_ymax = np.minimum(height[:, 0], centers[:, 1] + (obj_height // 2)).astype(int)[:, np.newaxis]
 
     # calculate actual resize ratio on width and height
     crop_height = obj_ymax - obj_ymin
     crop_width = obj_xmax - obj_xmin
-    resize_ratio_x = input_shape[1] / float(crop_width)
-    resize_ratio_y = input_shape[0] / float(crop_height)
+    resize_ratio_x = input_shape[1] / crop_width.astype(np.float64)
+    resize_ratio_y = input_shape[0] / crop_height.astype(np.float64)
 
-    # update keypoints to single object reference
-    new_keypoints = np.zeros_like(keypoints)
+    # move and resize the keypoint
+    new_x = np.minimum(width, (batch_keypoints[..., 0] * output_stride / resize_ratio_x) + obj_xmin)
+    new_y = np.minimum(height, (batch_keypoints[..., 1] * output_stride / resize_ratio_y) + obj_ymin)
 
-    for i in range(keypoints.shape[0]):
-        # only pick valid keypoint
-        if keypoints[i, 0] > 0 and keypoints[i, 1] > 0:
-            # move and resize the keypoint
-            new_x = min(width, (keypoints[i, 0] * output_stride / resize_ratio_x) + obj_xmin)
-            new_y = min(height, (keypoints[i, 1] * output_stride / resize_ratio_y) + obj_ymin)
+    # only pick valid keypoint & valid new keypoint
+    valid = (batch_keypoints[..., 0] > 0) & (batch_keypoints[..., 1] > 0) & (new_x < width) & (new_y < height)
 
-            # only pick valid new keypoint
-            if new_x < width and new_y < height:
-                new_keypoints[i, 0:2] = np.asarray([new_x, new_y])
-                new_keypoints[i, 2] = keypoints[i, 2]
+    # update keypoints to single object reference
+    new_keypoints = np.zeros_like(batch_keypoints)
+    new_keypoints[..., 0] = np.where(valid, new_x, 0)
+    new_keypoints[..., 1] = np.where(valid, new_y, 0)
+    new_keypoints[..., 2] = np.where(valid, batch_keypoints[..., 2], 0)
     return new_keypoints
 
 
+def batch_revert_box_keypoints(batch_keypoints, boxes, input_shape, output_stride=4):
+    """
+    Revert a batch of predict keypoints of box crops (resized to model
+    input shape, like multi person detection) back to origin image reference
+
+    # Arguments
+        batch_keypoints: keypoints array, shape=(batch_size, num_keypoints, 3)
+        boxes: crop box array with format (xmin, ymin, xmax, ymax),
+            shape=(batch_size, 4)
+        input_shape: model input shape as (height, width)
+        output_stride: stride between model input and output heatmap
+
+    # Returns
+        new_keypoints: reverted keypoints array, shape=(batch_size, num_keypoints, 3)
+    """
+    batch_keypoints = np.array(batch_keypoints, dtype=np.float64)
+    boxes = np.asarray(boxes, dtype=np.float64)
+
+    # resize ratio from model input to box on x & y, shape=(batch_size, 1) for broadcast
+    scale_x = (boxes[:, 2:3] - boxes[:, 0:1]) / input_shape[1]
+    scale_y = (boxes[:, 3:4] - boxes[:, 1:2]) / input_shape[0]
+
+    batch_keypoints[..., 0] = batch_keypoints[..., 0] * scale_x * output_stride + boxes[:, 0:1]
+    batch_keypoints[..., 1] = batch_keypoints[..., 1] * scale_y * output_stride + boxes[:, 1:2]
+    return batch_keypoints
+
 
 def crop_single_object(image, keypoints, center, scale, input_shape):
     """
@@ -637,11 +1053,105 @@ def generate_gt_heatmap(keypoints, heatmap_shape, sigma=1):
     return gt_heatmap
 
 
-def normalize_image(imgdata, color_mean):
+# cache of label heatmap kernel, keyed by (sigma, type)
+_heatmap_kernels = {}
+
+
+def get_heatmap_kernel(sigma, type='Gaussian'):
+    """
+    Get (cached) 2D gaussian kernel as label_heatmap() generate.
+    kernel is always centered on pixel grid since label_heatmap()
+    place it by integer upper left point, so no sub-pixel version
+    is needed
+    """
+    key = (sigma, type)
+    if key not in _heatmap_kernels:
+        size = 6 * sigma + 1
+        x = np.arange(0, size, 1, float)
+        y = x[:, np.newaxis]
+        x0 = y0 = size // 2
+        # The gaussian is not normalized, we want the center value to equal 1
+        if type == 'Gaussian':
+            g = np.exp(- ((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma ** 2))
+        elif type == 'Cauchy':
+            g = sigma / (((x - x0) ** 2 + (y - y0) ** 2 + sigma ** 2) ** 1.5)
+        else:
+            raise ValueError('Unsupported heatmap type', type)
+        g.setflags(write=False)
+        _heatmap_kernels[key] = g
+    return _heatmap_kernels[key]
+
+
+def render_gt_heatmaps(batch_keypoints, batch_heatmaps, sigma=1, type='Gaussian'):
+    """
+    Render ground truth heatmaps for a batch of keypoints directly into a
+    preallocated heatmap buffer, using cached gaussian kernel. Result is
+    exactly same as generate_gt_heatmap() on each sample (keypoint whose
+    gaussian extend to image border is skipped as label_heatmap() do)
+
+    # Arguments
+        batch_keypoints: keypoints array, shape=(batch_size, num_keypoints, 3)
+            each keypoints with format (x, y, visibility)
+        batch_heatmaps: heatmap buffer to render to,
+            shape=(batch_size, heatmap_height, heatmap_width, num_keypoints)
+        sigma: variance of the 2D gaussian heatmap distribution
+        type: kernel type, 'Gaussian' or 'Cauchy'
+
+    # Returns
+        batch_heatmaps: the rendered heatmap buffer
+    """
+    batch_keypoints = np.asarray(batch_keypoints)
+    batch_heatmaps[...] = 0
+    heatmap_height, heatmap_width = batch_heatmaps.shape[1:3]
+    g = get_heatmap_kernel(sigma, type)
+
+    # gaussian range on heatmap, same rounding as label_heatmap()
+    upper_left_x = (batch_keypoints[..., 0] - 3 * sigma).astype(int)
+    upper_left_y = (batch_keypoints[..., 1] - 3 * sigma).astype(int)
+    bottom_right_x = (batch_keypoints[..., 0] + 3 * sigma + 1).astype(int)
+    bottom_right_y = (batch_keypoints[..., 1] + 3 * sigma + 1).astype(int)
+
+    # only apply heatmap when visibility > 0 and whole gaussian in heatmap
+    valid = (batch_keypoints[..., 2] > 0) & (upper_left_x >= 0) & (upper_left_y >= 0) & \
+            (bottom_right_x < heatmap_width) & (bottom_right_y < heatmap_height)
+    batch_index, keypoint_index = np.nonzero(valid)
+    if len(batch_index) == 0:
+        return batch_heatmaps
+
+    upper_left_x = upper_left_x[batch_index, keypoint_index]
+    upper_left_y = upper_left_y[batch_index, keypoint_index]
+    span_x = bottom_right_x[batch_index, keypoint_index] - upper_left_x
+    span_y = bottom_right_y[batch_index, keypoint_index] - upper_left_y
+
+    kernel_size = g.shape[0]
+    if np.all(span_x == kernel_size) and np.all(span_y == kernel_size):
+        # common case (integer 3*sigma): every gaussian is a full kernel,
+        # so scatter them all with one fancy index assignment
+        kernel_range = np.arange(kernel_size)
+        rows = upper_left_y[:, np.newaxis] + kernel_range
+        cols = upper_left_x[:, np.newaxis] + kernel_range
+        batch_heatmaps[batch_index[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :], keypoint_index[:, np.newaxis, np.newaxis]] = g
+    else:
+        for n, k, x, y, w, h in zip(batch_index, keypoint_index, upper_left_x, upper_left_y, span_x, span_y):
+            # same as the size mismatch trick in label_heatmap()
+            w_img, h_img = min(w, kernel_size), min(h, kernel_size)
+            batch_heatmaps[n, y:y+h_img, x:x+w_img, k] = g[0:h, 0:w]
+
+    return batch_heatmaps
+
+
+def normalize_image(imgdata, color_mean, out=None):
     '''
     :param imgdata: image in 0 ~ 255
+    :param out: optional float32 buffer to write result in place,
+                without float64 intermediate
     :return:  image from 0.0 to 1.0
     '''
+    if out is not None:
+        np.multiply(imgdata, np.float32(1.0 / 255.0), out=out, dtype=np.float32)
+        np.subtract(out, np.asarray(color_mean, dtype=np.float32), out=out)
+        return out
+
     imgdata = imgdata / 255.0
 
     for i in range(imgdata.shape[-1]):
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared memory cache for decoded images. It could be passed to data loader
+worker processes (fork or spawn) together with the dataset object, so that
+all workers & callbacks in one training job share the cached images. A
+photo with several annotated people is then only decoded once until it get
+evicted.
+
+Cache data area is split into fixed size pages, and each image is stored in
+a contiguous page run. Eviction is CLOCK (second chance): the clock hand
+moves along pages to find free room for new image, evicts images which are
+not referenced since last pass, and clears reference bit of the others.
+"""
+import os, tempfile, threading, hashlib
+import numpy as np
+from multiprocessing import shared_memory
+
+try:
+    import fcntl
+except ImportError:
+    # no cross process lock, cache is only thread safe
+    fcntl = None
+
+# index of the shared state counters
+STATE_HAND = 0
+STATE_HITS = 1
+STATE_MISSES = 2
+STATE_INSERTS = 3
+STATE_EVICTIONS = 4
+STATE_USED_PAGES = 5
+NUM_STATES = 8
+
+
+def get_cache_key(img_path, decode_ratio=1):
+    """
+    get int64 cache key of an image file & decode ratio. Use a stable
+    hash (not python hash()) since key need to match between processes
+    """
+    digest = hashlib.blake2b('{}@{}'.format(img_path, decode_ratio).encode('utf-8'), digest_size=8).digest()
+    key = int.from_bytes(digest, 'little', signed=True)
+    # 0 is used to mark empty entry
+    return key if key != 0 else 1
+
+
+class _CacheLock(object):
+    """
+    lock for both threads (like tf.data map) and processes (with
+    flock on a lock file). flock is bound to the open file, so each
+    process (including forked ones) need to open the file on its own
+    """
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.thread_lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is None:
+            return
+        if self.pid != os.getpid():
+            # fd inherited from parent process is not closed,
+            # since parent may still use it
+            self.fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT)
+            self.pid = os.getpid()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = None
+
+
+class SharedImageCache(object):
+    """
+    Decoded image cache in shared memory with byte budget & CLOCK eviction
+
+    # Arguments
+        budget: cache data size in bytes
+        page_size: allocation unit in bytes
+    """
+    def __init__(self, budget, page_size=64*1024):
+        self.page_size = page_size
+        self.num_pages = max(1, budget // page_size)
+
+        # every image take at least 1 page, so page number
+        # is also the max entry number
+        self.data_shm = shared_memory.SharedMemory(create=True, size=self.num_pages * page_size)
+        self.meta_shm = shared_memory.SharedMemory(create=True, size=self._get_meta_size(self.num_pages))
+        self.lock_file = os.path.join(tempfile.gettempdir(), 'hourglass_image_cache_{}.lock'.format(self.data_shm.name.lstrip('/')))
+        # pid of the creator process, which will unlink the
+        # shared memory. forked workers also get this object
+        self.owner_pid = os.getpid()
+        self._setup()
+
+        self.keys[:] = 0
+        self.page_owner[:] = -1
+        self.state[:] = 0
+
+    @staticmethod
+    def _get_meta_size(num_pages):
+        # state, keys, start page, page number, image shape (h, w, c,
+        # origin h, origin w), reference bit & page owner
+        return NUM_STATES * 8 + num_pages * (8 + 4 + 4 + 5 * 4 + 1 + 4)
+
+    def _setup(self):
+        buffer = self.meta_shm.buf
+        num_pages = self.num_pages
+        offset = 0
+
+        def view(dtype, shape):
+            nonlocal offset
+            array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            offset += array.nbytes
+            return array
+
+        self.state = view(np.int64, (NUM_STATES,))
+        self.keys = view(np.int64, (num_pages,))
+        self.start_pages = view(np.int32, (num_pages,))
+        self.entry_pages = view(np.int32, (num_pages,))
+        self.shapes = view(np.int32, (num_pages, 5))
+        self.page_owner = view(np.int32, (num_pages,))
+        self.refs = view(np.uint8, (num_pages,))
+        self.lock = _CacheLock(self.lock_file)
+
+    def __getstate__(self):
+        return {'page_size': self.page_size, 'num_pages': self.num_pages, 'lock_file': self.lock_file,
+                'data_name': self.data_shm.name, 'meta_name': self.meta_shm.name}
+
+    def __setstate__(self, state):
+        self.page_size = state['page_size']
+        self.num_pages = state['num_pages']
+        self.lock_file = state['lock_file']
+        self.data_shm = shared_memory.SharedMemory(name=state['data_name'])
+        self.meta_shm = shared_memory.SharedMemory(name=state['meta_name'])
+        # worker processes share resource tracker of the creator process,
+        # so the attach registration does not need to be undone here
+        self.owner_pid = None
+        self._setup()
+
+    def _evict(self, entry):
+        start, pages = self.start_pages[entry], self.entry_pages[entry]
+        self.page_owner[start:start+pages] = -1
+        self.keys[entry] = 0
+        self.refs[entry] = 0
+        self.state[STATE_EVICTIONS] += 1
+        self.state[STATE_USED_PAGES] -= pages
+
+    def _allocate(self, pages):
+        """
+        move clock hand to find a free page run for new image
+        """
+        run_start = self.state[STATE_HAND]
+        if run_start + pages > self.num_pages:
+            run_start = 0
+
+        page = run_start
+        while page < run_start + pages:
+            entry = self.page_owner[page]
+            if entry < 0:
+                page += 1
+            elif self.refs[entry]:
+                # recently used, give it a second chance
+                # and restart the run after it
+                self.refs[entry] = 0
+                run_start = self.start_pages[entry] + self.entry_pages[entry]
+                if run_start + pages > self.num_pages:
+                    run_start = 0
+                page = run_start
+            else:
+                self._evict(entry)
+
+        self.state[STATE_HAND] = (run_start + pages) % self.num_pages
+        return run_start
+
+    def get(self, key):
+        """
+        get a copy of cached image and its origin image shape
+        (None if not reduced), or None if not cached
+        """
+        with self.lock:
+            entries = np.flatnonzero(self.keys == key)
+            if len(entries) == 0:
+                self.state[STATE_MISSES] += 1
+                return None
+
+            entry = entries[0]
+            self.refs[entry] = 1
+            self.state[STATE_HITS] += 1
+
+            height, width, channel, origin_height, origin_width = self.shapes[entry].tolist()
+            offset = int(self.start_pages[entry]) * self.page_size
+            image = np.ndarray((height, width, channel), dtype=np.uint8, buffer=self.data_shm.buf, offset=offset).copy()
+
+        origin_shape = None if (origin_height, origin_width) == (height, width) else (origin_height, origin_width, channel)
+        return image, origin_shape
+
+    def put(self, key, image, origin_shape=None):
+        """
+        cache a decoded uint8 image, return False if it's too large for cache
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+        pages = max(1, -(-image.nbytes // self.page_size))
+        if pages > self.num_pages:
+            return False
+        if origin_shape is None:
+            origin_shape = image.shape
+
+        with self.lock:
+            # may be cached by other worker at the same time
+            if np.any(self.keys == key):
+                return True
+
+            start = self._allocate(pages)
+            entry = np.flatnonzero(self.keys == 0)[0]
+            self.keys[entry] = key
+            self.start_pages[entry] = start
+            self.entry_pages[entry] = pages
+            self.shapes[entry] = image.shape[0:3] + tuple(origin_shape[0:2])
+            self.refs[entry] = 0
+            self.page_owner[start:start+pages] = entry
+
+            data = np.ndarray((image.nbytes,), dtype=np.uint8, buffer=self.data_shm.buf, offset=int(start) * self.page_size)
+            data[:] = image.reshape(-1)
+            self.state[STATE_INSERTS] += 1
+            self.state[STATE_USED_PAGES] += pages
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': int(self.state[STATE_HITS]),
+                    'misses': int(self.state[STATE_MISSES]),
+                    'inserts': int(self.state[STATE_INSERTS]),
+                    'evictions': int(self.state[STATE_EVICTIONS]),
+                    'entries': int(np.count_nonzero(self.keys)),
+                    'used_bytes': int(self.state[STATE_USED_PAGES]) * self.page_size,
+                    'budget': self.num_pages * self.page_size}
+
+    def reset_stats(self):
+        with self.lock:
+            self.state[STATE_HITS:STATE_EVICTIONS+1] = 0
+
+    def close(self):
+        if getattr(self, 'data_shm', None) is None:
+            return
+        # release numpy views before closing shared memory
+        self.state = self.keys = self.start_pages = self.entry_pages = None
+        self.shapes = self.page_owner = self.refs = None
+        self.lock.close()
+
+        owner = self.owner_pid == os.getpid()
+        for shm in [self.data_shm, self.meta_shm]:
+            shm.close()
+            if owner:
+                shm.unlink()
+        if owner and os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
+        self.data_shm = self.meta_shm = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 # -*- coding=utf-8 -*-
 """Model utility functions."""
+import numpy as np
+import tensorflow as tf
 from tensorflow.keras.optimizers import Adam, RMSprop, SGD
 from tensorflow.keras.optimizers.schedules import ExponentialDecay, PolynomialDecay, PiecewiseConstantDecay
 from tensorflow.keras.experimental import CosineDecay
@@ -146,3 +148,73 @@ def get_normalize(input_shape):
     scale = float((input_shape[0] + input_shape[1]) / 2) / 256.0
 
     return 6.4*scale
+
+
+def is_static_shape_model(model):
+    """
+    check if all the input dims (except batch) of model are fixed, which
+    is needed for XLA compile. A dynamic input shape model would be
+    recompiled for every new input shape
+    """
+    input_shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+    return all(dim is not None for input_shape in input_shapes for dim in input_shape[1:])
+
+
+def get_xla_error_message(error):
+    """
+    pick the cause line (like unsupported op) from a XLA compile error
+    """
+    lines = [line.strip() for line in str(error).splitlines() if line.strip()]
+    for line in lines:
+        if 'unsupported' in line.lower() or 'XLA' in line:
+            return line
+    return lines[0] if lines else type(error).__name__
+
+
+class XLAPredictor(object):
+    """
+    Keras model inference with XLA (jit) compiled tf.function, which fuses
+    the small Conv/BN/Add/UpSampling ops of hourglass to cut per-op
+    overhead. It has same predict()/predict_on_batch() interface as keras
+    model, and falls back to plain tf.function if model input shape is
+    dynamic or XLA compile fails.
+
+    # Arguments
+        model: keras model
+        jit_compile: whether to use XLA, False for plain tf.function
+    """
+    def __init__(self, model, jit_compile=True):
+        self.model = model
+        self.jit_compile = jit_compile
+        if jit_compile and not is_static_shape_model(model):
+            print('Model input shape {} is dynamic, disable XLA compile'.format(model.input_shape))
+            self.jit_compile = False
+        self.predict_function = self._make_predict_function()
+
+    def _make_predict_function(self):
+        model = self.model
+        return tf.function(lambda inputs: model(inputs, training=False), jit_compile=self.jit_compile)
+
+    def predict_on_batch(self, inputs):
+        batch_size = len(inputs)
+        if self.jit_compile and batch_size > 0:
+            # pad batch to power of 2, to limit the number of compiled
+            # shapes for changing batch size (like person number)
+            padded_size = 1 << (batch_size - 1).bit_length()
+            if padded_size != batch_size:
+                inputs = np.concatenate([inputs, np.zeros((padded_size - batch_size,) + inputs.shape[1:], dtype=inputs.dtype)])
+
+        try:
+            outputs = self.predict_function(inputs)
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+            if not self.jit_compile:
+                raise
+            print('XLA compile failed, fall back to non-XLA inference: {}'.format(get_xla_error_message(e)))
+            self.jit_compile = False
+            self.predict_function = self._make_predict_function()
+            return self.predict_on_batch(inputs[:batch_size])
+
+        return tf.nest.map_structure(lambda output: output.numpy()[:batch_size], outputs)
+
+    def predict(self, inputs):
+        return self.predict_on_batch(inputs)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read-ahead of raw image file bytes for datasets on remote storage (like
+NFS), where PIL Image.open() stalls on network reads one file at a time.
+
+BytePrefetcher reads the files of upcoming batches with a thread pool, in
+the order they will be used, and keeps the fetched bytes in a bounded
+FIFO buffer, so decoding only waits for files which are not read ahead.
+An optional LocalFileCache keeps fetched files on local disk (SSD) with a
+byte budget, so they are not fetched from remote storage again in later
+epochs or training runs.
+"""
+import os, threading, hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class LocalFileCache(object):
+    """
+    Size bounded local disk cache of remote file content. Files are
+    stored by hash of their cache key, and evicted in LRU order when over
+    budget. The key should identify the source file content, like its
+    absolute path with size & mtime (see BytePrefetcher key_func), so
+    datasets sharing a cache dir don't collide and a changed source file
+    is not served from cache. Cached files are kept across runs, and the LRU index is
+    rebuilt from file access time at startup.
+
+    Only the process which creates the cache writes & evicts files,
+    copies in other processes (data loader workers) are read only.
+
+    # Arguments
+        cache_path: local dir to store cached files
+        budget: cache size in bytes
+    """
+    def __init__(self, cache_path, budget):
+        self.cache_path = cache_path
+        self.budget = budget
+        self.owner_pid = os.getpid()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_path, exist_ok=True)
+
+        # LRU index of cached files: name -> size
+        self.index = OrderedDict()
+        self.used_bytes = 0
+        entries = []
+        for entry in os.scandir(cache_path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.index[name] = size
+            self.used_bytes += size
+        self._evict()
+
+    def _get_name(self, key):
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """
+        get cached file content, or None if not cached
+        """
+        name = self._get_name(key)
+        try:
+            with open(os.path.join(self.cache_path, name), 'rb') as cache_file:
+                data = cache_file.read()
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if name in self.index:
+                self.index.move_to_end(name)
+        return data
+
+    def put(self, key, data):
+        if self.owner_pid != os.getpid() or len(data) > self.budget:
+            return
+        name = self._get_name(key)
+        file_path = os.path.join(self.cache_path, name)
+        # write to temp file first, so reader never get a partial file
+        temp_file_path = '{}.{}.{}.tmp'.format(file_path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_file_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_file_path, file_path)
+        except OSError:
+            # local disk full or not writable, just skip caching
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+            return
+
+        with self.lock:
+            if name in self.index:
+                self.used_bytes -= self.index.pop(name)
+            self.index[name] = len(data)
+            self.used_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.used_bytes > self.budget and self.index:
+            name, size = self.index.popitem(last=False)
+            self.used_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_path, name))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.index),
+                    'used_bytes': self.used_bytes, 'budget': self.budget}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class BytePrefetcher(object):
+    """
+    Read file bytes ahead of time with a thread pool. schedule() the
+    files in the order they will be used, and get() them when decoding.
+    get() returns at once for fetched file, waits for the one in flight
+    and read it synchronously if it was not scheduled (or already
+    dropped from buffer).
+
+    Fetch threads only run in the process which schedules files. When
+    passed to data loader worker processes, the prefetcher buffer is
+    empty there, and could be fed with fetched bytes by update()
+
+    # Arguments
+        read_func: function to read content of a file as bytes
+        num_threads: number of fetch threads
+        max_items: max number of files in buffer (fetched or in flight),
+            oldest ones are dropped first
+        local_cache: optional LocalFileCache to read files from, and
+            store fetched files to
+        key_func: function to get local cache key of a file, which should
+            change with file content. None to use the path as key
+    """
+    def __init__(self, read_func, num_threads=8, max_items=256, local_cache=None, key_func=None):
+        self.read_func = read_func
+        self.num_threads = num_threads
+        self.max_items = max(1, max_items)
+        self.local_cache = local_cache
+        self.key_func = key_func
+        self._setup()
+
+    def _setup(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.executor = None
+        # buffer of fetched files: path -> Future of the bytes
+        self.buffer = OrderedDict()
+        self.reset_stats()
+
+    def _check_process(self):
+        # forked worker process get a copy of the buffer, but
+        # no fetch thread to complete the in flight ones
+        if self.pid != os.getpid():
+            self._setup()
+
+    def fetch(self, img_path):
+        """
+        read file content, through local cache if available
+        """
+        if self.local_cache is None:
+            return self.read_func(img_path)
+
+        key = self.key_func(img_path) if self.key_func else img_path
+        data = self.local_cache.get(key)
+        if data is None:
+            data = self.read_func(img_path)
+            self.local_cache.put(key, data)
+        return data
+
+    def schedule(self, img_paths):
+        """
+        start fetching files, in the order of img_paths
+        """
+        self._check_process()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='byte_prefetcher')
+            for img_path in img_paths:
+                if img_path in self.buffer:
+                    # keep it from being dropped before use
+                    self.buffer.move_to_end(img_path)
+                    continue
+                self.buffer[img_path] = self.executor.submit(self.fetch, img_path)
+                self.scheduled += 1
+            self._drop()
+
+    def update(self, fetched):
+        """
+        put fetched bytes (dict of path -> bytes) to buffer
+        """
+        self._check_process()
+        with self.lock:
+            for img_path, data in fetched.items():
+                future = Future()
+                future.set_result(data)
+                self.buffer[img_path] = future
+            self._drop()
+
+    def _drop(self):
+        while len(self.buffer) > self.max_items:
+            _, future = self.buffer.popitem(last=False)
+            future.cancel()
+
+    def get_ready(self, img_paths):
+        """
+        get dict of path -> bytes for the files which are
+        already fetched, without waiting for the others
+        """
+        self._check_process()
+        fetched = dict()
+        with self.lock:
+            for img_path in img_paths:
+                future = self.buffer.get(img_path)
+                if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                    fetched[img_path] = future.result()
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return fetched
+
+    def get(self, img_path):
+        """
+        get file content as bytes
+        """
+        self._check_process()
+        with self.lock:
+            future = self.buffer.get(img_path)
+            if future is None:
+                self.misses += 1
+            elif future.done():
+                self.hits += 1
+            else:
+                self.waits += 1
+
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()
+            except Exception:
+                # fetch failed, retry below so the
+                # error is raised in caller's context
+                pass
+        return self.fetch(img_path)
+
+    def get_stats(self):
+        with self.lock:
+            return {'scheduled': self.scheduled, 'hits': self.hits,
+                    'waits': self.waits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.scheduled = 0
+            self.hits = 0
+            self.waits = 0
+            self.misses = 0
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            executor, self.executor = self.executor, None
+            for future in self.buffer.values():
+                future.cancel()
+            self.buffer = OrderedDict()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def __getstate__(self):
+        # threads & in flight fetches stay in the scheduling process
+        return {'read_func': self.read_func, 'num_threads': self.num_threads,
+                'max_items': self.max_items, 'local_cache': self.local_cache,
+                'key_func': self.key_func}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
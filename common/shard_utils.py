@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Packed dataset shard format, for reading training images from a few large
+files (with mmap) instead of thousands of loose image files.
+
+A packed dataset directory looks like:
+
+    <dataset_path>/
+        annotations.json            # same as the loose image dataset
+        shards/
+            index.json              # image offset index
+            shard_00000.bin         # concatenated origin image files
+            shard_00001.bin
+            ...
+
+index.json format:
+    {'shards': ['shard_00000.bin', ...],
+     'images': {img_paths: [shard_index, offset, length], ...}}
+
+Image file content is stored unchanged, so decoded image is exactly same
+as loose image file.
+"""
+import os, io, json, mmap
+import random
+from collections import OrderedDict
+
+SHARD_DIR = 'shards'
+SHARD_INDEX_FILE = 'index.json'
+
+
+class ShardWriter(object):
+    """
+    Pack image files into shard files, roll over to a new
+    shard when current one reach shard_size bytes
+    """
+    def __init__(self, output_path, shard_size=512*1024*1024):
+        self.shard_path = os.path.join(output_path, SHARD_DIR)
+        os.makedirs(self.shard_path, exist_ok=True)
+        self.shard_size = shard_size
+
+        self.shards = []
+        self.images = OrderedDict()
+        self.shard_file = None
+        self.offset = 0
+
+    def _new_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        shard_name = 'shard_{:05d}.bin'.format(len(self.shards))
+        self.shards.append(shard_name)
+        self.shard_file = open(os.path.join(self.shard_path, shard_name), 'wb')
+        self.offset = 0
+
+    def __contains__(self, img_path):
+        return img_path in self.images
+
+    def write(self, img_path, image_bytes):
+        if self.shard_file is None or (self.offset > 0 and self.offset + len(image_bytes) > self.shard_size):
+            self._new_shard()
+
+        self.shard_file.write(image_bytes)
+        self.images[img_path] = [len(self.shards) - 1, self.offset, len(image_bytes)]
+        self.offset += len(image_bytes)
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+
+        with open(os.path.join(self.shard_path, SHARD_INDEX_FILE), 'w') as index_file:
+            json.dump({'shards': self.shards, 'images': self.images}, index_file)
+
+
+class ShardReader(object):
+    """
+    Read image file content from packed shards with mmap. Shard
+    files are mapped lazily, so it could be passed to data loader
+    worker process before any read
+    """
+    def __init__(self, dataset_path):
+        self.shard_path = os.path.join(dataset_path, SHARD_DIR)
+        with open(os.path.join(self.shard_path, SHARD_INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+        self.shards = index['shards']
+        self.images = index['images']
+        self.mmaps = {}
+
+    @staticmethod
+    def exists(dataset_path):
+        return os.path.isfile(os.path.join(dataset_path, SHARD_DIR, SHARD_INDEX_FILE))
+
+    def __contains__(self, img_path):
+        return img_path in self.images
+
+    def _get_mmap(self, shard_index):
+        if shard_index not in self.mmaps:
+            with open(os.path.join(self.shard_path, self.shards[shard_index]), 'rb') as shard_file:
+                self.mmaps[shard_index] = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmaps[shard_index]
+
+    def get_shard_index(self, img_path):
+        return self.images[img_path][0]
+
+    def read(self, img_path):
+        """
+        get image file content as a zero-copy memoryview on shard mmap
+        """
+        shard_index, offset, length = self.images[img_path]
+        return memoryview(self._get_mmap(shard_index))[offset:offset+length]
+
+    def open(self, img_path):
+        """
+        get image file content as a file object, for PIL Image.open()
+        """
+        return io.BytesIO(self.read(img_path))
+
+    def shuffle(self, annotations):
+        """
+        shard-local shuffle of annotation records in place: shuffle shard
+        order, and records inside each shard, so that shard files are
+        still read one by one in an epoch
+        """
+        shard_annotations = OrderedDict()
+        for annotation in annotations:
+            shard_annotations.setdefault(self.get_shard_index(annotation['img_paths']), []).append(annotation)
+
+        shard_list = list(shard_annotations.values())
+        random.shuffle(shard_list)
+        for shard_annotation in shard_list:
+            random.shuffle(shard_annotation)
+
+        annotations[:] = [annotation for shard_annotation in shard_list for annotation in shard_annotation]
+        return annotations
+
+    def close(self):
+        for shard_mmap in self.mmaps.values():
+            shard_mmap.close()
+        self.mmaps = {}
+
+    def __getstate__(self):
+        # mmap could not be pickled, just remap in new process
+        state = self.__dict__.copy()
+        state['mmaps'] = {}
+        return state
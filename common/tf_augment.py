@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch level data augment with tensor ops. Random parameters are picked
+per-sample, but the whole batch is processed together in graph, so it
+could run inside tf.data pipeline and use intra-op thread pool.
+"""
+import numpy as np
+import tensorflow as tf
+
+from common.data_utils import PIL_GRAY_WEIGHTS, PIL_SMOOTH_KERNEL
+
+
+def _random_uniform(batch_size, minval, maxval):
+    # per-sample random value, reshape to (batch_size, 1, 1, 1)
+    # for broadcasting on image batch
+    return tf.reshape(tf.random.uniform((batch_size,), minval, maxval), (-1, 1, 1, 1))
+
+
+def _random_choice(batch_size, prob):
+    return tf.reshape(tf.random.uniform((batch_size,)) < prob, (-1, 1, 1, 1))
+
+
+def _depthwise_filter(images, kernel):
+    """
+    apply a 2D kernel on every channel of image batch, with
+    reflect border like cv2.filter2D() default
+    """
+    pad = kernel.shape[0] // 2
+    channels = images.shape[-1]
+    kernel = np.tile(kernel[:, :, np.newaxis, np.newaxis], (1, 1, channels, 1)).astype(np.float32)
+
+    images = tf.pad(images, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT')
+    return tf.nn.depthwise_conv2d(images, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+
+def _gray(images, weights):
+    return tf.reduce_sum(images * tf.constant(weights, dtype=tf.float32), axis=-1, keepdims=True)
+
+
+def batch_photometric_augment(images, jitter=.5, grayscale_prob=.1, blur_prob=.2, blur_size=5):
+    """
+    Random photometric augment for image batch, with same random range
+    and blend formula as random_photometric() in data_utils: brightness,
+    chroma, contrast, sharpness, grayscale & gaussian blur. CLAHE histogram
+    equalization has no cheap tensor version and is not included.
+
+    # Arguments
+        images: image batch tensor, float32 with value range 0 ~ 255
+            shape=(batch_size, height, width, 3)
+        jitter: jitter range for random brightness/chroma/contrast/sharpness
+        grayscale_prob: probability for grayscale convert
+        blur_prob: probability for gaussian blur
+        blur_size: kernel size for gaussian blur
+
+    # Returns
+        images: augmented image batch tensor, value range 0 ~ 255
+    """
+    batch_size = tf.shape(images)[0]
+
+    # brightness: blend with black image
+    images = tf.clip_by_value(images * _random_uniform(batch_size, jitter, 1/jitter), 0., 255.)
+
+    # chroma: blend with grayscale image
+    gray = _gray(images, PIL_GRAY_WEIGHTS)
+    images = tf.clip_by_value(gray + _random_uniform(batch_size, jitter, 1/jitter) * (images - gray), 0., 255.)
+
+    # contrast: blend with mean gray level of image
+    gray_mean = tf.reduce_mean(_gray(images, PIL_GRAY_WEIGHTS), axis=[1, 2, 3], keepdims=True)
+    images = tf.clip_by_value(gray_mean + _random_uniform(batch_size, jitter, 1/jitter) * (images - gray_mean), 0., 255.)
+
+    # sharpness: blend with smoothed image
+    smooth = _depthwise_filter(images, PIL_SMOOTH_KERNEL)
+    images = tf.clip_by_value(smooth + _random_uniform(batch_size, jitter, 1/jitter) * (images - smooth), 0., 255.)
+
+    # grayscale, same channel weights as random_grayscale()
+    gray = _gray(images, PIL_GRAY_WEIGHTS[::-1])
+    images = tf.where(_random_choice(batch_size, grayscale_prob), tf.broadcast_to(gray, tf.shape(images)), images)
+
+    # gaussian blur, use same kernel as cv2.GaussianBlur() with sigma 0
+    gaussian_1d = np.array([0.3 * ((blur_size - 1) * 0.5 - 1) + 0.8])
+    gaussian_1d = np.exp(-(np.arange(blur_size) - (blur_size - 1) / 2) ** 2 / (2 * gaussian_1d ** 2))
+    gaussian_1d = gaussian_1d / np.sum(gaussian_1d)
+    blurred = _depthwise_filter(images, np.outer(gaussian_1d, gaussian_1d))
+    images = tf.where(_random_choice(batch_size, blur_prob), blurred, images)
+
+    return images
+
+
+def get_flip_permutation(num_keypoints, matchpoints=None):
+    """
+    get keypoint index permutation for swapping matched
+    keypoint pairs, as horizontal_flip_keypoints() do
+    """
+    permutation = np.arange(num_keypoints)
+    if matchpoints:
+        for i, j in matchpoints:
+            permutation[i], permutation[j] = permutation[j], permutation[i]
+    return permutation
+
+
+def batch_affine_augment(images, keypoints, input_shape, output_shape, horizontal_matchpoints=None, vertical_matchpoints=None,
+                         scale_range=(0.8, 1.2), rotate_range=30, rotate_prob=.5, flip_prob=.5):
+    """
+    Random flip, scale & rotate augment on a batch of object images which
+    are cropped with extra margin (see hourglass_dataset.crop_object()),
+    and warp them to model input size. Keypoints are transformed with the
+    same per-sample matrix, then rounded as transform_keypoints() do.
+
+    Random range is same as hourglass_dataset: horizontal & vertical flip
+    with matched keypoint swap, scale jitter in scale_range, integer rotate
+    angle in [-rotate_range, rotate_range) with rotate_prob.
+
+    # Arguments
+        images: margined object image batch tensor, float32
+            shape=(batch_size, margin_height, margin_width, 3)
+        keypoints: keypoints tensor in margined heatmap reference
+            before integer rounding, shape=(batch_size, num_keypoints, 3)
+        input_shape: model input shape as (height, width)
+        output_shape: heatmap shape as (height, width)
+        horizontal_matchpoints: list of keypoint index pair to swap in horizontal flip
+        vertical_matchpoints: list of keypoint index pair to swap in vertical flip
+
+    # Returns
+        images: augmented image batch tensor, shape=(batch_size, height, width, 3)
+        keypoints: transformed keypoints tensor in heatmap reference
+    """
+    batch_size = tf.shape(images)[0]
+    num_keypoints = keypoints.shape[1]
+
+    scales = tf.random.uniform((batch_size,), scale_range[0], scale_range[1])
+    angles = tf.cast(tf.random.uniform((batch_size,), -rotate_range, rotate_range, dtype=tf.int32), tf.float32)
+    angles = tf.where(tf.random.uniform((batch_size,)) < rotate_prob, angles, tf.zeros_like(angles))
+    h_flips = tf.random.uniform((batch_size,)) < flip_prob
+    v_flips = tf.random.uniform((batch_size,)) < flip_prob
+
+    # matrix M map margined crop to output crop on same pixel density,
+    # both relative to crop center: bigger scale means bigger crop area,
+    # rotate direction is same as crop_image()
+    rad = angles * np.pi / 180
+    cs, sn = tf.cos(rad) / scales, tf.sin(rad) / scales
+    fx = tf.where(h_flips, -1., 1.)
+    fy = tf.where(v_flips, -1., 1.)
+    m00, m01 = cs * fx, sn * fy
+    m10, m11 = -sn * fx, cs * fy
+
+    # warp image. ImageProjectiveTransformV3 need the inverse map from
+    # output pixel index to input pixel index, and M is a scaled
+    # rotation & flip, so the inverse is scales^2 * M^T
+    margin_height, margin_width = images.shape[1], images.shape[2]
+    s2 = scales * scales
+    i00, i01, i10, i11 = m00 * s2, m10 * s2, m01 * s2, m11 * s2
+    ox, oy = 0.5 - input_shape[1] / 2, 0.5 - input_shape[0] / 2
+    b0 = i00 * ox + i01 * oy + margin_width / 2 - 0.5
+    b1 = i10 * ox + i11 * oy + margin_height / 2 - 0.5
+    zeros = tf.zeros_like(scales)
+    transforms = tf.stack([i00, i01, b0, i10, i11, b1, zeros, zeros], axis=1)
+    images = tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms,
+                                                   output_shape=tf.constant(input_shape, dtype=tf.int32),
+                                                   fill_value=0., interpolation='BILINEAR', fill_mode='CONSTANT')
+
+    # swap matched keypoints for flipped sample
+    keypoints = tf.where(tf.reshape(h_flips, (-1, 1, 1)),
+                         tf.gather(keypoints, get_flip_permutation(num_keypoints, horizontal_matchpoints), axis=1), keypoints)
+    keypoints = tf.where(tf.reshape(v_flips, (-1, 1, 1)),
+                         tf.gather(keypoints, get_flip_permutation(num_keypoints, vertical_matchpoints), axis=1), keypoints)
+
+    # transform keypoints on heatmap reference, with the
+    # integer rounding and "+1" of transform()
+    margin_output_height, margin_output_width = output_shape[0] * margin_height // input_shape[0], output_shape[1] * margin_width // input_shape[1]
+    x = keypoints[..., 0] - margin_output_width / 2
+    y = keypoints[..., 1] - margin_output_height / 2
+    new_x = tf.floor(m00[:, tf.newaxis] * x + m01[:, tf.newaxis] * y + output_shape[1] / 2) + 1
+    new_y = tf.floor(m10[:, tf.newaxis] * x + m11[:, tf.newaxis] * y + output_shape[0] / 2) + 1
+    keypoints = tf.stack([new_x, new_y, keypoints[..., 2]], axis=-1)
+
+    return images, keypoints
+
+
+def render_gt_heatmaps_tensor(batch_keypoints, heatmap_shape, sigma=1):
+    """
+    Render ground truth gaussian heatmaps for a batch of keypoints with
+    tensor ops, same as render_gt_heatmaps() in data_utils (keypoint whose
+    gaussian extend to heatmap border is skipped)
+
+    # Arguments
+        batch_keypoints: keypoints tensor, shape=(batch_size, num_keypoints, 3)
+            each keypoints with format (x, y, visibility)
+        heatmap_shape: heatmap shape as (height, width)
+        sigma: variance of the 2D gaussian heatmap distribution
+
+    # Returns
+        batch_heatmaps: heatmap tensor, float32
+            shape=(batch_size, height, width, num_keypoints)
+    """
+    heatmap_height, heatmap_width = heatmap_shape
+    batch_keypoints = tf.cast(batch_keypoints, tf.float32)
+    size = 6 * sigma + 1
+    center = size // 2
+
+    # gaussian range on heatmap, same rounding as label_heatmap()
+    upper_left_x = tf.cast(tf.cast(batch_keypoints[..., 0] - 3 * sigma, tf.int32), tf.float32)
+    upper_left_y = tf.cast(tf.cast(batch_keypoints[..., 1] - 3 * sigma, tf.int32), tf.float32)
+    bottom_right_x = tf.cast(tf.cast(batch_keypoints[..., 0] + 3 * sigma + 1, tf.int32), tf.float32)
+    bottom_right_y = tf.cast(tf.cast(batch_keypoints[..., 1] + 3 * sigma + 1, tf.int32), tf.float32)
+    valid = (batch_keypoints[..., 2] > 0) & (upper_left_x >= 0) & (upper_left_y >= 0) & \
+            (bottom_right_x < heatmap_width) & (bottom_right_y < heatmap_height)
+
+    # gaussian kernel is separable, so render it as outer product of
+    # x & y part, with shape (batch_size, 1, width, num_keypoints) and
+    # (batch_size, height, 1, num_keypoints)
+    kernel_x = tf.range(heatmap_width, dtype=tf.float32)[tf.newaxis, :, tf.newaxis] - upper_left_x[:, tf.newaxis, :]
+    kernel_y = tf.range(heatmap_height, dtype=tf.float32)[tf.newaxis, :, tf.newaxis] - upper_left_y[:, tf.newaxis, :]
+    span = tf.minimum(bottom_right_x - upper_left_x, size)[:, tf.newaxis, :]
+    gaussian_x = tf.where((kernel_x >= 0) & (kernel_x < span),
+                          tf.exp(-(kernel_x - center) ** 2 / (2 * sigma ** 2)), 0.)
+    span = tf.minimum(bottom_right_y - upper_left_y, size)[:, tf.newaxis, :]
+    gaussian_y = tf.where((kernel_y >= 0) & (kernel_y < span),
+                          tf.exp(-(kernel_y - center) ** 2 / (2 * sigma ** 2)), 0.)
+
+    gaussian_x = gaussian_x * tf.cast(valid, tf.float32)[:, tf.newaxis, :]
+    return gaussian_y[:, :, tf.newaxis, :] * gaussian_x[:, tf.newaxis, :, :]
@@ -14,6 +14,7 @@ from hourglass.data import HG_OUTPUT_STRIDE
 from hourglass.postprocess import post_process_heatmap, post_process_heatmap_simple
 from common.data_utils import preprocess_image
 from common.utils import get_classes, get_skeleton, render_skeleton, optimize_tf_gpu
+from common.model_utils import XLAPredictor
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -31,6 +32,7 @@ default_config = {
         "classes_path": os.path.join('configs', 'mpii_classes.txt'),
         "skeleton_path": None,
         "weights_path": os.path.join('weights', 'hourglass_mobile.h5'),
+        "use_xla": False,
         "gpu_num" : 1,
     }
 
@@ -55,6 +57,8 @@ class Hourglass(object):
             self.skeleton_lines = None
         self.class_names = get_classes(self.classes_path)
         self.hourglass_model = self._generate_model()
+        # XLA compiled inference to fuse the small ops in hourglass blocks
+        self.predictor = XLAPredictor(self.hourglass_model) if self.use_xla else self.hourglass_model
         K.set_learning_phase(0)
 
     def _generate_model(self):
@@ -101,7 +105,7 @@ class Hourglass(object):
 
     def predict(self, image_data):
         # get final predict heatmap
-        prediction = self.hourglass_model.predict(image_data)
+        prediction = self.predictor.predict(image_data)
         if isinstance(prediction, list):
             prediction = prediction[-1]
         heatmap = prediction[0]
@@ -219,6 +223,10 @@ if __name__ == "__main__":
         '--conf_threshold', type=float,
         help='confidence threshold, default ' + str(Hourglass.get_defaults("conf_threshold"))
     )
+    parser.add_argument(
+        '--use_xla', default=False, action="store_true",
+        help='use XLA compiled inference, default ' + str(Hourglass.get_defaults("use_xla"))
+    )
 
     parser.add_argument(
         '--image', default=False, action="store_true",
@@ -19,9 +19,10 @@ import MNN
 import onnxruntime
 
 from hourglass.data import hourglass_dataset
+from hourglass.val_cache import ValidationCache
 from hourglass.postprocess import post_process_heatmap, post_process_heatmap_simple
-from common.data_utils import invert_transform_keypoints, revert_keypoints
-from common.model_utils import get_normalize
+from common.data_utils import batch_invert_transform_keypoints, batch_revert_keypoints
+from common.model_utils import get_normalize, XLAPredictor
 from common.utils import get_classes, get_skeleton, render_skeleton, optimize_tf_gpu
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -167,19 +168,23 @@ def draw_plot_func(dictionary, n_classes, window_title, plot_title, x_label, out
 
 
 def revert_pred_keypoints(keypoints, metainfo, model_input_shape, heatmap_shape):
-    # invert transform keypoints based on center & scale
-    center = metainfo['center']
-    scale = metainfo['scale']
-    image_shape = metainfo['image_shape']
+    return batch_revert_pred_keypoints(keypoints[np.newaxis], [metainfo], model_input_shape, heatmap_shape)[0]
+
+
+def batch_revert_pred_keypoints(batch_keypoints, metainfos, model_input_shape, heatmap_shape):
+    # invert transform a batch of keypoints based on center & scale
+    centers = np.array([metainfo['center'] for metainfo in metainfos])
+    scales = np.array([metainfo['scale'] for metainfo in metainfos])
+    image_shapes = np.array([metainfo['image_shape'][0:2] for metainfo in metainfos])
 
     #######################################################################################################
     # 2 ways of keypoints invert transform, according to data preprocess solutions in hourglass/data.py
 
     # Option 1 (from origin repo):
-    reverted_keypoints = invert_transform_keypoints(keypoints, center, scale, heatmap_shape, rotate_angle=0)
+    reverted_keypoints = batch_invert_transform_keypoints(batch_keypoints, centers, scales, heatmap_shape, rotate_angles=0)
 
     # Option 2:
-    #reverted_keypoints = revert_keypoints(keypoints, center, scale, image_shape, model_input_shape)
+    #reverted_keypoints = batch_revert_keypoints(batch_keypoints, centers, scales, image_shapes, model_input_shape)
 
     return reverted_keypoints
 
@@ -439,6 +444,11 @@ def eval_PCK(model, model_format, eval_dataset, class_names, model_input_shape,
     #
     output_list = []
 
+    # predict keypoints & metainfo of all samples, which
+    # are reverted to origin image shape together
+    pred_keypoints_list = []
+    metainfo_list = []
+
     count = 0
     pbar = tqdm(total=eval_dataset.get_dataset_size(), desc='Eval model')
     for image_data, gt_heatmap, metainfo in eval_dataset:
@@ -446,6 +456,10 @@ def eval_PCK(model, model_format, eval_dataset, class_names, model_input_shape,
         count += 1
         if count > eval_dataset.get_dataset_size():
             break
+        # empty crop sample is bypassed by dataset, with no metainfo
+        if len(metainfo) == 0:
+            pbar.update(1)
+            continue
 
         # support of tflite model
         if model_format == 'TFLITE':
@@ -484,19 +498,24 @@ def eval_PCK(model, model_format, eval_dataset, class_names, model_input_shape,
             elif result_list[i] == 1:
                 succeed_dict[class_name] = succeed_dict[class_name] + 1
 
+        pred_keypoints_list.append(pred_keypoints)
+        metainfo_list.append(metainfo)
+        pbar.update(1)
+    pbar.close()
+
+    if pred_keypoints_list:
         # revert predict keypoints back to origin image shape
-        reverted_pred_keypoints = revert_pred_keypoints(pred_keypoints, metainfo, model_input_shape, heatmap_shape)
+        batch_reverted_keypoints = batch_revert_pred_keypoints(np.array(pred_keypoints_list), metainfo_list, model_input_shape, heatmap_shape)
 
-        # get coco result dict with predict keypoints and image info
-        result_dict = get_result_dict(reverted_pred_keypoints, metainfo)
-        # add result dict to output list
-        output_list.append(result_dict)
+        for reverted_pred_keypoints, metainfo in zip(batch_reverted_keypoints, metainfo_list):
+            # get coco result dict with predict keypoints and image info
+            result_dict = get_result_dict(reverted_pred_keypoints, metainfo)
+            # add result dict to output list
+            output_list.append(result_dict)
 
-        if save_result:
-            # render keypoints skeleton on image and save result
-            save_keypoints_detection(reverted_pred_keypoints, metainfo, class_names, skeleton_lines)
-        pbar.update(1)
-    pbar.close()
+            if save_result:
+                # render keypoints skeleton on image and save result
+                save_keypoints_detection(reverted_pred_keypoints, metainfo, class_names, skeleton_lines)
 
     # save to coco result json
     os.makedirs('result', exist_ok=True)
@@ -620,6 +639,14 @@ def main():
         '--model_input_shape', type=str,
         help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
 
+    parser.add_argument(
+        '--val_cache', default=False, action="store_true",
+        help='use preprocessed validation tensor cache (shared with training eval callback), create it if not exist')
+
+    parser.add_argument(
+        '--val_cache_path', type=str, required=False,
+        help='dir to store validation tensor cache, default None for dataset path', default=None)
+
     parser.add_argument(
         '--save_result', default=False, action="store_true",
         help='Save the detection result image in result/detection dir')
@@ -628,6 +655,10 @@ def main():
         '--skeleton_path', type=str, required=False,
         help='path to keypoint skeleton definitions, default None', default=None)
 
+    parser.add_argument(
+        '--use_xla', default=False, action="store_true",
+        help='use XLA compiled inference for h5 model')
+
     args = parser.parse_args()
 
     # param parse
@@ -643,11 +674,17 @@ def main():
 
     # load trained model for eval
     model, model_format = load_eval_model(args.model_path)
+    if args.use_xla:
+        if model_format != 'H5':
+            raise ValueError('XLA inference is only supported for h5 model')
+        model = XLAPredictor(model)
 
     # prepare eval dataset
     eval_dataset = hourglass_dataset(args.dataset_path, batch_size=1, class_names=class_names,
                               input_shape=model_input_shape, num_hgstack=1, is_train=False, with_meta=True)
 
+    if args.val_cache:
+        eval_dataset = ValidationCache(eval_dataset, cache_path=args.val_cache_path, with_heatmap=False)
 
     total_accuracy, accuracy_dict = eval_PCK(model, model_format, eval_dataset, class_names, model_input_shape, args.score_threshold, normalize, args.conf_threshold, args.save_result, skeleton_lines)
 
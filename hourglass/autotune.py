@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Autotune of training data loader settings on current machine. Short timed
+trials of the input pipeline are run for worker number, prefetch queue
+depth, file read-ahead and shared image cache size, and the config with
+most samples/sec within a memory budget is picked. Tuned config is stored
+per host, dataset & batch shape, so later training runs reuse it:
+
+    ~/.cache/hourglass/loader_autotune.json
+"""
+import os, time, json, pickle, socket
+import multiprocessing
+import numpy as np
+
+from hourglass.data import hourglass_dataset
+from hourglass.loader import ParallelDataLoader
+from common.image_cache import SharedImageCache
+
+AUTOTUNE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'hourglass', 'loader_autotune.json')
+
+# loader settings used when not tuned, same as train.py defaults
+DEFAULT_CONFIG = {'workers': 1, 'max_queue_size': 10, 'read_ahead': 0, 'image_cache_size': 0}
+
+# a trial need to be this much faster to pick a config with more resource
+MIN_SPEEDUP = 1.05
+
+# fallback private memory of a loader worker process, if it could not be measured
+DEFAULT_WORKER_MEMORY = 256*1024*1024
+
+
+def get_autotune_key(dataset_path, input_shape, batch_size):
+    """
+    key of tuned config: host, cpu number, dataset & batch shape
+    """
+    return '{}:{}:{}:{}x{}:{}'.format(socket.gethostname(), multiprocessing.cpu_count(), os.path.realpath(dataset_path),
+                                      input_shape[0], input_shape[1], batch_size)
+
+
+def load_tuned_config(key, autotune_file=AUTOTUNE_FILE):
+    if not os.path.isfile(autotune_file):
+        return None
+    with open(autotune_file) as f:
+        tuned_configs = json.load(f)
+    return tuned_configs.get(key)
+
+
+def save_tuned_config(key, config, autotune_file=AUTOTUNE_FILE):
+    tuned_configs = dict()
+    if os.path.isfile(autotune_file):
+        with open(autotune_file) as f:
+            tuned_configs = json.load(f)
+    tuned_configs[key] = config
+
+    os.makedirs(os.path.dirname(autotune_file), exist_ok=True)
+    temp_file = autotune_file + '.tmp.{}'.format(os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(tuned_configs, f, indent=2)
+    os.replace(temp_file, autotune_file)
+
+
+def get_process_memory(pid):
+    """
+    private memory (bytes) of a process, which is not shared with parent
+    after fork. None if it could not be read (non-Linux)
+    """
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            private = 0
+            for line in f:
+                if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                    private += int(line.split()[1]) * 1024
+            return private
+    except (OSError, ValueError):
+        return None
+
+
+def get_file_size(dataset, annotations):
+    """
+    average image file size of some annotation records
+    """
+    sizes = []
+    for annotation in annotations:
+        if dataset.shard_reader:
+            sizes.append(dataset.shard_reader.images[annotation['img_paths']][2])
+        else:
+            sizes.append(os.path.getsize(os.path.join(dataset.image_path, annotation['img_paths'])))
+    return float(np.mean(sizes)) if sizes else 0.0
+
+
+class LoaderAutotuner(object):
+    """
+    Run loader trials with a hourglass_dataset config and pick the
+    fastest loader settings within memory budget
+
+    # Arguments
+        dataset_kwargs: dict of arguments to create training hourglass_dataset
+        memory_budget: max memory in bytes for loader workers, prefetch
+            queue, read-ahead buffer & image cache
+        trial_batches: number of batches to time in a trial
+        max_workers: max worker number to try, None for cpu number
+        verbose: print trial results
+    """
+    def __init__(self, dataset_kwargs, memory_budget, trial_batches=30, max_workers=None, verbose=True):
+        self.dataset_kwargs = dataset_kwargs
+        self.memory_budget = memory_budget
+        self.trial_batches = trial_batches
+        self.max_workers = max_workers if max_workers else multiprocessing.cpu_count()
+        self.verbose = verbose
+        self.worker_memory = None
+        self.trials = []
+
+        # measure batch & image file size for memory estimate
+        dataset = hourglass_dataset(**dataset_kwargs)
+        self.batch_size = dataset.batch_size
+        self.batch_bytes = len(pickle.dumps(dataset[0], protocol=pickle.HIGHEST_PROTOCOL))
+        self.file_bytes = get_file_size(dataset, dataset.get_annotations()[:10*dataset.batch_size])
+
+    def estimate_memory(self, config):
+        worker_memory = self.worker_memory if self.worker_memory is not None else DEFAULT_WORKER_MEMORY
+        workers = config['workers'] if config['workers'] > 1 else 0
+        # each in flight batch is in queue (pickled) and then unpickled
+        queue_memory = config['max_queue_size'] * self.batch_bytes * 2
+        # prefetcher buffer keeps 2 * read_ahead batches of files
+        read_ahead_memory = 2 * config['read_ahead'] * self.batch_size * self.file_bytes
+        return workers * worker_memory + queue_memory + read_ahead_memory + config['image_cache_size']*1024*1024
+
+    def run_trial(self, config):
+        """
+        time the loader with config, return samples/sec
+        """
+        image_cache = SharedImageCache(int(config['image_cache_size']*1024*1024)) if config['image_cache_size'] > 0 else None
+        dataset = hourglass_dataset(**dict(self.dataset_kwargs, image_cache=image_cache, read_ahead=config['read_ahead']))
+        num_batches = self.trial_batches
+
+        try:
+            if config['workers'] > 1:
+                loader = ParallelDataLoader(dataset, workers=config['workers'], max_queue_size=config['max_queue_size'])
+                # warm up with worker startup, and drain the batches
+                # queued meanwhile, so only steady state is timed
+                for _ in range(config['max_queue_size'] + 1):
+                    next(loader)
+                start = time.perf_counter()
+                for _ in range(num_batches):
+                    next(loader)
+                elapsed = time.perf_counter() - start
+                worker_memory = [get_process_memory(process.pid) for process in loader.processes]
+                loader.stop()
+                if None not in worker_memory:
+                    self.worker_memory = max(worker_memory + [self.worker_memory or 0])
+            else:
+                dataset[0]
+                start = time.perf_counter()
+                for i in range(num_batches):
+                    if i % len(dataset) == 0:
+                        dataset.on_epoch_end()
+                    dataset[i % len(dataset)]
+                elapsed = time.perf_counter() - start
+        finally:
+            if image_cache is not None:
+                image_cache.close()
+            if dataset.prefetcher is not None:
+                dataset.prefetcher.close()
+
+        samples_per_sec = num_batches * self.batch_size / elapsed
+        self.trials.append((dict(config), samples_per_sec))
+        if self.verbose:
+            print('autotune trial {}: {:.1f} samples/sec, estimated memory {:.0f}MB'.format(config, samples_per_sec, self.estimate_memory(config)/1024/1024))
+        return samples_per_sec
+
+    def tune_option(self, config, best_speed, option, candidates):
+        """
+        try candidates of one option on current best config, candidates
+        should be in increasing resource order
+        """
+        best_config = config
+        for value in candidates:
+            if value == config[option]:
+                continue
+            trial_config = dict(best_config, **{option: value})
+            if self.estimate_memory(trial_config) > self.memory_budget:
+                break
+            speed = self.run_trial(trial_config)
+            # more resource need to give obvious speedup
+            if speed > best_speed * MIN_SPEEDUP:
+                best_config, best_speed = trial_config, speed
+        return best_config, best_speed
+
+    def tune(self):
+        """
+        tune options one by one: worker number, prefetch queue
+        depth, file read-ahead and image cache size
+        """
+        config = dict(DEFAULT_CONFIG)
+        best_speed = self.run_trial(config)
+
+        worker_candidates = [2**i for i in range(1, 8) if 2**i < self.max_workers] + [self.max_workers]
+        config, best_speed = self.tune_option(config, best_speed, 'workers', sorted(set(worker_candidates)))
+        if config['workers'] > 1:
+            config, best_speed = self.tune_option(config, best_speed, 'max_queue_size', [2, 5, 10, 20, 40])
+        config, best_speed = self.tune_option(config, best_speed, 'read_ahead', [1, 2, 4])
+
+        # give half of the left memory budget to image cache
+        cache_size = int((self.memory_budget - self.estimate_memory(config)) / 2 / 1024 / 1024)
+        if cache_size >= 64:
+            config, best_speed = self.tune_option(config, best_speed, 'image_cache_size', [cache_size])
+
+        return dict(config, samples_per_sec=round(best_speed, 1), memory=int(self.estimate_memory(config)), time=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def get_loader_config(dataset_kwargs, memory_budget, trial_batches=30, autotune_file=AUTOTUNE_FILE):
+    """
+    get tuned loader config for the dataset on current host, and
+    run autotune if it's not tuned yet
+
+    # Returns
+        config: dict of 'workers', 'max_queue_size', 'read_ahead'
+            & 'image_cache_size' (in MB)
+    """
+    key = get_autotune_key(dataset_kwargs['dataset_path'], dataset_kwargs['input_shape'], dataset_kwargs['batch_size'])
+    config = load_tuned_config(key, autotune_file)
+    if config is not None and config.get('memory', 0) <= memory_budget:
+        print('Use tuned loader config {} from {}'.format(config, autotune_file))
+        return config
+
+    print('Autotune data loader on {}...'.format(key))
+    tuner = LoaderAutotuner(dataset_kwargs, memory_budget, trial_batches)
+    config = tuner.tune()
+    save_tuned_config(key, config, autotune_file)
+    print('Tuned loader config {}, saved to {}'.format(config, autotune_file))
+    return config
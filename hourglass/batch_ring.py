@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Ring of preallocated batch buffers for hourglass_dataset."""
+import threading
+import numpy as np
+
+
+class BatchSlot(object):
+    """
+    preallocated buffers of one batch
+    """
+    def __init__(self, index, batch_size, input_shape, output_shape, num_classes):
+        self.index = index
+        # input images:    batch_size * input_shape  * channel (3)
+        # output heatmaps: batch_size * output_shape * num_classes
+        # keypoints:       batch_size * num_classes * (x, y, visibility)
+        self.images = np.zeros(shape=(batch_size, input_shape[0], input_shape[1], 3), dtype=np.float32)
+        self.heatmaps = np.zeros(shape=(batch_size, output_shape[0], output_shape[1], num_classes), dtype=np.float32)
+        self.keypoints = np.zeros(shape=(batch_size, num_classes, 3), dtype=np.float64)
+        self.metainfo = list()
+        self.in_use = False
+
+
+class BatchSlotRing(object):
+    """
+    Fixed number of batch slots, which are handed out in round robin order.
+    A batch is formed up in place in an acquired slot, and the slot is not
+    reused until it's released, so consumer could hold several batches
+    (like in a prefetch queue) without copy. acquire() blocks when all the
+    slots are in use. Thread safe.
+
+    # Arguments
+        num_slots: number of batch slots
+        batch_size: batch size
+        input_shape: model input shape as (height, width)
+        output_shape: output heatmap shape as (height, width)
+        num_classes: number of keypoint classes
+    """
+    def __init__(self, num_slots, batch_size, input_shape, output_shape, num_classes):
+        self.slots = [BatchSlot(i, batch_size, input_shape, output_shape, num_classes) for i in range(max(1, num_slots))]
+        self.next_index = 0
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _get_free_slot(self):
+        for i in range(len(self.slots)):
+            slot = self.slots[(self.next_index + i) % len(self.slots)]
+            if not slot.in_use:
+                return slot
+        return None
+
+    def acquire(self, timeout=None):
+        """
+        get a free slot, wait at most timeout seconds
+        (None to wait forever) for it to be released
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._get_free_slot() is not None, timeout=timeout):
+                raise TimeoutError('no free batch slot in {} seconds'.format(timeout))
+            slot = self._get_free_slot()
+            slot.in_use = True
+            self.next_index = (slot.index + 1) % len(self.slots)
+            return slot
+
+    def release(self, slot):
+        with self.condition:
+            slot.in_use = False
+            self.condition.notify()
+
+    def __getstate__(self):
+        # lock could not be pickled (data loader worker with
+        # spawn), and slots are always free in a new process
+        state = self.__dict__.copy()
+        del state['condition']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.condition = threading.Condition()
+        for slot in self.slots:
+            slot.in_use = False
@@ -1,40 +1,88 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-import glob
+import time
+import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
 from hourglass.data import hourglass_dataset
-from common.model_utils import get_normalize
+from hourglass.val_cache import ValidationCache
+from hourglass.trainer import get_local_model
+from hourglass.checkpoint import AsyncCheckpointWriter, AsyncModelSaver
+from common.model_utils import get_normalize, XLAPredictor
 
 from eval import eval_PCK
 
 
-class CheckpointCleanCallBack(Callback):
-    def __init__(self, checkpoint_dir, max_val_keep=5):
-        self.checkpoint_dir = checkpoint_dir
-        self.max_val_keep = max_val_keep
+class LoaderProfileCallBack(Callback):
+    """
+    log data loader throughput & stage time histograms collected by
+    hourglass.profiler.LoaderProfiler to TensorBoard, every log_freq
+    training batches
+    """
+    def __init__(self, log_dir, profiler, log_freq=100):
+        self.profiler = profiler
+        self.log_freq = log_freq
+        self.writer = tf.summary.create_file_writer(os.path.join(log_dir, 'loader'))
+        self.step = 0
+        self.start_time = None
 
-    def on_epoch_end(self, epoch, logs=None):
+    def on_train_begin(self, logs=None):
+        self.profiler.reset()
+        self.start_time = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.step % self.log_freq != 0:
+            return
 
-        # filter out val checkpoints
-        val_checkpoints = sorted(glob.glob(os.path.join(self.checkpoint_dir, 'ep*.h5')), reverse=False)
+        elapsed = time.perf_counter() - self.start_time
+        summary = self.profiler.get_summary()
+        stage_times = self.profiler.get_stage_times()
+        slowest = self.profiler.get_slowest()
+        with self.writer.as_default():
+            tf.summary.scalar('loader/samples_per_sec', self.profiler.get_num_samples() / elapsed, step=self.step)
+            for stage, times in stage_times.items():
+                if len(times) > 0:
+                    tf.summary.histogram('loader/{}_ms'.format(stage), times * 1000, step=self.step)
+                    tf.summary.scalar('loader/{}_mean_ms'.format(stage), summary[stage]['mean'], step=self.step)
+            if slowest:
+                tf.summary.text('loader/slowest_samples', '\n\n'.join(['{:.3f}ms {}'.format(sample_time * 1000, img_path) for sample_time, img_path in slowest]), step=self.step)
+        self.writer.flush()
 
-        # keep latest val checkpoints
-        for val_checkpoint in val_checkpoints[:-(self.max_val_keep)]:
-            os.remove(val_checkpoint)
+        self.profiler.reset()
+        self.start_time = time.perf_counter()
 
 
 class EvalCallBack(Callback):
-    def __init__(self, log_dir, dataset_path, class_names, model_input_shape, model_type):
+    """
+    evaluate PCK on val dataset at the end of every epoch, and save model
+    checkpoint when val_acc improves. Checkpoints are written in background
+    by checkpoint_writer (an own writer if it's None), and only latest
+    max_val_keep ones are kept. With val_cache, preprocessed val input is
+    stored in val_cache_path (None for dataset path) by ValidationCache
+    """
+    def __init__(self, log_dir, dataset_path, class_names, model_input_shape, model_type, image_cache=None, checkpoint_writer=None, max_val_keep=5,
+                 val_cache=False, val_cache_path=None):
         self.log_dir = log_dir
         self.dataset_path = dataset_path
         self.class_names = class_names
         self.normalize = get_normalize(model_input_shape)
         self.model_input_shape = model_input_shape
         self.best_acc = 0.0
+        self.local_model = None
+        self.predictor = None
+
+        self.own_writer = checkpoint_writer is None
+        self.checkpoint_writer = AsyncCheckpointWriter() if self.own_writer else checkpoint_writer
+        self.model_saver = AsyncModelSaver(self.checkpoint_writer, pattern=os.path.join(self.log_dir, 'ep*.h5'), max_keep=max_val_keep)
 
         self.eval_dataset = hourglass_dataset(self.dataset_path, batch_size=1, class_names=self.class_names,
-                              input_shape=self.model_input_shape, num_hgstack=1, is_train=False, with_meta=True)
+                              input_shape=self.model_input_shape, num_hgstack=1, is_train=False, with_meta=True,
+                              image_cache=image_cache)
+        if val_cache:
+            # validation input is same for every epoch, so only
+            # preprocess it once and evaluate from cache
+            self.eval_dataset = ValidationCache(self.eval_dataset, cache_path=val_cache_path, with_heatmap=False)
 
         # record model & dataset name to draw training curve
         with open(os.path.join(self.log_dir, 'val.txt'), 'w+') as xfile:
@@ -42,7 +90,14 @@ class EvalCallBack(Callback):
         xfile.close()
 
     def on_epoch_end(self, epoch, logs=None):
-        val_acc, _ = eval_PCK(self.model, 'H5', self.eval_dataset, self.class_names, self.model_input_shape, score_threshold=0.5, normalize=self.normalize, conf_threshold=1e-6, save_result=False)
+        # evaluate & save a local copy of multi-worker model (model itself
+        # for local training), since evaluation only runs on chief worker
+        self.local_model = get_local_model(self.model, self.local_model)
+        if self.predictor is None:
+            # plain model call, as keras predict() could also run
+            # collective ops with distribution strategy
+            self.predictor = XLAPredictor(self.local_model, jit_compile=False)
+        val_acc, _ = eval_PCK(self.predictor, 'H5', self.eval_dataset, self.class_names, self.model_input_shape, score_threshold=0.5, normalize=self.normalize, conf_threshold=1e-6, save_result=False)
         print('validate accuray', val_acc, '@epoch', epoch)
 
         # record accuracy for every epoch to draw training curve
@@ -53,8 +108,15 @@ class EvalCallBack(Callback):
         if val_acc > self.best_acc:
             # Save best accuray value and model checkpoint
             checkpoint_dir = os.path.join(self.log_dir, 'ep{epoch:03d}-loss{loss:.3f}-val_acc{val_acc:.3f}.h5'.format(epoch=(epoch+1), loss=logs.get('loss'), val_acc=val_acc))
-            self.model.save(checkpoint_dir)
+            self.model_saver.save(self.local_model, checkpoint_dir)
             print('Epoch {epoch:03d}: val_acc improved from {best_acc:.3f} to {val_acc:.3f}, saving model to {checkpoint_dir}'.format(epoch=epoch+1, best_acc=self.best_acc, val_acc=val_acc, checkpoint_dir=checkpoint_dir))
             self.best_acc = val_acc
         else:
             print('Epoch {epoch:03d}: val_acc did not improve from {best_acc:.3f}'.format(epoch=epoch+1, best_acc=self.best_acc))
+
+    def on_train_end(self, logs=None):
+        # flush pending checkpoints
+        if self.own_writer:
+            self.checkpoint_writer.close()
+        else:
+            self.checkpoint_writer.wait()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Full training state checkpoint, so a preempted training job could resume
+exactly where it stopped. The state of model weights, optimizer variables
+(slots, iterations for LR schedule & loss scale), epoch metrics, epoch &
+step, data loader position, dataset shuffle seed and random generator
+states is pickled into one file. It's written to a temp file, fsync-ed and
+renamed, so a killed job never leaves a broken checkpoint:
+
+    logs/000/state/state-ep<epoch>-step<step>.pkl
+
+The step is the optimizer step within the epoch to resume from, and state
+saved at end of epoch N is named as epoch N+1, step 0.
+
+Checkpoint files could also be written by AsyncCheckpointWriter on a
+background thread, so serialization, fsync and cleanup of old checkpoints
+don't stall training. Only the snapshot of weights & state into host memory
+is done on the training thread.
+"""
+import os, re, glob
+import sys
+import pickle
+import signal
+import threading
+import queue
+
+STATE_PATTERN = re.compile(r'state-ep(\d+)-step(\d+)\.pkl$')
+
+
+def get_temp_path(path):
+    return path + '.tmp.{}'.format(os.getpid())
+
+
+def commit_file(temp_path, path):
+    """
+    fsync a written temp file and rename it to path, so the
+    file is either the old one or the complete new one
+    """
+    with open(temp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+    # fsync dir to persist the rename
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_file_atomic(path, data):
+    """
+    write bytes to file with temp file, fsync & rename
+    """
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    commit_file(temp_path, path)
+
+
+def save_training_state(path, state):
+    write_file_atomic(path, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def remove_old_files(paths, max_keep):
+    """
+    keep-last-N retention: remove all but the last max_keep
+    files of a path list sorted from old to new
+    """
+    for path in paths[:-max_keep] if max_keep > 0 else paths:
+        os.remove(path)
+
+
+def load_training_state(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def get_state_checkpoints(checkpoint_dir):
+    """
+    list of training state checkpoint files in dir,
+    sorted by (epoch, step) from old to new
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, 'state-ep*-step*.pkl')):
+        match = STATE_PATTERN.search(os.path.basename(path))
+        if match:
+            checkpoints.append(((int(match.group(1)), int(match.group(2))), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def get_latest_state(checkpoint_dir):
+    """
+    path of latest training state checkpoint in dir, None if there's no one
+    """
+    checkpoints = get_state_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+class StateCheckpointer(object):
+    """
+    Save full training state for HourglassTrainer.fit(), every save_freq
+    optimizer steps and at the end of every epoch, and keep latest
+    max_keep checkpoints. On SIGTERM (like spot instance preemption),
+    the state is saved after current training step and training stops.
+
+    # Arguments
+        checkpoint_dir: dir to save training state checkpoints
+        save_freq: save every save_freq optimizer steps, 0 to only
+            save at end of epoch
+        max_keep: number of latest checkpoints to keep
+        is_writer: whether to write files, False for non-chief workers in
+            multi-worker training (which still collect the state together)
+        save_on_signal: whether to save & stop on SIGTERM
+        writer: AsyncCheckpointWriter to write the state files in
+            background, None to write them on training thread
+        extra_state: dict of other python objects to save in the state,
+            like the train data shuffle seed
+    """
+    def __init__(self, checkpoint_dir, save_freq=0, max_keep=2, is_writer=True, save_on_signal=True, writer=None, extra_state=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.save_freq = save_freq
+        self.max_keep = max(1, max_keep)
+        self.is_writer = is_writer
+        self.writer = writer
+        self.extra_state = extra_state or {}
+        self.signal_received = False
+        if is_writer:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        if save_on_signal:
+            signal.signal(signal.SIGTERM, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        print('Received signal {}, will save training state and stop'.format(signum))
+        self.signal_received = True
+
+    def should_save(self, last_step, step):
+        """
+        whether a save_freq boundary is passed from last_step to step
+        """
+        return self.save_freq > 0 and step // self.save_freq > last_step // self.save_freq
+
+    def save(self, state):
+        """
+        save training state dict (from HourglassTrainer.get_training_state())
+        and remove the old checkpoints, return checkpoint path. With a
+        writer, the file is written later in background
+        """
+        if not self.is_writer:
+            return None
+        state = dict(state, **self.extra_state)
+        path = os.path.join(self.checkpoint_dir, 'state-ep{:03d}-step{:06d}.pkl'.format(state['epoch'], state['step']))
+        if self.writer is not None:
+            # state only holds numpy arrays & python objects
+            # snapshot, so it's safe to pickle in background
+            self.writer.submit(path, lambda temp_path: self._write_state(temp_path, state), self._clean)
+        else:
+            save_training_state(path, state)
+            self._clean()
+        return path
+
+    def _write_state(self, temp_path, state):
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _clean(self):
+        remove_old_files(get_state_checkpoints(self.checkpoint_dir), self.max_keep)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Write checkpoint files on a background thread. A checkpoint is submitted
+    with a write function, which serializes a host memory snapshot to a
+    temp file on the writer thread. Then the file is fsync-ed & renamed to
+    the checkpoint path, and the retention cleanup function is called.
+    Checkpoints are written in submit order, and submit() blocks when
+    max_in_flight checkpoints are queued or being written, to bound the
+    host memory of pending snapshots.
+
+    Error in background writing is raised on next submit(), wait() or close().
+
+    # Arguments
+        max_in_flight: max number of checkpoints queued or being written
+    """
+    def __init__(self, max_in_flight=2):
+        self.slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.jobs = queue.Queue()
+        self.error = None
+        # daemon thread, so a crashed training still exits. a
+        # checkpoint interrupted by exit only leaves a temp file
+        self.thread = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            path, write_func, clean_func = job
+            temp_path = get_temp_path(path)
+            try:
+                write_func(temp_path)
+                commit_file(temp_path, path)
+                if clean_func is not None:
+                    clean_func()
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()[1]
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            finally:
+                self.slots.release()
+                self.jobs.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Checkpoint writing failed: {}'.format(error)) from error
+
+    def submit(self, path, write_func, clean_func=None):
+        """
+        queue a checkpoint write
+
+        # Arguments
+            path: checkpoint file path
+            write_func: function(temp_path) to serialize checkpoint
+                to temp_path, called on writer thread
+            clean_func: function() to apply retention policy after
+                checkpoint is written, called on writer thread
+        """
+        self._check_error()
+        if not self.thread.is_alive():
+            raise RuntimeError('Checkpoint writer is closed')
+        self.slots.acquire()
+        self.jobs.put((path, write_func, clean_func))
+
+    def wait(self):
+        """
+        block until all submitted checkpoints are written
+        """
+        self.jobs.join()
+        self._check_error()
+
+    def close(self):
+        """
+        write pending checkpoints and stop writer thread
+        """
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self._check_error()
+
+
+class AsyncModelSaver(object):
+    """
+    Save keras model (config & weights, without optimizer) to h5 through
+    AsyncCheckpointWriter. Model weights are copied to host memory on
+    calling thread, and loaded into a shadow model (rebuilt from model
+    config once, on writer thread) to save on writer thread, so training
+    could update weights meanwhile.
+
+    # Arguments
+        writer: AsyncCheckpointWriter
+        pattern: glob pattern of the saved model files for retention,
+            which sort by name from old to new. None for no cleanup
+        max_keep: number of latest model files to keep
+    """
+    def __init__(self, writer, pattern=None, max_keep=5):
+        self.writer = writer
+        self.pattern = pattern
+        self.max_keep = max_keep
+        self.source_model = None
+        self.model_config = None
+        self.shadow_model = None
+
+    def save(self, model, path):
+        """
+        snapshot model weights and queue the h5 save to path
+        """
+        if self.source_model is not model:
+            # shadow model is only used on writer thread,
+            # so wait pending saves before dropping it
+            self.writer.wait()
+            self.source_model = model
+            self.model_config = (model.__class__, model.get_config())
+            self.shadow_model = None
+
+        weights = model.get_weights()
+        self.writer.submit(path, lambda temp_path: self._write(temp_path, weights), self._clean if self.pattern else None)
+
+    def _write(self, temp_path, weights):
+        if self.shadow_model is None:
+            model_class, config = self.model_config
+            self.shadow_model = model_class.from_config(config)
+        self.shadow_model.set_weights(weights)
+        self.shadow_model.save(temp_path, save_format='h5')
+
+    def _clean(self):
+        remove_old_files(sorted(glob.glob(self.pattern)), self.max_keep)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, random
+import os, io, random
+import contextlib
 import numpy as np
 from PIL import Image
-import json
 from tensorflow.keras.utils import Sequence
 
-from common.data_utils import random_horizontal_flip, random_vertical_flip, random_brightness, random_grayscale, random_chroma, random_contrast, random_sharpness, random_blur, random_histeq, random_rotate_angle, crop_single_object, rotate_single_object, crop_image, normalize_image, transform_keypoints, generate_gt_heatmap
+from common.data_utils import rand, random_horizontal_flip, random_vertical_flip, horizontal_flip_keypoints, vertical_flip_keypoints, random_brightness, random_grayscale, random_chroma, random_contrast, random_sharpness, random_blur, random_histeq, random_photometric, random_rotate_angle, crop_single_object, rotate_single_object, crop_image, crop_image_affine, normalize_image, get_transform, transform_keypoints, render_gt_heatmaps, MPII_SCALE_REFERENCE
+from common.shard_utils import ShardReader
+from common.annotation_store import AnnotationStore, AnnotationList
+from common.image_cache import get_cache_key
+from common.prefetcher import BytePrefetcher
+from hourglass.sampler import ImageAffinitySampler
+from hourglass.batch_ring import BatchSlotRing
+from hourglass.profiler import NULL_TIMER
 
 # by default, Stacked Hourglass model use output_stride = 4, which means:
 #
@@ -16,6 +23,23 @@ from common.data_utils import random_horizontal_flip, random_vertical_flip, rand
 HG_OUTPUT_STRIDE = 4
 
 
+@contextlib.contextmanager
+def seeded_random(seed):
+    """
+    run with python & numpy global random generators seeded, and
+    restore their states after. So a shuffle could be reproduced on
+    other processes without changing their random sequences
+    """
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+
+
 class hourglass_dataset(Sequence):
     def __init__(self, dataset_path,
                        batch_size,
@@ -24,33 +48,115 @@ class hourglass_dataset(Sequence):
                        num_hgstack=2,
                        is_train=True,
                        with_meta=False,
-                       matchpoints=None):
+                       matchpoints=None,
+                       fused_transform=True,
+                       fused_photometric=True,
+                       reduced_decode=True,
+                       image_cache=None,
+                       image_affinity=None,
+                       shard_local_shuffle=True,
+                       num_batch_slots=1,
+                       single_target=False,
+                       keypoint_target=False,
+                       read_ahead=0,
+                       local_cache=None,
+                       profiler=None,
+                       num_data_shards=1,
+                       data_shard_index=0,
+                       shuffle_seed=0,
+                       deterministic=False):
         self.json_file = os.path.join(dataset_path, 'annotations.json')
         self.image_path = os.path.join(dataset_path, 'images')
+        # read images from packed shards if dataset is packed
+        # with tools/dataset_converter/dataset_packer.py
+        self.shard_reader = ShardReader(dataset_path) if ShardReader.exists(dataset_path) else None
+        # whether to shuffle packed dataset shard-locally (shard order, then
+        # records inside each shard), so shard files are read one by one.
+        # batches then only mix samples of one or two shards, False to
+        # shuffle globally over all shards with random file access
+        self.shard_local_shuffle = shard_local_shuffle and self.shard_reader is not None
         self.batch_size = batch_size
         self.class_names = class_names
         self.num_classes = len(class_names)
         self.input_shape = input_shape
         self.num_hgstack = num_hgstack
+        # whether to output one gt heatmap batch as target for all the
+        # hg stacks, instead of a num_hgstack list. keras loss will
+        # apply the single target to every model output
+        self.single_target = single_target
+        # whether to output transformed keypoints (batch_size, num_classes, 3)
+        # as target instead of gt heatmaps, which will be rendered on device
+        # by the loss from hourglass.loss.get_keypoint_target_loss()
+        self.keypoint_target = keypoint_target
         self.is_train = is_train
         self.with_meta = with_meta
+        # whether to merge flip, crop, rotate & resize of
+        # input image into one affine warp
+        self.fused_transform = fused_transform
+        # whether to apply photometric augment with the fused
+        # lookup table/color matrix/filter version
+        self.fused_photometric = fused_photometric
+        # whether to decode JPEG image with reduced resolution
+        # (DCT domain downscale) for object which will be
+        # downscaled a lot in crop. need fused_transform
+        self.reduced_decode = reduced_decode and fused_transform
+        # optional common.image_cache.SharedImageCache for decoded
+        # images, shared with data loader workers
+        self.image_cache = image_cache
+        # read image file bytes of next read_ahead batches with a
+        # thread pool, and optionally keep them in a local disk cache
+        # (common.prefetcher.LocalFileCache), for dataset on remote storage
+        self.read_ahead = read_ahead
+        if read_ahead > 0 or local_cache is not None:
+            self.prefetcher = BytePrefetcher(self.read_image_file, max_items=2*max(1, read_ahead)*batch_size, local_cache=local_cache, key_func=self.get_file_key)
+        else:
+            self.prefetcher = None
+        # optional hourglass.profiler.LoaderProfiler to
+        # record stage time of sample processing
+        self.profiler = profiler
         # output heatmap size should be 1/HG_OUTPUT_STRIDE of input size
         self.output_shape = (self.input_shape[0]//HG_OUTPUT_STRIDE, self.input_shape[1]//HG_OUTPUT_STRIDE)
         self.dataset_name = None
+        # data parallel training on num_data_shards workers: every worker
+        # shuffle the whole train set in same order (seeded with
+        # shuffle_seed & epoch), and take its disjoint shard of it
+        self.num_data_shards = num_data_shards
+        self.data_shard_index = data_shard_index
+        self.shuffle_seed = shuffle_seed
+        # whether to also seed augment of every batch with shuffle_seed,
+        # epoch & batch index, so data at any (epoch, batch) position
+        # could be reproduced to resume training exactly
+        self.deterministic = deterministic
+        self.epoch = 0
         self.train_annotations, self.val_annotations = self._load_image_annotation()
+        self.origin_train_indexes = self.train_annotations.indexes.copy()
         if self.is_train:
-            self.annotations = self.train_annotations
+            self.annotations = self.get_data_shard(self.train_annotations)
         else:
             self.annotations = self.val_annotations
 
         self.horizontal_matchpoints, self.vertical_matchpoints = self._get_matchpoint_list(matchpoints)
 
-        # Preallocate memory for batch input/output data
-        # input images:    batch_size * input_shape  * channel (3)
-        # output heatmaps: batch_size * output_shape * num_classes
-        self.batch_images = np.zeros(shape=(self.batch_size, self.input_shape[0], self.input_shape[1], 3), dtype=np.float32)
-        self.batch_heatmaps = np.zeros(shape=(self.batch_size, self.output_shape[0], self.output_shape[1], self.num_classes), dtype=np.float32)
-        self.batch_metainfo = list()
+        # shuffle with image affinity (locality 0~1) to put people on same
+        # image into one batch and decode it once, None for random shuffle
+        if image_affinity is not None:
+            self.sampler = ImageAffinitySampler(self.batch_size, locality=image_affinity, max_group_size=self.batch_size,
+                                                shard_reader=self.shard_reader if self.shard_local_shuffle else None)
+        else:
+            self.sampler = None
+
+        # Preallocate memory for batch input/output data, as a ring of
+        # batch slots. batch returned by __getitem__ stays valid until
+        # num_batch_slots more batches are produced, and consumer could
+        # also hold it explicitly with acquire_batch()/release_batch()
+        self.batch_ring = BatchSlotRing(num_batch_slots, self.batch_size, self.input_shape, self.output_shape, self.num_classes)
+
+        # shuffle for first epoch too, like the other epochs
+        if self.is_train:
+            if self.deterministic or self.num_data_shards > 1:
+                self.set_epoch(0)
+            else:
+                self.shuffle(self.annotations)
 
     def _get_matchpoint_list(self, matchpoints):
         horizontal_matchpoints, vertical_matchpoints = [], []
@@ -88,25 +194,68 @@ class hourglass_dataset(Sequence):
         #  'people_index': 1.0,
         #  'numOtherPeople': 1.0,
         #  'headboxes': [[0.0, 0.0], [0.0, 0.0]]}
-        with open(self.json_file) as anno_file:
-            annotations = json.load(anno_file)
+        #
+        # annotations are loaded into a columnar store (cached as .npz),
+        # and train/val annotation lists are views of it, with record
+        # items as read-only dict of above format (without other people
+        # info, which is not used in training)
+        store = AnnotationStore.load(self.json_file)
+        self.dataset_name = store.dataset_name
 
-        val_annotation, train_annotation = [], []
         # put to train or val annotation list
-        for idx, val in enumerate(annotations):
-            # record dataset name
-            if self.dataset_name is None:
-                self.dataset_name = val['dataset']
-
-            if val['isValidation'] == True:
-                val_annotation.append(annotations[idx])
-            else:
-                train_annotation.append(annotations[idx])
+        is_validation = store.columns['isValidation'] == True
+        val_annotation = AnnotationList(store, np.nonzero(is_validation)[0])
+        train_annotation = AnnotationList(store, np.nonzero(~is_validation)[0])
         return train_annotation, val_annotation
 
+    def profile(self, stage):
+        """
+        context manager to record time of a processing stage
+        """
+        if self.profiler is None:
+            return NULL_TIMER
+        return self.profiler.stage(stage)
+
     def get_dataset_name(self):
         return str(self.dataset_name)
 
+    def get_data_shard(self, annotations):
+        """
+        contiguous shard of annotations for current worker. shards have
+        same size (remainder dropped), so all workers run same steps
+        """
+        if self.num_data_shards <= 1:
+            return annotations
+        shard_size = len(annotations) // self.num_data_shards
+        start = self.data_shard_index * shard_size
+        return AnnotationList(annotations.store, annotations.indexes[start:start+shard_size].copy())
+
+    def get_seed(self, *keys):
+        """
+        32 bit random seed derived from shuffle_seed & int keys
+        """
+        return int(np.random.SeedSequence([self.shuffle_seed] + list(keys)).generate_state(1)[0])
+
+    def get_batch_seed(self, i):
+        """
+        augment seed of batch i in current epoch, None if not deterministic
+        """
+        if not self.deterministic:
+            return None
+        return self.get_seed(self.epoch, self.data_shard_index, i)
+
+    def set_epoch(self, epoch):
+        """
+        reproduce train annotation order of an epoch, for deterministic or
+        sharded dataset: origin order shuffled with seed of the epoch,
+        then take data shard of the worker
+        """
+        self.epoch = epoch
+        self.train_annotations.indexes = self.origin_train_indexes.copy()
+        with seeded_random(self.get_seed(epoch)):
+            self.shuffle(self.train_annotations)
+        self.annotations = self.get_data_shard(self.train_annotations)
+
     def get_dataset_size(self):
         return len(self.annotations)
 
@@ -127,87 +276,291 @@ class hourglass_dataset(Sequence):
         return len(self.annotations) // self.batch_size
 
     def __getitem__(self, i):
-
-        self.batch_metainfo = []
-        for n, annotation in enumerate(self.annotations[i*self.batch_size:(i+1)*self.batch_size]):
-            sample_index = i*self.batch_size + n
-            # generate input image and ground truth heatmap
-            image, gt_heatmap, meta = self.process_image(sample_index, annotation)
+        if self.read_ahead > 0:
+            self.prefetch_batches(i, self.read_ahead + 1)
+        batch_annotations = self.annotations[i*self.batch_size:(i+1)*self.batch_size]
+        return self.get_batch(batch_annotations, i*self.batch_size, seed=self.get_batch_seed(i))
+
+    def prefetch_batches(self, i, num_batches):
+        """
+        start reading image files of batch i ~ (i+num_batches-1)
+        in current order, with the byte prefetcher
+        """
+        end = min(i + num_batches, len(self)) * self.batch_size
+        self.prefetcher.schedule([annotation['img_paths'] for annotation in self.annotations[i*self.batch_size:end]])
+
+    def get_prefetched(self, batch_annotations):
+        """
+        get dict of path -> bytes for already fetched image files of
+        the batch, to be sent to data loader worker with the batch
+        """
+        return self.prefetcher.get_ready([annotation['img_paths'] for annotation in batch_annotations])
+
+    def acquire_batch(self, i, timeout=None):
+        """
+        form up batch i in a batch slot which is held until
+        release_batch(), return (slot, batch). Consumer could hold
+        up to num_batch_slots batches in flight without copy
+        """
+        if self.read_ahead > 0:
+            self.prefetch_batches(i, self.read_ahead + 1)
+        slot = self.batch_ring.acquire(timeout)
+        batch_annotations = self.annotations[i*self.batch_size:(i+1)*self.batch_size]
+        return slot, self.get_batch(batch_annotations, i*self.batch_size, slot, seed=self.get_batch_seed(i))
+
+    def release_batch(self, slot):
+        self.batch_ring.release(slot)
+
+    def get_batch(self, batch_annotations, index_offset=0, slot=None, seed=None):
+        """
+        form up one batch of input images & gt heatmaps (& metainfo)
+        from a list of annotation records. used by __getitem__ and also
+        by the worker processes of hourglass.loader.ParallelDataLoader
+
+        # Arguments
+            batch_annotations: list of annotation dicts for the batch
+            index_offset: sample index of the first record, which will
+                be recorded in metainfo as 'sample_index'
+            slot: acquired BatchSlot to form up the batch in. None to use
+                next slot of the ring, which is released at once
+            seed: random seed for augment of the batch, like the one from
+                get_batch_seed(). None to use global random state
+        """
+        if seed is not None:
+            with seeded_random(seed):
+                return self.get_batch(batch_annotations, index_offset, slot)
+
+        if slot is None:
+            slot = self.batch_ring.acquire()
+            self.batch_ring.release(slot)
+
+        slot.metainfo = []
+        # transformed keypoints of the batch, for rendering gt heatmaps
+        # together. bypassed sample will keep 0 visibility (empty heatmap)
+        batch_keypoints = slot.keypoints
+        batch_keypoints[...] = 0
+        # decoded images of the batch, so people on same
+        # image only need one decode
+        decoded_images = dict()
+        for n, annotation in enumerate(batch_annotations):
+            sample_index = index_offset + n
+            if self.profiler:
+                self.profiler.begin_sample(annotation['img_paths'])
+            # generate input image and transformed keypoints, image
+            # is normalized into the batch slot in place
+            image, _, meta = self.process_image(sample_index, annotation, with_heatmap=False, decoded_images=decoded_images, out=slot.images[n])
+            if self.profiler:
+                self.profiler.end_sample()
 
             # in case we got an empty image, bypass the sample
             if image is None:
                 continue
 
             # form up batch data
-            self.batch_images[n, :, :, :] = image
-            self.batch_heatmaps[n, :, :, :] = gt_heatmap
-            self.batch_metainfo.append(meta)
+            batch_keypoints[n] = meta['tpts']
+            slot.metainfo.append(meta)
+
+        if self.keypoint_target:
+            # heatmap will be rendered with keypoints in loss
+            batch_target = batch_keypoints
+        else:
+            # generate ground truth keypoint heatmap for whole batch
+            with self.profile('heatmap'):
+                batch_target = render_gt_heatmaps(batch_keypoints, slot.heatmaps)
+        if self.profiler:
+            self.profiler.end_batch()
 
         # need to feed each hg unit the same gt heatmap,
         # so append a num_hgstack list
-        out_heatmaps = []
-        for m in range(self.num_hgstack):
-            out_heatmaps.append(self.batch_heatmaps)
+        if self.single_target:
+            out_heatmaps = batch_target
+        else:
+            out_heatmaps = []
+            for m in range(self.num_hgstack):
+                out_heatmaps.append(batch_target)
 
         if self.with_meta:
-            return self.batch_images, out_heatmaps, self.batch_metainfo
+            return slot.images, out_heatmaps, slot.metainfo
         else:
-            return self.batch_images, out_heatmaps
-
-
-    def process_image(self, sample_index, annotation):
+            return slot.images, out_heatmaps
+
+
+    def process_image(self, sample_index, annotation, with_heatmap=True, decoded_images=None, out=None):
+        image, origin_shape = self.load_image(annotation, decoded_images)
+        return self.process_image_data(sample_index, annotation, image, with_heatmap, origin_shape, out)
+
+    def load_image(self, annotation, decoded_images=None):
+        """
+        decode RGB image array of an annotation record, or get it from
+        decoded_images dict (images decoded for the batch) or shared image
+        cache. origin_shape is the full image shape if it's decoded with
+        reduced resolution, otherwise None
+        """
+        decode_ratio = self.get_decode_ratio(annotation)
+        image_key = (annotation['img_paths'], decode_ratio)
+        if decoded_images is not None and image_key in decoded_images:
+            return decoded_images[image_key]
+
+        image, origin_shape = self.decode_image(annotation, decode_ratio)
+        if decoded_images is not None:
+            decoded_images[image_key] = (image, origin_shape)
+        return image, origin_shape
+
+    def decode_image(self, annotation, decode_ratio=1):
+        if self.image_cache is not None:
+            cache_key = get_cache_key(annotation['img_paths'], decode_ratio)
+            cached = self.image_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        with self.profile('read'):
+            if self.prefetcher:
+                image_file = io.BytesIO(self.prefetcher.get(annotation['img_paths']))
+            elif self.shard_reader:
+                image_file = self.shard_reader.open(annotation['img_paths'])
+            elif self.profiler:
+                # read file content first to profile it separately
+                image_file = io.BytesIO(self.read_image_file(annotation['img_paths']))
+            else:
+                image_file = os.path.join(self.image_path, annotation['img_paths'])
+
+        with self.profile('decode'):
+            img = Image.open(image_file)
+            origin_shape = (img.size[1], img.size[0], 3)
+
+            if decode_ratio > 1:
+                # DCT domain downscale in decoding, only work for JPEG
+                img.draft('RGB', (img.size[0] // decode_ratio, img.size[1] // decode_ratio))
+
+            # make sure image is in RGB mode with 3 channels
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            image = np.array(img)
+            img.close()
+
+        if image.shape[0:2] == origin_shape[0:2]:
+            origin_shape = None
+        if self.image_cache is not None:
+            self.image_cache.put(cache_key, image, origin_shape)
+        return image, origin_shape
+
+    def read_image_file(self, img_path):
+        """
+        read image file content as bytes, for byte prefetcher
+        """
+        if self.shard_reader:
+            return self.shard_reader.read(img_path).tobytes()
+        with open(os.path.join(self.image_path, img_path), 'rb') as image_file:
+            return image_file.read()
+
+    def get_file_key(self, img_path):
+        """
+        local file cache key of an image file: absolute source path (or
+        shard file & offset for packed dataset) with file size & mtime, so
+        datasets sharing a local cache don't get each other's files, and
+        a changed source file is fetched again
+        """
+        if self.shard_reader:
+            shard_index, offset, length = self.shard_reader.images[img_path]
+            file_path = os.path.join(self.shard_reader.shard_path, self.shard_reader.shards[shard_index])
+            location = '{}@{}+{}'.format(os.path.abspath(file_path), offset, length)
+        else:
+            file_path = os.path.join(self.image_path, img_path)
+            location = os.path.abspath(file_path)
+        file_stat = os.stat(file_path)
+        return '{}:{}:{}'.format(location, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def get_decode_ratio(self, annotation):
+        """
+        get downscale ratio (1, 2, 4 or 8) for reduced resolution decoding
+        of an annotation record, from object scale & model input size. The
+        decoded object is kept larger than model input even with the
+        smallest random scale augment, so the crop still downscale it
+        """
+        if not self.reduced_decode:
+            return 1
+
+        _, scale = self.get_center_scale(annotation)
+        if self.is_train:
+            # smallest random scale in augment
+            scale = scale * 0.8
+        scale_factor = scale * MPII_SCALE_REFERENCE / self.input_shape[0]
+
+        decode_ratio = 1
+        while decode_ratio < 8 and decode_ratio * 2 <= scale_factor:
+            decode_ratio *= 2
+        return decode_ratio
+
+    def process_image_data(self, sample_index, annotation, image, with_heatmap=True, origin_shape=None, out=None):
+        """
+        augment & crop decoded RGB image array of an annotation record,
+        and generate gt heatmap & metainfo for it. Split from process_image()
+        so that other input pipeline (like hourglass.tfdata) could feed
+        its own decoded image. with_heatmap=False skip gt heatmap generation
+        (return None), for caller which render heatmap of whole batch.
+        origin_shape is needed if image is decoded with reduced resolution,
+        keypoints, center & metainfo are always on origin image reference.
+        out is an optional float32 buffer to write normalized image in place
+        """
         imagefile = os.path.join(self.image_path, annotation['img_paths'])
-        img = Image.open(imagefile)
-        # make sure image is in RGB mode with 3 channels
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        image = np.array(img)
-        img.close()
 
         # record origin image shape, will store
         # in metainfo
-        image_shape = image.shape
+        image_shape = image.shape if origin_shape is None else tuple(origin_shape)
 
         # get center, keypoints and scale
         # center, keypoints point format: (x, y)
-        center = np.array(annotation['objpos'])
+        center, scale = self.get_center_scale(annotation)
         keypoints = np.array(annotation['joint_self'])
-        scale = annotation['scale_provided']
-
-        # adjust center/scale slightly to avoid cropping limbs
-        if center[0] != -1:
-            center[1] = center[1] + 15 * scale
-            scale = scale * 1.25
 
         rotate_angle = 0
+        h_flip, v_flip = False, False
         # real-time data augmentation for training process
         if self.is_train:
-            # random horizontal filp
-            image, keypoints, center = random_horizontal_flip(image, keypoints, center, matchpoints=self.horizontal_matchpoints, prob=0.5)
+            with self.profile('geometric'):
+                if self.fused_transform:
+                    # only flip keypoints & center here, image flip
+                    # will be merged into the crop affine transform
+                    h_flip = rand() < 0.5
+                    if h_flip:
+                        keypoints, center = horizontal_flip_keypoints(keypoints, center, image_shape[1], matchpoints=self.horizontal_matchpoints)
+
+                    v_flip = rand() < 0.5
+                    if v_flip:
+                        keypoints, center = vertical_flip_keypoints(keypoints, center, image_shape[0], matchpoints=self.vertical_matchpoints)
+                else:
+                    # random horizontal filp
+                    image, keypoints, center = random_horizontal_flip(image, keypoints, center, matchpoints=self.horizontal_matchpoints, prob=0.5)
 
-            # random vertical filp
-            image, keypoints, center = random_vertical_flip(image, keypoints, center, matchpoints=self.vertical_matchpoints, prob=0.5)
+                    # random vertical filp
+                    image, keypoints, center = random_vertical_flip(image, keypoints, center, matchpoints=self.vertical_matchpoints, prob=0.5)
 
-            # random adjust brightness
-            image = random_brightness(image)
+            with self.profile('photometric'):
+                if self.fused_photometric:
+                    # random brightness, color level, contrast, sharpness,
+                    # grayscale, gaussian blur & histogram equalization
+                    image = random_photometric(image)
+                else:
+                    # random adjust brightness
+                    image = random_brightness(image)
 
-            # random adjust color level
-            image = random_chroma(image)
+                    # random adjust color level
+                    image = random_chroma(image)
 
-            # random adjust contrast
-            image = random_contrast(image)
+                    # random adjust contrast
+                    image = random_contrast(image)
 
-            # random adjust sharpness
-            image = random_sharpness(image)
+                    # random adjust sharpness
+                    image = random_sharpness(image)
 
-            # random convert image to grayscale
-            image = random_grayscale(image)
+                    # random convert image to grayscale
+                    image = random_grayscale(image)
 
-            # random do gaussian blur to image
-            image = random_blur(image)
+                    # random do gaussian blur to image
+                    image = random_blur(image)
 
-            # random do histogram equalization using CLAHE
-            image = random_histeq(image)
+                    # random do histogram equalization using CLAHE
+                    image = random_histeq(image)
 
             # random adjust scale
             scale = scale * np.random.uniform(0.8, 1.2)
@@ -226,10 +579,15 @@ class hourglass_dataset(Sequence):
         ###############################
         # Option 1 (from origin repo):
         # crop out single object area, resize to input size and normalize image
-        image = crop_image(image, center, scale, self.input_shape, rotate_angle)
+        with self.profile('geometric'):
+            if self.fused_transform:
+                # flip, crop, rotate & resize with one affine warp
+                image = crop_image_affine(image, center, scale, self.input_shape, rotate_angle, h_flip, v_flip, origin_shape=origin_shape)
+            else:
+                image = crop_image(image, center, scale, self.input_shape, rotate_angle)
 
-        # transform keypoints to cropped image reference
-        transformed_keypoints = transform_keypoints(keypoints, center, scale, self.output_shape, rotate_angle)
+            # transform keypoints to cropped image reference
+            transformed_keypoints = transform_keypoints(keypoints, center, scale, self.output_shape, rotate_angle)
         ###############################
 
 
@@ -253,10 +611,15 @@ class hourglass_dataset(Sequence):
             return None, None, None
 
         # normalize image
-        image = normalize_image(image, self.get_color_mean())
+        with self.profile('normalize'):
+            image = normalize_image(image, self.get_color_mean(), out)
 
         # generate ground truth keypoint heatmap
-        gt_heatmap = generate_gt_heatmap(transformed_keypoints, self.output_shape)
+        gt_heatmap = None
+        if with_heatmap:
+            with self.profile('heatmap'):
+                gt_heatmap = np.zeros(shape=(1, self.output_shape[0], self.output_shape[1], self.num_classes), dtype=np.float32)
+                gt_heatmap = render_gt_heatmaps(transformed_keypoints[np.newaxis], gt_heatmap)[0]
 
         # meta info
         metainfo = {'sample_index': sample_index, 'center': center, 'scale': scale, 'image_shape': image_shape,
@@ -264,11 +627,70 @@ class hourglass_dataset(Sequence):
 
         return image, gt_heatmap, metainfo
 
+    def get_center_scale(self, annotation):
+        """
+        get object center & scale of an annotation record, with
+        the adjustment to avoid cropping limbs
+        """
+        center = np.array(annotation['objpos'])
+        scale = annotation['scale_provided']
+
+        # adjust center/scale slightly to avoid cropping limbs
+        if center[0] != -1:
+            center[1] = center[1] + 15 * scale
+            scale = scale * 1.25
+
+        return center, scale
+
+    def crop_object(self, annotation, image, crop_margin=1.0, origin_shape=None):
+        """
+        crop object area of an annotation record from decoded RGB image
+        array without any augment, but with crop_margin times the model
+        input size, so that random scale/rotate could be applied later on
+        the cropped image (like batch level augment in hourglass.tfdata)
+
+        return uint8 cropped image with shape (input_shape*crop_margin, 3),
+        and keypoints in the margined heatmap reference, before the integer
+        rounding of transform_keypoints(). invalid keypoints get visibility 0.
+        origin_shape is needed if image is decoded with reduced resolution
+        """
+        center, scale = self.get_center_scale(annotation)
+        keypoints = np.array(annotation['joint_self'], dtype=np.float64)
+
+        # keep heatmap size as integer and input size
+        # as HG_OUTPUT_STRIDE times of it
+        crop_output_shape = (int(self.output_shape[0] * crop_margin), int(self.output_shape[1] * crop_margin))
+        crop_input_shape = (crop_output_shape[0] * HG_OUTPUT_STRIDE, crop_output_shape[1] * HG_OUTPUT_STRIDE)
+        crop_scale = scale * crop_output_shape[0] / self.output_shape[0]
+
+        image = crop_image_affine(image, center, crop_scale, crop_input_shape, origin_shape=origin_shape)
+
+        t = get_transform(center, crop_scale, crop_output_shape)
+        valid = (keypoints[:, 0] > 0) & (keypoints[:, 1] > 0)
+        crop_keypoints = np.zeros_like(keypoints)
+        crop_keypoints[:, 0] = t[0, 0] * keypoints[:, 0] + t[0, 1] * keypoints[:, 1] + t[0, 2]
+        crop_keypoints[:, 1] = t[1, 0] * keypoints[:, 0] + t[1, 1] * keypoints[:, 1] + t[1, 2]
+        crop_keypoints[:, 2] = np.where(valid, keypoints[:, 2], 0)
+
+        return image, crop_keypoints
+
     def get_keypoint_classes(self):
         return self.class_names
 
+    def shuffle(self, annotations):
+        if self.sampler:
+            self.sampler.shuffle(annotations)
+        elif self.shard_local_shuffle:
+            self.shard_reader.shuffle(annotations)
+        else:
+            random.shuffle(annotations)
+
     def on_epoch_end(self):
         if self.is_train:
             # Shuffle dataset for next epoch
-            random.shuffle(self.annotations)
+            if self.deterministic or self.num_data_shards > 1:
+                self.set_epoch(self.epoch + 1)
+            else:
+                self.epoch += 1
+                self.shuffle(self.annotations)
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Multi-process batch loader for hourglass_dataset."""
+import random
+import pickle
+import signal
+import traceback
+import multiprocessing
+import numpy as np
+
+from hourglass.profiler import LoaderProfiler
+
+
+def _worker_loop(dataset, task_queue, result_queue, seed):
+    """
+    worker process main loop: fetch (batch_index, batch_annotations, index_offset,
+    image_bytes, batch_seed) task from task queue, form up the batch with worker-owned
+    dataset copy (so batch buffers are private to the worker) and put it to result
+    queue. image_bytes is the image files of the batch already read by byte prefetcher
+    on main process, or None. batch_seed is the augment seed of deterministic dataset,
+    or None to use worker random state
+    """
+    # forked worker may inherit SIGTERM handler of training process
+    # (like hourglass.checkpoint.StateCheckpointer), but it should
+    # just exit when terminated by stop()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # every worker owns its random state, otherwise forked
+    # workers will produce exactly the same augmentation
+    np.random.seed(seed)
+    random.seed(seed)
+    # worker profiles on its own, and send records back with batch
+    if dataset.profiler is not None:
+        dataset.profiler = LoaderProfiler(dataset.profiler.num_slowest)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_index, batch_annotations, index_offset, image_bytes, batch_seed = task
+        try:
+            if image_bytes:
+                dataset.prefetcher.update(image_bytes)
+            # queue pickles object later in its feeder thread, so hold
+            # the batch slot until the batch is serialized here
+            slot = dataset.batch_ring.acquire()
+            try:
+                batch = dataset.get_batch(batch_annotations, index_offset, slot, seed=batch_seed)
+                batch = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+            finally:
+                dataset.release_batch(slot)
+            profile = dataset.profiler.pop_records() if dataset.profiler is not None else None
+            result_queue.put((batch_index, batch, None, profile))
+        except Exception:
+            result_queue.put((batch_index, None, traceback.format_exc(), None))
+
+
+class ParallelDataLoader(object):
+    """
+    Spread batch production of a hourglass_dataset over a pool of worker
+    processes. Completed batches are returned in order, with at most
+    max_queue_size batches in flight (bounded prefetch). Dataset is
+    shuffled with its own on_epoch_end() when a new epoch is enqueued,
+    so per-epoch shuffle and is_train/with_meta behavior are the same
+    as the single process Sequence.
+
+    Loader could be used as a python generator for model.fit_generator(),
+    which will loop over the dataset endlessly:
+
+        train_loader = ParallelDataLoader(train_generator, workers=8)
+        model.fit_generator(generator=train_loader, steps_per_epoch=len(train_loader), ...)
+
+    # Arguments
+        dataset: hourglass_dataset object
+        workers: number of worker processes
+        max_queue_size: max number of batches in flight
+        seed: base random seed for workers, worker i will use (seed + i).
+            None for a random one
+        start_method: multiprocessing start method ('fork'/'spawn'/'forkserver'),
+            None for platform default
+    """
+    def __init__(self, dataset, workers=4, max_queue_size=10, seed=None, start_method=None):
+        self.dataset = dataset
+        self.workers = max(1, workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.seed = seed if seed is not None else np.random.randint(0, 2**31 - self.workers)
+        self.context = multiprocessing.get_context(start_method)
+
+        self.processes = []
+        self.task_queue = None
+        self.result_queue = None
+
+        # enqueue cursor (epoch & batch index) and
+        # next batch index to return to consumer
+        self.enqueue_epoch = 0
+        self.enqueue_index = 0
+        self.send_index = 0
+        self.receive_index = 0
+        self.reorder_buffer = dict()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.processes:
+            self.start()
+
+        # keep max_queue_size batches in flight
+        while self.send_index - self.receive_index < self.max_queue_size:
+            self._put_task()
+
+        while self.receive_index not in self.reorder_buffer:
+            batch_index, batch, error, profile = self.result_queue.get()
+            if error is not None:
+                self.stop()
+                raise RuntimeError('data loader worker failed:\n' + error)
+            if profile is not None:
+                self.dataset.profiler.merge(profile)
+            self.reorder_buffer[batch_index] = batch
+
+        batch = pickle.loads(self.reorder_buffer.pop(self.receive_index))
+        self.receive_index += 1
+        return batch
+
+    def _put_task(self):
+        num_batches = len(self.dataset)
+        if self.enqueue_index >= num_batches:
+            # new epoch, shuffle dataset on main process
+            # before dispatching its annotations
+            self.dataset.on_epoch_end()
+            self.enqueue_epoch += 1
+            self.enqueue_index = 0
+
+        batch_size = self.dataset.batch_size
+        index_offset = self.enqueue_index * batch_size
+        batch_annotations = self.dataset.get_annotations()[index_offset:index_offset+batch_size]
+
+        image_bytes = None
+        if self.dataset.read_ahead > 0:
+            # read image files of next batches ahead, and send the
+            # fetched ones of this batch to worker, so worker never
+            # wait for remote storage once prefetcher is warm
+            self.dataset.prefetch_batches(self.enqueue_index, self.dataset.read_ahead + 1)
+            image_bytes = self.dataset.get_prefetched(batch_annotations)
+
+        self.task_queue.put((self.send_index, batch_annotations, index_offset, image_bytes, self.dataset.get_batch_seed(self.enqueue_index)))
+        self.enqueue_index += 1
+        self.send_index += 1
+
+    def seek(self, num_batches):
+        """
+        move to the position after num_batches batches from start of
+        epoch 0, to resume training. dataset should be deterministic,
+        and loader should not be started yet
+        """
+        if self.processes:
+            raise RuntimeError('could not seek a running data loader')
+        epoch, index = divmod(num_batches, len(self.dataset))
+        self.dataset.set_epoch(epoch)
+        self.enqueue_epoch = epoch
+        self.enqueue_index = index
+
+    def start(self):
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+
+        for i in range(self.workers):
+            process = self.context.Process(target=_worker_loop,
+                                           args=(self.dataset, self.task_queue, self.result_queue, self.seed + i),
+                                           daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def stop(self):
+        if not self.processes:
+            return
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.task_queue.close()
+        self.result_queue.close()
+
+    def __del__(self):
+        try:
+            self.stop()
+        except Exception:
+            pass
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from tensorflow.keras.losses import mean_squared_error, mean_absolute_error#, huber
 import tensorflow.keras.backend as K
+from common.tf_augment import render_gt_heatmaps_tensor
 
 
 def euclidean_loss(y_true, y_pred):
@@ -62,3 +63,27 @@ def get_loss(loss_type):
         raise ValueError('Unsupported loss type', loss_type)
 
     return loss
+
+
+def get_keypoint_target_loss(loss_func, heatmap_shape, sigma=1):
+    """
+    wrap a heatmap loss function to take transformed keypoints as
+    y_true, with shape (batch_size, num_keypoints, 3). gt heatmaps are
+    rendered on device from the keypoints before the loss, same as
+    render_gt_heatmaps() in data loader
+
+    # Arguments
+        loss_func: heatmap loss function, like the ones from get_loss()
+        heatmap_shape: model output heatmap shape as (height, width)
+        sigma: variance of the 2D gaussian heatmap distribution
+
+    # Returns
+        loss: wrapped loss function
+    """
+    def keypoint_target_loss(y_true, y_pred):
+        y_true = render_gt_heatmaps_tensor(y_true, heatmap_shape, sigma)
+        return loss_func(y_true, y_pred)
+
+    # keep origin loss name for metrics & logs
+    keypoint_target_loss.__name__ = loss_func.__name__
+    return keypoint_target_loss
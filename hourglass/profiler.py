@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage level profiler for hourglass_dataset sample processing. Time of
+each stage is summed per sample, so the stage histograms and the slowest
+samples (by image path) show where the input pipeline spends its time.
+
+    read:        read image file content (from disk, shard or prefetcher)
+    decode:      decode image file to RGB array
+    geometric:   flip, random scale/rotate, crop & resize to model input
+    photometric: random color/contrast/blur augment
+    normalize:   normalize image to float32 model input
+    heatmap:     render gt heatmaps (per batch for get_batch())
+"""
+import time, threading, heapq
+import numpy as np
+
+STAGES = ('read', 'decode', 'geometric', 'photometric', 'normalize', 'heatmap')
+
+
+class _StageTimer(object):
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+
+class LoaderProfiler(object):
+    """
+    Collect per-stage & per-sample processing time. Thread safe, and
+    records of a data loader worker process could be moved to the main
+    process profiler with pop_records()/merge()
+
+    # Arguments
+        num_slowest: number of slowest samples to keep
+    """
+    def __init__(self, num_slowest=10):
+        self.num_slowest = num_slowest
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage name -> list of time in seconds
+            self.stage_times = {stage: [] for stage in STAGES}
+            self.sample_times = []
+            # min heap of (time, image path)
+            self.slowest = []
+            self.num_batches = 0
+
+    def stage(self, name):
+        """
+        context manager to time a stage
+        """
+        return _StageTimer(self, name)
+
+    def begin_sample(self, img_path):
+        self.local.sample = {'path': img_path, 'start': time.perf_counter(), 'stages': {}}
+
+    def end_sample(self):
+        sample = getattr(self.local, 'sample', None)
+        if sample is None:
+            return
+        self.local.sample = None
+        sample_time = time.perf_counter() - sample['start']
+        with self.lock:
+            for stage, stage_time in sample['stages'].items():
+                self.stage_times[stage].append(stage_time)
+            self.sample_times.append(sample_time)
+            self._push_slowest(sample_time, sample['path'])
+
+    def end_batch(self):
+        with self.lock:
+            self.num_batches += 1
+
+    def record(self, stage, seconds):
+        sample = getattr(self.local, 'sample', None)
+        if sample is not None:
+            # sum up stage time of current sample
+            sample['stages'][stage] = sample['stages'].get(stage, 0.0) + seconds
+        else:
+            with self.lock:
+                self.stage_times[stage].append(seconds)
+
+    def _push_slowest(self, sample_time, img_path):
+        if len(self.slowest) < self.num_slowest:
+            heapq.heappush(self.slowest, (sample_time, img_path))
+        elif sample_time > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (sample_time, img_path))
+
+    def pop_records(self):
+        """
+        get & clear collected records, to send to another process
+        """
+        with self.lock:
+            records = {'stage_times': self.stage_times, 'sample_times': self.sample_times,
+                       'slowest': self.slowest, 'num_batches': self.num_batches}
+        self.reset()
+        return records
+
+    def merge(self, records):
+        with self.lock:
+            for stage, stage_times in records['stage_times'].items():
+                self.stage_times.setdefault(stage, []).extend(stage_times)
+            self.sample_times.extend(records['sample_times'])
+            for sample_time, img_path in records['slowest']:
+                self._push_slowest(sample_time, img_path)
+            self.num_batches += records['num_batches']
+
+    def get_stage_times(self):
+        """
+        get dict of stage name -> float64 array of time in seconds
+        """
+        with self.lock:
+            return {stage: np.array(stage_times, dtype=np.float64) for stage, stage_times in self.stage_times.items()}
+
+    def get_summary(self):
+        """
+        get dict of stage name -> time statistics in ms, with the
+        whole sample time as 'sample'
+        """
+        stage_times = self.get_stage_times()
+        with self.lock:
+            stage_times['sample'] = np.array(self.sample_times, dtype=np.float64)
+
+        summary = dict()
+        for stage, times in stage_times.items():
+            if len(times) == 0:
+                continue
+            times = times * 1000
+            summary[stage] = {'count': len(times), 'total': float(np.sum(times)), 'mean': float(np.mean(times)),
+                              'p50': float(np.percentile(times, 50)), 'p90': float(np.percentile(times, 90)),
+                              'p99': float(np.percentile(times, 99)), 'max': float(np.max(times))}
+        return summary
+
+    def get_slowest(self):
+        """
+        get list of (time in seconds, image path) of slowest samples
+        """
+        with self.lock:
+            return sorted(self.slowest, reverse=True)
+
+    def get_num_samples(self):
+        with self.lock:
+            return len(self.sample_times)
+
+    def format_report(self, elapsed=None, num_samples=None, histogram_bins=10):
+        """
+        format profile as text report, with samples/sec if elapsed
+        wall time (seconds) is provided. num_samples is the loaded
+        samples in that time, None for the profiled sample number
+        """
+        lines = []
+        if num_samples is None:
+            num_samples = self.get_num_samples()
+        if elapsed:
+            lines.append('{} samples in {:.3f}s, {:.1f} samples/sec'.format(num_samples, elapsed, num_samples / elapsed))
+
+        summary = self.get_summary()
+        lines.append('{:<12}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>8}'.format('stage(ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max', 'share'))
+        sample_total = summary['sample']['total'] if 'sample' in summary else 0
+        for stage in STAGES + ('sample',):
+            if stage not in summary:
+                continue
+            stat = summary[stage]
+            share = stat['total'] / sample_total * 100 if sample_total > 0 else 0
+            lines.append('{:<12}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>7.1f}%'.format(stage, stat['count'], stat['mean'], stat['p50'], stat['p90'], stat['p99'], stat['max'], share))
+
+        # log scale histogram of every stage
+        stage_times = self.get_stage_times()
+        for stage in STAGES:
+            times = stage_times[stage] * 1000
+            if len(times) == 0:
+                continue
+            lines.append('{} histogram (ms):'.format(stage))
+            edges = np.geomspace(max(np.min(times), 1e-3), max(np.max(times), 2e-3), histogram_bins + 1)
+            counts, _ = np.histogram(np.clip(times, edges[0], edges[-1]), bins=edges)
+            for i, count in enumerate(counts):
+                bar = '#' * int(np.ceil(count / max(1, np.max(counts)) * 40))
+                lines.append('  {:>9.3f} - {:>9.3f} {:>6} {}'.format(edges[i], edges[i+1], count, bar))
+
+        slowest = self.get_slowest()
+        if slowest:
+            lines.append('slowest samples:')
+            for sample_time, img_path in slowest:
+                lines.append('  {:>9.3f}ms {}'.format(sample_time * 1000, img_path))
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.local = threading.local()
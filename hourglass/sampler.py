@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Image affinity shuffle of annotation records for hourglass_dataset."""
+import numpy as np
+from common.annotation_store import AnnotationList
+
+
+class ImageAffinitySampler(object):
+    """
+    Shuffle annotation records per epoch, but tend to keep records of the
+    same image (people on one photo) next to each other, so that they fall
+    into the same batch and the image is only decoded once for the batch.
+
+    Each record stays with its image group with probability 'locality',
+    or is detached and shuffled alone. Image groups (and detached records)
+    are then shuffled together. So locality=0 is a plain random shuffle,
+    and locality=1 keep all records of an image contiguous.
+
+    With a ShardReader of packed dataset, the shuffle is shard-local like
+    ShardReader.shuffle(): records are still ordered shard by shard.
+
+    # Arguments
+        batch_size: batch size of the dataset, for decode saving stats
+        locality: probability to keep a record with its image group, 0~1
+        max_group_size: max records of one image kept together, larger
+            group is split into random chunks. None for no limit
+        shard_reader: ShardReader of packed dataset, or None
+    """
+    def __init__(self, batch_size, locality=0.5, max_group_size=None, shard_reader=None):
+        self.batch_size = batch_size
+        self.locality = locality
+        self.max_group_size = max_group_size
+        self.shard_reader = shard_reader
+        self.stats = None
+
+    @staticmethod
+    def _get_image_ids(annotations):
+        if isinstance(annotations, AnnotationList):
+            # interned image path index of the store
+            return annotations.store.path_index[annotations.indexes]
+        _, image_ids = np.unique([annotation['img_paths'] for annotation in annotations], return_inverse=True)
+        return image_ids
+
+    def get_order(self, image_ids, shard_ids=None):
+        """
+        get shuffled record order from image id (and
+        shard index if packed) of each record
+        """
+        num_records = len(image_ids)
+        # random order inside each image group
+        order = np.lexsort((np.random.rand(num_records), image_ids))
+        group_ids = np.asarray(image_ids, dtype=np.int64)
+
+        if self.max_group_size:
+            # split large group into chunks with rank in group
+            sorted_ids = group_ids[order]
+            group_starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+            group_sizes = np.diff(np.r_[group_starts, num_records])
+            ranks = np.arange(num_records) - np.repeat(group_starts, group_sizes)
+            chunk_ids = np.empty(num_records, dtype=np.int64)
+            chunk_ids[order] = ranks // self.max_group_size
+            group_ids = group_ids * (num_records + 1) + chunk_ids
+
+        _, group_ids = np.unique(group_ids, return_inverse=True)
+        # random sort key for each group, and own key for detached records
+        sort_keys = np.random.rand(group_ids.max() + 1 if num_records > 0 else 0)[group_ids]
+        detached = np.random.rand(num_records) >= self.locality
+        sort_keys[detached] = np.random.rand(np.count_nonzero(detached))
+
+        if shard_ids is None:
+            return np.lexsort((np.random.rand(num_records), sort_keys))
+
+        # random shard order as primary sort key
+        _, shard_ids = np.unique(shard_ids, return_inverse=True)
+        shard_keys = np.random.permutation(shard_ids.max() + 1 if num_records > 0 else 0)[shard_ids]
+        return np.lexsort((np.random.rand(num_records), sort_keys, shard_keys))
+
+    def get_decode_saving(self, image_ids):
+        """
+        count images decoded more than once in a batch, which
+        could be skipped with the records order
+        """
+        num_batches = len(image_ids) // self.batch_size
+        batch_ids = np.sort(np.reshape(image_ids[:num_batches*self.batch_size], (num_batches, self.batch_size)), axis=1)
+        unique_images = num_batches + np.count_nonzero(batch_ids[:, 1:] != batch_ids[:, :-1])
+        return num_batches * self.batch_size - unique_images
+
+    def shuffle(self, annotations):
+        """
+        shuffle annotation records (list or AnnotationList) in place
+        """
+        image_ids = self._get_image_ids(annotations)
+        shard_ids = None
+        if self.shard_reader is not None:
+            shard_ids = [self.shard_reader.get_shard_index(annotation['img_paths']) for annotation in annotations]
+        order = self.get_order(image_ids, shard_ids)
+
+        if isinstance(annotations, AnnotationList):
+            annotations.indexes[:] = annotations.indexes[order]
+        else:
+            annotations[:] = [annotations[i] for i in order]
+
+        num_samples = (len(order) // self.batch_size) * self.batch_size
+        decodes_saved = int(self.get_decode_saving(image_ids[order]))
+        self.stats = {'samples': num_samples,
+                      'decodes': num_samples - decodes_saved,
+                      'decodes_saved': decodes_saved}
+        return annotations
+
+    def get_stats(self):
+        """
+        decode stats of the last shuffled epoch
+        """
+        return self.stats
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""tf.data input pipeline for Stacked Hourglass training."""
+import os
+import numpy as np
+import tensorflow as tf
+
+from hourglass.data import HG_OUTPUT_STRIDE
+from common.tf_augment import batch_photometric_augment, batch_affine_augment, render_gt_heatmaps_tensor
+
+
+def _decode_image(image_bytes, decode_ratio=1):
+    """
+    decode image file content to RGB uint8 tensor. jpeg use accurate
+    IDCT to keep align with the PIL decoder in hourglass_dataset, and
+    could be downscaled in decoding with decode_ratio (1, 2, 4 or 8),
+    like hourglass_dataset.process_image() do with PIL draft mode.
+    return decoded image and origin image shape
+    """
+    def decode_jpeg(ratio):
+        return lambda: tf.io.decode_jpeg(image_bytes, channels=3, ratio=ratio, dct_method='INTEGER_ACCURATE')
+
+    def decode_reduced_jpeg():
+        # decode_jpeg() only accept constant ratio, so
+        # switch between the supported ones
+        branch_index = tf.cast(tf.math.log(tf.cast(decode_ratio, tf.float32)) / np.log(2) + 0.5, tf.int32)
+        image = tf.switch_case(branch_index, [decode_jpeg(1), decode_jpeg(2), decode_jpeg(4), decode_jpeg(8)])
+        return image, tf.image.extract_jpeg_shape(image_bytes)
+
+    def decode_other():
+        image = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+        return image, tf.shape(image)
+
+    return tf.cond(tf.io.is_jpeg(image_bytes), decode_reduced_jpeg, decode_other)
+
+
+def get_tf_dataset(dataset, num_shards=8, shuffle=None, repeat=None, batch_augment=False, crop_margin=1.5):
+    """
+    Build a tf.data.Dataset from a hourglass_dataset object, reading the
+    same annotations & images. Image files are read with parallel interleave
+    over num_shards sub-streams and decoded in TF, then augment, crop &
+    heatmap generation run with hourglass_dataset.process_image_data() in a
+    parallel map. Autotune is used for parallelism and prefetch buffer,
+    so input processing could overlap with training steps.
+
+    With batch_augment, the per-sample map only crop object area (with
+    crop_margin times of model input size) without augment, and random
+    augment, final crop & heatmap rendering run on the whole batch with
+    tensor ops in common.tf_augment, so it use intra-op thread pool
+    instead of the python map.
+
+    Element structure is same as hourglass_dataset batch (without metainfo):
+        (batch_images, (batch_heatmaps,) * num_hgstack)
+    or (batch_images, batch_heatmaps) if dataset.single_target. With
+    dataset.keypoint_target, batch_heatmaps is replaced by transformed
+    keypoints with shape (batch_size, num_classes, 3), and heatmaps are
+    rendered in the loss (hourglass.loss.get_keypoint_target_loss())
+
+    # Arguments
+        dataset: hourglass_dataset object, provide annotation records,
+            batch size, augment options & output shapes
+        num_shards: number of sub-streams for parallel file reading
+        shuffle: whether to shuffle samples in every epoch,
+            None to follow dataset.is_train
+        repeat: whether to repeat the dataset endlessly (use with
+            steps_per_epoch), None to follow dataset.is_train
+        batch_augment: whether to apply augment on batch tensor, only
+            used when dataset.is_train
+        crop_margin: crop area scale relative to model input for batch
+            augment, which should cover most of the random scale & rotate
+
+    # Returns
+        tf_dataset: tf.data.Dataset object
+    """
+    if shuffle is None:
+        shuffle = dataset.is_train
+    if repeat is None:
+        repeat = dataset.is_train
+
+    annotations = list(dataset.get_annotations())
+    num_samples = len(annotations)
+    num_shards = max(1, min(num_shards, num_samples))
+    image_files = tf.constant([os.path.join(dataset.image_path, annotation['img_paths']) for annotation in annotations])
+    decode_ratios = tf.constant([dataset.get_decode_ratio(annotation) for annotation in annotations], dtype=tf.int32)
+
+    input_shape = tuple(dataset.input_shape)
+    output_shape = tuple(dataset.output_shape)
+    num_classes = dataset.num_classes
+
+    batch_augment = batch_augment and dataset.is_train
+    if batch_augment:
+        # per-sample output would be margined object image & keypoints
+        crop_output_shape = (int(output_shape[0] * crop_margin), int(output_shape[1] * crop_margin))
+        sample_shapes = ((crop_output_shape[0] * HG_OUTPUT_STRIDE, crop_output_shape[1] * HG_OUTPUT_STRIDE, 3), (num_classes, 3))
+    elif dataset.keypoint_target:
+        sample_shapes = (input_shape + (3,), (num_classes, 3))
+    else:
+        sample_shapes = (input_shape + (3,), output_shape + (num_classes,))
+
+    def read_shard_image(sample_index):
+        return dataset.shard_reader.read(annotations[sample_index]['img_paths']).tobytes()
+
+    def read_image(sample_index):
+        if dataset.shard_reader:
+            # packed dataset, read file content from shard mmap
+            image_bytes = tf.numpy_function(read_shard_image, [sample_index], tf.string)
+            image_bytes.set_shape(())
+            return image_bytes
+        return tf.io.read_file(tf.gather(image_files, sample_index))
+
+    def make_shard(shard_index):
+        # shard i pick sample i, i+num_shards, i+2*num_shards, ... so
+        # a round-robin interleave keeps origin order when no shuffle
+        shard = tf.data.Dataset.range(shard_index, num_samples, num_shards)
+        if shuffle:
+            shard = shard.shuffle(num_samples // num_shards + 1, reshuffle_each_iteration=True)
+        return shard.map(lambda i: (i, read_image(i)))
+
+    def process_sample(sample_index, image, origin_shape):
+        # origin_shape is only needed for reduced resolution image
+        origin_shape = None if tuple(image.shape[0:2]) == tuple(origin_shape[0:2]) else (int(origin_shape[0]), int(origin_shape[1]), 3)
+
+        if batch_augment:
+            # only crop object area, augment will be done on batch
+            image_data, keypoints = dataset.crop_object(annotations[sample_index], image, crop_margin, origin_shape)
+            return image_data.astype(np.float32), keypoints.astype(np.float32), True
+
+        # run augment, crop & heatmap generation on numpy
+        if dataset.profiler:
+            dataset.profiler.begin_sample(annotations[sample_index]['img_paths'])
+        image_data, gt_heatmap, meta = dataset.process_image_data(int(sample_index), annotations[sample_index], image,
+                                                                  with_heatmap=not dataset.keypoint_target, origin_shape=origin_shape)
+        if dataset.profiler:
+            dataset.profiler.end_sample()
+
+        # in case we got an empty image, mark it to be filtered
+        if image_data is None:
+            return np.zeros(sample_shapes[0], dtype=np.float32), np.zeros(sample_shapes[1], dtype=np.float32), False
+        if dataset.keypoint_target:
+            # heatmap will be rendered with keypoints in loss
+            return image_data.astype(np.float32), meta['tpts'].astype(np.float32), True
+        return image_data.astype(np.float32), gt_heatmap.astype(np.float32), True
+
+    def map_sample(sample_index, image_bytes):
+        image, origin_shape = _decode_image(image_bytes, tf.gather(decode_ratios, sample_index))
+        image_data, gt_heatmap, valid = tf.numpy_function(process_sample, [sample_index, image, origin_shape], [tf.float32, tf.float32, tf.bool])
+        image_data.set_shape(sample_shapes[0])
+        gt_heatmap.set_shape(sample_shapes[1])
+        return image_data, gt_heatmap, valid
+
+    color_mean = tf.constant(dataset.get_color_mean(), dtype=tf.float32)
+
+    def augment_batch(batch_images, batch_keypoints):
+        batch_images = batch_photometric_augment(batch_images)
+        batch_images, batch_keypoints = batch_affine_augment(batch_images, batch_keypoints, input_shape, output_shape,
+                                                             dataset.horizontal_matchpoints, dataset.vertical_matchpoints)
+        # same as normalize_image()
+        batch_images = batch_images / 255.0 - color_mean
+        if dataset.keypoint_target:
+            return batch_images, batch_keypoints
+        batch_heatmaps = render_gt_heatmaps_tensor(batch_keypoints, output_shape)
+        return batch_images, batch_heatmaps
+
+    tf_dataset = tf.data.Dataset.range(num_shards)
+    if shuffle:
+        tf_dataset = tf_dataset.shuffle(num_shards, reshuffle_each_iteration=True)
+    tf_dataset = tf_dataset.interleave(make_shard, cycle_length=num_shards, block_length=1,
+                                       num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    tf_dataset = tf_dataset.map(map_sample, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    tf_dataset = tf_dataset.filter(lambda image_data, gt_heatmap, valid: valid)
+    tf_dataset = tf_dataset.map(lambda image_data, gt_heatmap, valid: (image_data, gt_heatmap))
+
+    # keep batch number same as hourglass_dataset.__len__()
+    tf_dataset = tf_dataset.batch(dataset.batch_size, drop_remainder=True)
+    if batch_augment:
+        tf_dataset = tf_dataset.map(augment_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+
+    # need to feed each hg unit the same gt heatmap
+    if not dataset.single_target:
+        num_hgstack = dataset.num_hgstack
+        tf_dataset = tf_dataset.map(lambda batch_images, batch_heatmaps: (batch_images, (batch_heatmaps,) * num_hgstack))
+
+    if repeat:
+        tf_dataset = tf_dataset.repeat()
+    tf_dataset = tf_dataset.prefetch(tf.data.AUTOTUNE)
+
+    return tf_dataset
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Custom training loop for Stacked Hourglass model, as a replacement of
+model.fit_generator(). Train step is compiled with tf.function and could
+run several steps in one call (steps_per_execution), and accumulate the
+gradients of several micro batches before one optimizer update for large
+effective batch size. Forward & backward pass could be XLA compiled to
+fuse the small ops of hourglass blocks. Keras callbacks are driven with
+the same logs as model.fit(), together with step time & samples/sec of
+every epoch.
+
+Also support data parallel training on several CPU nodes, with
+MultiWorkerMirroredStrategy from a cluster spec (get_multi_worker_strategy()),
+and full training state checkpoints to resume exactly (hourglass.checkpoint).
+"""
+import os, json, time, random, functools
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import UpSampling2D
+from tensorflow.keras.utils import Sequence
+
+from hourglass.data import hourglass_dataset
+from hourglass.loader import ParallelDataLoader
+from common.model_utils import is_static_shape_model, get_xla_error_message
+
+
+def _nearest_upsampling(inputs, size):
+    """
+    same as UpSampling2D nearest resize with integer size, by broadcast
+    & reshape. Its gradient (block sum) is XLA compatible, while the
+    ResizeNearestNeighborGrad op has no XLA kernel on CPU
+    """
+    height, width, channels = inputs.shape[1:]
+    outputs = tf.broadcast_to(inputs[:, :, None, :, None, :], [tf.shape(inputs)[0], height, size[0], width, size[1], channels])
+    return tf.reshape(outputs, [-1, height * size[0], width * size[1], channels])
+
+
+def set_xla_upsampling(model):
+    """
+    switch UpSampling2D layers of hourglass blocks to XLA compatible
+    implementation. The output is identical, and model config & weights
+    are not changed
+    """
+    for layer in model.layers:
+        if isinstance(layer, UpSampling2D) and layer.interpolation == 'nearest' and \
+           layer.data_format == 'channels_last' and None not in layer.input_shape[1:]:
+            layer.call = functools.partial(_nearest_upsampling, size=layer.size)
+
+
+def get_multi_worker_strategy(cluster_spec, task_index):
+    """
+    create MultiWorkerMirroredStrategy for data parallel training on CPU
+    nodes. TF_CONFIG is set with the cluster spec & current task, so it
+    should be called before any other TF op runs
+
+    # Arguments
+        cluster_spec: json file of cluster spec like
+            {"worker": ["host1:port", "host2:port"]}, or comma
+            separated worker addresses like "host1:port,host2:port"
+        task_index: index of current worker in cluster spec. worker 0
+            is the chief to run evaluation & save checkpoints
+
+    # Returns
+        strategy: MultiWorkerMirroredStrategy
+    """
+    if os.path.isfile(cluster_spec):
+        with open(cluster_spec) as f:
+            cluster = json.load(f)
+    else:
+        cluster = {'worker': [address.strip() for address in cluster_spec.split(',')]}
+    if task_index < 0 or task_index >= len(cluster['worker']):
+        raise ValueError('invalid task index {} for {} workers'.format(task_index, len(cluster['worker'])))
+
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': task_index}})
+    # ring all-reduce over gRPC, NCCL is for GPU only
+    communication_options = tf.distribute.experimental.CommunicationOptions(implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication_options)
+
+
+def get_num_workers(strategy):
+    """
+    number of worker processes (nodes) of the strategy, 1 for local strategy
+    """
+    if isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return strategy.num_replicas_in_sync // len(strategy.extended.worker_devices)
+    return 1
+
+
+def is_chief(strategy):
+    """
+    whether current worker should run evaluation & save checkpoints,
+    always True for local strategy
+    """
+    return strategy is None or strategy.extended.should_checkpoint
+
+
+def get_local_model(model, local_model=None):
+    """
+    copy worker local variable values of a multi-worker strategy model to
+    a model out of the strategy, which could be evaluated & saved on chief
+    only. Reading the distributed variables (like BatchNorm moving
+    statistics) in keras predict()/save() runs collective ops, and would
+    block if other workers don't run it. Other model is returned as is
+
+    # Arguments
+        model: keras model
+        local_model: model to copy to, cloned from model if None
+
+    # Returns
+        local_model: model with current weights of local worker
+    """
+    strategy = model.distribute_strategy
+    if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return model
+    if local_model is None:
+        local_model = tf.keras.models.clone_model(model)
+    local_model.set_weights([strategy.experimental_local_results(weight)[0].numpy() for weight in model.weights])
+    return local_model
+
+
+class BatchSlotReleaser(object):
+    """
+    Hold the batch slots of hourglass_dataset batches which are fed to
+    tf.data without copy, until training steps consumed them. Tensor
+    converted from an aligned numpy array may share its memory, so slot
+    could only be reused after the training function call which trained
+    on the batch returns. Batches are consumed in the order they're fed.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.slots = collections.deque()
+        self.closed = False
+
+    def hold(self, slot):
+        """
+        hold an acquired slot, return False if releaser is closed
+        """
+        if self.closed:
+            self.dataset.release_batch(slot)
+            return False
+        self.slots.append(slot)
+        return True
+
+    def release(self, num_batches):
+        """
+        release slots of the oldest num_batches batches, which are trained
+        """
+        for _ in range(min(num_batches, len(self.slots))):
+            self.dataset.release_batch(self.slots.popleft())
+
+    def close(self):
+        """
+        release all the slots and stop feeding batches, so a generator
+        waiting for a free slot won't block forever
+        """
+        self.closed = True
+        self.release(len(self.slots))
+
+
+def get_input_dataset(loader, initial_batches=0, batches_per_call=1):
+    """
+    wrap training batch source as an endless tf.data.Dataset
+
+    # Arguments
+        loader: tf.data.Dataset (should be repeated), keras Sequence
+            (like hourglass_dataset) or python batch generator (like
+            hourglass.loader.ParallelDataLoader)
+        initial_batches: number of batches already trained from start
+            of epoch 0, to resume from. loader should be a deterministic
+            hourglass_dataset or ParallelDataLoader to get the same data
+        batches_per_call: max number of loader batches trained in one
+            training function call. hourglass_dataset batches are fed
+            without copy if it has more batch slots (num_batch_slots)
+
+    # Returns
+        dataset: tf.data.Dataset of (batch_images, batch_targets)
+        slot_releaser: BatchSlotReleaser for the batches fed without copy,
+            whose release() should be called with the number of trained
+            batches after every training function call, and close() at
+            end of training. None if batches are copied
+    """
+    if isinstance(loader, tf.data.Dataset):
+        if initial_batches > 0:
+            print('Data position of tf.data pipeline could not be restored, start from a new pass')
+        return loader, None
+
+    def to_tuple(batch):
+        # from_generator need tuple for nested structure
+        if isinstance(batch, (list, tuple)):
+            return tuple(to_tuple(item) for item in batch)
+        return batch
+
+    slot_releaser = None
+    if isinstance(loader, Sequence):
+        epoch, start_index = divmod(initial_batches, len(loader))
+        if initial_batches > 0 and hasattr(loader, 'set_epoch'):
+            loader.set_epoch(epoch)
+        # with a slot for every batch of a training function call (and one
+        # more to form up next batch), batches are fed in their slots
+        if isinstance(loader, hourglass_dataset) and len(loader.batch_ring) > batches_per_call:
+            slot_releaser = BatchSlotReleaser(loader)
+        def get_batches():
+            index = start_index
+            while True:
+                for i in range(index, len(loader)):
+                    if slot_releaser is not None:
+                        slot, batch = loader.acquire_batch(i)
+                        if not slot_releaser.hold(slot):
+                            return
+                        yield to_tuple(batch[0:2])
+                    else:
+                        # Sequence reuse its batch buffers, but tensor
+                        # converted from numpy array may share the memory
+                        yield to_tuple(tf.nest.map_structure(np.copy, loader[i])[0:2])
+                index = 0
+                loader.on_epoch_end()
+    else:
+        if initial_batches > 0 and hasattr(loader, 'seek'):
+            loader.seek(initial_batches)
+        def get_batches():
+            while True:
+                yield to_tuple(next(loader)[0:2])
+
+    # first batch gives the output signature, and it's also the first
+    # element of the dataset, so no extra batch is formed up
+    batches = get_batches()
+    first_batch = next(batches)
+    def generator():
+        yield first_batch
+        yield from batches
+
+    # hourglass_dataset drops the last partial batch, so batch dim is fixed,
+    # which also makes the oneDNN CPU kernels deterministic for exact resume.
+    # keep it unknown for other loaders, in case of a smaller last batch
+    batch_dim = None
+    if isinstance(loader, (hourglass_dataset, ParallelDataLoader)):
+        batch_dim = tf.nest.flatten(first_batch)[0].shape[0]
+    output_signature = tf.nest.map_structure(lambda array: tf.TensorSpec(shape=(batch_dim,) + array.shape[1:], dtype=tf.as_dtype(array.dtype)), first_batch)
+    return tf.data.Dataset.from_generator(generator, output_signature=output_signature), slot_releaser
+
+
+class HourglassTrainer(object):
+    """
+    Compiled custom training loop with intermediate supervision loss on
+    all the hourglass stack outputs
+
+    # Arguments
+        model: hourglass model, with one heatmap output per stack. create
+            it under the strategy scope for distributed training
+        optimizer: keras optimizer, like the one from get_optimizer()
+        loss_func: heatmap loss function, like the one from get_loss().
+            it's applied to every stack output and the mean losses are
+            summed up, same as keras per-output loss
+        steps_per_execution: number of optimizer steps in one tf.function call
+        accumulation_steps: number of micro batches to accumulate gradients
+            for one optimizer step
+        strategy: tf.distribute strategy, None for current (default) one.
+            with MultiWorkerMirroredStrategy, every worker should feed its
+            own data shard, with per replica batch size
+        jit_compile: whether to XLA compile forward & backward pass, only
+            for model with static input shape. Gradients differ from
+            non-XLA ones by float32 rounding (summation order), see
+            tools/benchmark/xla_benchmark.py for a float64 reference check
+    """
+    def __init__(self, model, optimizer, loss_func, steps_per_execution=1, accumulation_steps=1, strategy=None, jit_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_func = loss_func
+        self.steps_per_execution = max(1, steps_per_execution)
+        self.accumulation_steps = max(1, accumulation_steps)
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        self.output_names = model.output_names
+        self.stop_training = False
+        self.jit_compile = jit_compile
+        if jit_compile and not is_static_shape_model(model):
+            print('Model input shape {} is dynamic, disable XLA compile'.format(model.input_shape))
+            self.jit_compile = False
+        if self.jit_compile:
+            set_xla_upsampling(model)
+
+        with self.strategy.scope():
+            # running mean of total & per-stack loss in an epoch,
+            # named same as keras fit() logs
+            self.loss_metrics = [tf.keras.metrics.Mean(name='loss')] + \
+                                [tf.keras.metrics.Mean(name=name + '_loss') for name in self.output_names]
+            # trained samples of all replicas, for samples/sec
+            self.sample_counter = tf.keras.metrics.Sum(name='samples')
+            # create optimizer slots out of the compiled loop
+            self._build_optimizer()
+            if self.accumulation_steps > 1:
+                # local gradient sum of every replica
+                self.accum_gradients = [tf.Variable(tf.zeros_like(variable), trainable=False,
+                                                    synchronization=tf.VariableSynchronization.ON_READ,
+                                                    aggregation=tf.VariableAggregation.NONE)
+                                        for variable in self.model.trainable_variables]
+        self.train_function = None
+        # whether training is stopped by a signal (preemption)
+        self.preempted = False
+
+    def _build_optimizer(self):
+        if hasattr(self.optimizer, 'build'):
+            self.optimizer.build(self.model.trainable_variables)
+        else:
+            # legacy keras optimizer
+            self.optimizer._create_all_weights(self.model.trainable_variables)
+
+    def compute_loss(self, y_true, y_pred):
+        """
+        sum of mean loss on every stack output, same gt target
+        for all stacks if y_true is not a list/tuple
+        """
+        if not isinstance(y_pred, (list, tuple)):
+            y_pred = [y_pred]
+        stack_losses = []
+        for i, stack_pred in enumerate(y_pred):
+            stack_true = y_true[i] if isinstance(y_true, (list, tuple)) else y_true
+            stack_losses.append(tf.reduce_mean(self.loss_func(stack_true, tf.cast(stack_pred, tf.float32))))
+        loss = tf.add_n(stack_losses)
+        if self.model.losses:
+            # regularization losses
+            loss = loss + tf.add_n(self.model.losses)
+        return loss, stack_losses
+
+    def _get_gradients(self, batch):
+        x, y = batch
+        with tf.GradientTape() as tape:
+            y_pred = self.model(x, training=True)
+            loss, stack_losses = self.compute_loss(y, y_pred)
+            # gradients are summed over replicas & micro batches
+            scaled_loss = loss / (self.strategy.num_replicas_in_sync * self.accumulation_steps)
+            if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.optimizer.get_scaled_loss(scaled_loss)
+
+        gradients = tape.gradient(scaled_loss, self.model.trainable_variables)
+        if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+
+        for metric, value in zip(self.loss_metrics, [loss] + stack_losses):
+            metric.update_state(value)
+        self.sample_counter.update_state(tf.cast(tf.shape(x)[0], tf.float32))
+        return gradients
+
+    def train_step(self, batch):
+        gradients = self.get_gradients(batch)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+    def accumulate_step(self, batch):
+        gradients = self.get_gradients(batch)
+        for accum_gradient, gradient in zip(self.accum_gradients, gradients):
+            accum_gradient.assign_add(gradient)
+
+    def apply_step(self):
+        self.optimizer.apply_gradients(zip([accum_gradient.read_value() for accum_gradient in self.accum_gradients], self.model.trainable_variables))
+        for accum_gradient in self.accum_gradients:
+            accum_gradient.assign(tf.zeros_like(accum_gradient))
+
+    def check_xla_compile(self, batch_spec):
+        """
+        XLA compile forward & backward pass for the batch spec, and fall back
+        to non-XLA training if it fails. It's done before training function
+        call, since a failed call has consumed batches from the iterator
+        """
+        if not self.jit_compile:
+            return
+        # op support doesn't depend on batch size, which may be unknown
+        batch = tf.nest.map_structure(lambda spec: tf.zeros([1 if dim is None else dim for dim in spec.shape], spec.dtype), batch_spec)
+        get_gradients = tf.function(self._get_gradients, jit_compile=True)
+        try:
+            # only lower to HLO, no step is run
+            self.strategy.run(lambda: get_gradients.experimental_get_compiler_ir(batch)(stage='hlo'))
+        except (ValueError, tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+            # unsupported op error is raised as ValueError when getting HLO
+            print('XLA compile failed, fall back to non-XLA training: {}'.format(get_xla_error_message(e)))
+            self.jit_compile = False
+
+    def make_train_function(self):
+        # optimizer update stays out of XLA cluster, since
+        # it's cheap and may not be XLA compatible
+        if self.jit_compile:
+            self.get_gradients = tf.function(self._get_gradients, jit_compile=True)
+        else:
+            self.get_gradients = self._get_gradients
+
+        strategy = self.strategy
+        accumulation_steps = self.accumulation_steps
+
+        @tf.function
+        def train_function(iterator, num_steps):
+            for _ in tf.range(num_steps):
+                if accumulation_steps > 1:
+                    for _ in tf.range(accumulation_steps):
+                        strategy.run(self.accumulate_step, args=(next(iterator),))
+                    strategy.run(self.apply_step)
+                else:
+                    strategy.run(self.train_step, args=(next(iterator),))
+
+        return train_function
+
+    def get_optimizer_variables(self):
+        # slots, iterations & dynamic loss scale, also the
+        # ones of optimizer wrapped by LossScaleOptimizer
+        return [variable for variable in tf.train.TrackableView(self.optimizer).descendants() if isinstance(variable, tf.Variable)]
+
+    def get_metric_variables(self):
+        return [variable for metric in self.loss_metrics + [self.sample_counter] for variable in metric.variables]
+
+    def get_training_state(self, epoch, step, data_batches=0):
+        """
+        full training state to resume from an optimizer step. Accumulated
+        gradients are not included since they're zero between optimizer
+        steps. With multi-worker strategy, it should be called on all the
+        workers, since reading distributed variables runs collective ops
+
+        # Arguments
+            epoch: epoch to resume
+            step: optimizer step in the epoch to resume
+            data_batches: number of loader batches trained from start
+
+        # Returns
+            state: dict of numpy arrays & python objects, could be pickled
+        """
+        return {'epoch': epoch,
+                'step': step,
+                'data_batches': data_batches,
+                'model_weights': self.model.get_weights(),
+                'optimizer_variables': [variable.numpy() for variable in self.get_optimizer_variables()],
+                'metric_variables': [variable.numpy() for variable in self.get_metric_variables()],
+                'random_state': random.getstate(),
+                'numpy_random_state': np.random.get_state()}
+
+    def set_training_state(self, state):
+        """
+        restore model, optimizer, metrics & random states from a
+        training state of get_training_state()
+        """
+        optimizer_variables = self.get_optimizer_variables()
+        if len(optimizer_variables) != len(state['optimizer_variables']):
+            raise ValueError('optimizer variable number mismatch: {} vs {} in training state, check optimizer type'.format(len(optimizer_variables), len(state['optimizer_variables'])))
+
+        self.model.set_weights(state['model_weights'])
+        for variable, value in zip(optimizer_variables + self.get_metric_variables(), state['optimizer_variables'] + state['metric_variables']):
+            variable.assign(value)
+        random.setstate(state['random_state'])
+        np.random.set_state(state['numpy_random_state'])
+
+    def get_logs(self):
+        return {metric.name: float(metric.result()) for metric in self.loss_metrics}
+
+    def fit(self, loader, steps_per_epoch, epochs, initial_epoch=0, callbacks=None, verbose=1, checkpointer=None, resume_state=None):
+        """
+        train model like model.fit()
+
+        # Arguments
+            loader: training batch source, see get_input_dataset()
+            steps_per_epoch: number of micro batches in an epoch, which is
+                rounded down to whole optimizer steps with accumulation
+            epochs: index of the last epoch
+            initial_epoch: epoch to start training
+            callbacks: list of keras callbacks
+            verbose: 0 for silent, 1 for progress bar
+            checkpointer: hourglass.checkpoint.StateCheckpointer to save
+                training state periodically, None to disable
+            resume_state: training state (from a checkpoint) to resume
+                from, which override initial_epoch
+
+        # Returns
+            history: keras History object
+        """
+        optimizer_steps = max(1, steps_per_epoch // self.accumulation_steps)
+
+        # loader batches of all local replicas in one optimizer step
+        if isinstance(self.strategy, tf.distribute.MultiWorkerMirroredStrategy):
+            batches_per_step = self.accumulation_steps * len(self.strategy.extended.worker_devices)
+        else:
+            batches_per_step = self.accumulation_steps
+
+        initial_step, data_batches = 0, 0
+        if resume_state is not None:
+            self.set_training_state(resume_state)
+            initial_epoch, initial_step, data_batches = resume_state['epoch'], resume_state['step'], resume_state['data_batches']
+            print('Resume training from epoch {} step {}'.format(initial_epoch + 1, initial_step))
+
+        dataset, slot_releaser = get_input_dataset(loader, data_batches, batches_per_call=self.steps_per_execution * batches_per_step)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        if isinstance(self.strategy, tf.distribute.MultiWorkerMirroredStrategy):
+            # worker dataset is sharded already (hourglass_dataset
+            # num_data_shards), so no auto shard & rebatch
+            iterator = iter(self.strategy.distribute_datasets_from_function(lambda input_context: dataset))
+        else:
+            iterator = iter(self.strategy.experimental_distribute_dataset(dataset))
+        if self.train_function is None:
+            self.check_xla_compile(dataset.element_spec)
+            self.train_function = self.make_train_function()
+
+        callbacks = list(callbacks) if callbacks else []
+        if verbose != 0:
+            # logs are running mean already, don't average them again
+            stateful_metrics = [metric.name for metric in self.loss_metrics] + ['step_time', 'samples_per_sec']
+            callbacks.append(tf.keras.callbacks.ProgbarLogger(count_mode='steps', stateful_metrics=stateful_metrics))
+        callback_list = tf.keras.callbacks.CallbackList(callbacks, add_history=True, model=self.model,
+                                                        verbose=verbose, epochs=epochs, steps=optimizer_steps)
+        # callbacks like TerminateOnNaN stop training with model flag
+        self.model.stop_training = False
+        callback_list.on_train_begin()
+
+        try:
+            logs = dict()
+            first_call = True
+            for epoch in range(initial_epoch, epochs):
+                # metrics of resumed epoch are restored
+                step = initial_step if epoch == initial_epoch else 0
+                if step == 0:
+                    for metric in self.loss_metrics + [self.sample_counter]:
+                        metric.reset_state()
+                callback_list.on_epoch_begin(epoch)
+
+                step_time, timed_steps, timed_samples = 0.0, 0, 0.0
+                while step < optimizer_steps:
+                    num_steps = min(self.steps_per_execution, optimizer_steps - step)
+                    callback_list.on_train_batch_begin(step)
+                    samples = float(self.sample_counter.result())
+                    start = time.perf_counter()
+                    self.train_function(iterator, tf.constant(num_steps))
+                    logs = self.get_logs()
+                    elapsed = time.perf_counter() - start
+                    # skip first call, which include tracing & input warm up
+                    if not first_call:
+                        step_time += elapsed
+                        timed_steps += num_steps
+                        timed_samples += float(self.sample_counter.result()) - samples
+                    first_call = False
+                    step += num_steps
+                    data_batches += num_steps * batches_per_step
+                    if slot_releaser is not None:
+                        # trained batches could be formed up in their slots again
+                        slot_releaser.release(num_steps * batches_per_step)
+                    callback_list.on_train_batch_end(step - 1, logs)
+
+                    if checkpointer is not None and step < optimizer_steps and \
+                       (checkpointer.should_save(step - num_steps, step) or checkpointer.signal_received):
+                        checkpointer.save(self.get_training_state(epoch, step, data_batches))
+                        if checkpointer.signal_received:
+                            # preempted, stop without finishing the epoch
+                            self.preempted = True
+                            self.model.stop_training = True
+                    if self.model.stop_training:
+                        break
+                if self.preempted:
+                    break
+
+                if timed_steps > 0:
+                    # step time in ms of one optimizer step
+                    logs['step_time'] = step_time / timed_steps * 1000
+                    logs['samples_per_sec'] = timed_samples / step_time
+                callback_list.on_epoch_end(epoch, logs)
+                if checkpointer is not None and step >= optimizer_steps:
+                    # resume from start of next epoch
+                    checkpointer.save(self.get_training_state(epoch + 1, 0, data_batches))
+                    if checkpointer.signal_received:
+                        self.preempted = True
+                        break
+                if self.model.stop_training:
+                    break
+        finally:
+            if slot_releaser is not None:
+                slot_releaser.close()
+
+        callback_list.on_train_end(logs)
+        return self.model.history
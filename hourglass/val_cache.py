@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preprocessed validation tensor cache for hourglass_dataset. With
+is_train=False the cropped & normalized input image and metainfo of a
+validation sample is always the same, so they are generated once and
+stored next to the annotation file (or in a given cache dir):
+
+    val_cache_<height>x<width>.npy     # float32 input images, loaded with mmap
+    val_cache_<height>x<width>.npz     # metainfo arrays, valid mask & cache signature
+
+Cache is rebuilt when annotation file, model input shape or preprocess
+options change. eval.py and EvalCallBack use the same cache files when
+enabled with --val_cache. The image file takes num_samples * height *
+width * 3 * 4 bytes (about 2.3GB for MPII val at 256x256), and its disk
+space is allocated before building, so a full disk raises OSError.
+"""
+import os, errno
+import numpy as np
+from tqdm import tqdm
+from common.data_utils import render_gt_heatmaps
+
+# bump it when cache file format or preprocess changes
+CACHE_VERSION = 2
+
+
+class ValidationCache(object):
+    """
+    Wrap a validation hourglass_dataset (is_train=False, with_meta=True)
+    and produce the same (image_data, gt_heatmap, metainfo) batches from
+    cache. Cache is loaded (or built) lazily at first access
+
+    # Arguments
+        dataset: validation hourglass_dataset object
+        cache_path: dir to store cache files, None for dataset path
+        with_heatmap: whether to render gt heatmaps for batches. None
+            heatmaps are returned if False, since evaluation only use
+            the transformed keypoints in metainfo
+    """
+    def __init__(self, dataset, cache_path=None, with_heatmap=True):
+        assert not dataset.is_train, 'validation cache only works with is_train=False dataset'
+        self.dataset = dataset
+        self.batch_size = dataset.batch_size
+        self.with_heatmap = with_heatmap
+
+        cache_path = cache_path if cache_path else os.path.dirname(dataset.json_file)
+        os.makedirs(cache_path, exist_ok=True)
+        cache_name = 'val_cache_{}x{}'.format(dataset.input_shape[0], dataset.input_shape[1])
+        self.image_file = os.path.join(cache_path, cache_name + '.npy')
+        self.meta_file = os.path.join(cache_path, cache_name + '.npz')
+
+        self.images = None
+        self.meta = None
+        self.heatmaps = np.zeros(shape=(self.batch_size, dataset.output_shape[0], dataset.output_shape[1], dataset.num_classes), dtype=np.float32)
+
+    def get_signature(self):
+        file_stat = os.stat(self.dataset.json_file)
+        return np.array([CACHE_VERSION, file_stat.st_size, file_stat.st_mtime_ns,
+                         self.dataset.input_shape[0], self.dataset.input_shape[1], self.dataset.num_classes,
+                         int(self.dataset.fused_transform), int(self.dataset.reduced_decode)], dtype=np.int64)
+
+    def _load(self):
+        if self.images is not None:
+            return
+        signature = self.get_signature()
+
+        if os.path.isfile(self.meta_file) and os.path.isfile(self.image_file):
+            with np.load(self.meta_file, allow_pickle=False) as meta:
+                if np.array_equal(meta['signature'], signature):
+                    self.meta = {key: meta[key] for key in meta.files}
+                    self.images = np.load(self.image_file, mmap_mode='r')
+                    return
+
+        try:
+            self._build(signature)
+        except OSError as e:
+            raise OSError('Failed to build validation cache {}: {}. Use a writable cache path with enough space, or disable validation cache'.format(self.image_file, e)) from e
+
+    def _build(self, signature):
+        dataset = self.dataset
+        annotations = dataset.get_annotations()
+        num_samples = len(annotations)
+        image_shape = (num_samples, dataset.input_shape[0], dataset.input_shape[1], 3)
+
+        # write to temp files first, in case of concurrent evaluation
+        temp_image_file = self.image_file + '.tmp.{}.npy'.format(os.getpid())
+        temp_meta_file = self.meta_file + '.tmp.{}.npz'.format(os.getpid())
+        try:
+            images = np.lib.format.open_memmap(temp_image_file, mode='w+', dtype=np.float32, shape=image_shape)
+            # allocate disk space of the sparse file before writing, since
+            # a write to memmap on a full disk get SIGBUS instead of OSError
+            if hasattr(os, 'posix_fallocate'):
+                with open(temp_image_file, 'r+b') as f:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, os.path.getsize(temp_image_file))
+                    except OSError as e:
+                        # ignore filesystem without fallocate support
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+
+            meta = self._fill(annotations, images, signature)
+
+            images.flush()
+            del images
+            np.savez(temp_meta_file, **meta)
+            # meta file is replaced last, since it
+            # hold the signature of cache
+            os.replace(temp_image_file, self.image_file)
+            os.replace(temp_meta_file, self.meta_file)
+        finally:
+            for temp_file in [temp_image_file, temp_meta_file]:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+        self.images = np.load(self.image_file, mmap_mode='r')
+        self.meta = meta
+
+    def _fill(self, annotations, images, signature):
+        """
+        preprocess validation samples into images array,
+        and return the metainfo arrays
+        """
+        dataset = self.dataset
+        num_samples = len(annotations)
+        meta = {'signature': signature,
+                'sample_index': np.arange(num_samples, dtype=np.int64),
+                'center': np.zeros((num_samples, 2), dtype=np.float64),
+                'scale': np.zeros((num_samples,), dtype=np.float64),
+                'image_shape': np.zeros((num_samples, 3), dtype=np.int64),
+                'pts': np.zeros((num_samples, dataset.num_classes, 3), dtype=np.float64),
+                'tpts': np.zeros((num_samples, dataset.num_classes, 3), dtype=np.float64),
+                'name': [],
+                'valid': np.zeros((num_samples,), dtype=np.bool_)}
+
+        for i, annotation in enumerate(tqdm(annotations, desc='Build validation cache')):
+            image, _, metainfo = dataset.process_image(i, annotation, with_heatmap=False)
+            if image is None:
+                # empty crop, bypass the sample like hourglass_dataset.get_batch():
+                # zero image & keypoints (empty heatmap), and no metainfo in batch
+                meta['name'].append('')
+                continue
+            images[i] = image
+            meta['valid'][i] = True
+            for key in ['center', 'scale', 'image_shape', 'pts', 'tpts']:
+                meta[key][i] = metainfo[key]
+            meta['name'].append(metainfo['name'])
+        meta['name'] = np.array(meta['name'], dtype=np.str_)
+        return meta
+
+    def get_metainfo(self, i):
+        return {'sample_index': int(self.meta['sample_index'][i]),
+                'center': self.meta['center'][i].copy(),
+                'scale': float(self.meta['scale'][i]),
+                'image_shape': tuple(self.meta['image_shape'][i].tolist()),
+                'pts': self.meta['pts'][i].copy(),
+                'tpts': self.meta['tpts'][i].copy(),
+                'name': str(self.meta['name'][i])}
+
+    def get_dataset_name(self):
+        return self.dataset.get_dataset_name()
+
+    def get_dataset_size(self):
+        return self.dataset.get_dataset_size()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        self._load()
+        start, end = i*self.batch_size, (i+1)*self.batch_size
+        batch_images = np.asarray(self.images[start:end])
+        batch_metainfo = [self.get_metainfo(j) for j in range(start, end) if self.meta['valid'][j]]
+
+        batch_heatmaps = None
+        if self.with_heatmap:
+            if self.dataset.keypoint_target:
+                # heatmap will be rendered with keypoints in loss
+                batch_heatmaps = self.meta['tpts'][start:end]
+            else:
+                batch_heatmaps = render_gt_heatmaps(self.meta['tpts'][start:end], self.heatmaps)
+        # same output format as hourglass_dataset with with_meta=True
+        if self.dataset.single_target:
+            return batch_images, batch_heatmaps, batch_metainfo
+        return batch_images, [batch_heatmaps] * self.dataset.num_hgstack, batch_metainfo
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -12,8 +12,9 @@ import tensorflow.keras.backend as K
 from hourglass.model import get_hourglass_model
 from hourglass.data import HG_OUTPUT_STRIDE
 from hourglass.postprocess import post_process_heatmap, post_process_heatmap_simple
-from common.data_utils import preprocess_image
+from common.data_utils import preprocess_image, batch_revert_box_keypoints
 from common.utils import get_classes, get_skeleton, render_skeleton, optimize_tf_gpu
+from common.model_utils import XLAPredictor
 
 from detector import detect_person, get_anchors, get_square_box
 
@@ -33,6 +34,7 @@ default_config = {
         "classes_path": os.path.join('configs', 'mpii_classes.txt'),
         "skeleton_path": None,
         "weights_path": os.path.join('weights', 'hourglass_mobile.h5'),
+        "use_xla": False,
 
         # YOLOv3 person detection model info
         "det_model_path": os.path.join('detector', 'yolo3_mobilenet_lite_320_coco.h5'),
@@ -64,6 +66,8 @@ class Hourglass(object):
             self.skeleton_lines = None
         self.class_names = get_classes(self.classes_path)
         self.hourglass_model = self._generate_model()
+        # XLA compiled inference to fuse the small ops in hourglass blocks
+        self.predictor = XLAPredictor(self.hourglass_model) if self.use_xla else self.hourglass_model
 
         self._init_detection_model()
         K.set_learning_phase(0)
@@ -113,17 +117,11 @@ class Hourglass(object):
 
             image_data = preprocess_image(person_image, self.model_input_shape)
 
-            # NOTE: image_size and scale in (w,h) format, but
-            #       self.model_input_shape in (h,w) format
-            image_size = person_image.size
-            scale = (image_size[0] * 1.0 / self.model_input_shape[1], image_size[1] * 1.0 / self.model_input_shape[0])
-
             keypoints = self.predict(image_data)
 
             # rescale keypoints back to origin image shape
-            keypoints_dict = dict()
-            for i, keypoint in enumerate(keypoints):
-                keypoints_dict[self.class_names[i]] = (keypoint[0] * scale[0] * HG_OUTPUT_STRIDE + xmin, keypoint[1] * scale[1] * HG_OUTPUT_STRIDE + ymin, keypoint[2])
+            keypoints = batch_revert_box_keypoints([keypoints], [(xmin, ymin, xmax, ymax)], self.model_input_shape, HG_OUTPUT_STRIDE)[0]
+            keypoints_dict = dict(zip(self.class_names, map(tuple, keypoints)))
 
             # draw bbox rectangle on image
             cv2.rectangle(image_array, (raw_xmin, raw_ymin), (raw_xmax, raw_ymax), (255, 0, 0), 1, cv2.LINE_AA)
@@ -147,7 +145,6 @@ class Hourglass(object):
         person_boxes, person_scores = detect_person(image, self.det_model, self.det_anchors, self.det_class_names, self.det_model_input_shape)
 
         batch_image_data = []
-        batch_scale = []
         batch_raw_box = []
         batch_box = []
         for box, score in zip(person_boxes, person_scores):
@@ -162,13 +159,7 @@ class Hourglass(object):
 
             image_data = preprocess_image(person_image, self.model_input_shape)
 
-            # NOTE: image_size and scale in (w,h) format, but
-            #       self.model_input_shape in (h,w) format
-            image_size = person_image.size
-            scale = (image_size[0] * 1.0 / self.model_input_shape[1], image_size[1] * 1.0 / self.model_input_shape[0])
-
             # merge batched info for inference
-            batch_scale.append(scale)
             batch_raw_box.append((raw_xmin, raw_ymin, raw_xmax, raw_ymax))
             batch_box.append((xmin, ymin, xmax, ymax))
             # here we strip the batch dim in image_data before append
@@ -182,16 +173,14 @@ class Hourglass(object):
         batch_image_data = np.array(batch_image_data)
         batch_keypoints = self.batch_predict(batch_image_data)
 
+        # rescale keypoints of all persons back to origin image shape
+        batch_keypoints = batch_revert_box_keypoints(batch_keypoints, batch_box, self.model_input_shape, HG_OUTPUT_STRIDE)
+
         # handle batch inference result
         for i, keypoints in enumerate(batch_keypoints):
-            scale = batch_scale[i]
             raw_xmin, raw_ymin, raw_xmax, raw_ymax = batch_raw_box[i]
-            xmin, ymin, xmax, ymax = batch_box[i]
 
-            # rescale keypoints back to origin image shape
-            keypoints_dict = dict()
-            for j, keypoint in enumerate(keypoints):
-                keypoints_dict[self.class_names[j]] = (keypoint[0] * scale[0] * HG_OUTPUT_STRIDE + xmin, keypoint[1] * scale[1] * HG_OUTPUT_STRIDE + ymin, keypoint[2])
+            keypoints_dict = dict(zip(self.class_names, map(tuple, keypoints)))
 
             # draw bbox rectangle on image
             cv2.rectangle(image_array, (raw_xmin, raw_ymin), (raw_xmax, raw_ymax), (255, 0, 0), 1, cv2.LINE_AA)
@@ -207,7 +196,7 @@ class Hourglass(object):
 
     def predict(self, image_data):
         # get final predict heatmap
-        prediction = self.hourglass_model.predict(image_data)
+        prediction = self.predictor.predict(image_data)
         if isinstance(prediction, list):
             prediction = prediction[-1]
         heatmap = prediction[0]
@@ -220,7 +209,7 @@ class Hourglass(object):
 
     def batch_predict(self, image_data):
         # get batch predict heatmap
-        prediction = self.hourglass_model.predict_on_batch(image_data)
+        prediction = self.predictor.predict_on_batch(image_data)
         if isinstance(prediction, list):
             prediction = prediction[-1]
 
@@ -341,6 +330,10 @@ if __name__ == "__main__":
         '--conf_threshold', type=float,
         help='confidence threshold, default ' + str(Hourglass.get_defaults("conf_threshold"))
     )
+    parser.add_argument(
+        '--use_xla', default=False, action="store_true",
+        help='use XLA compiled inference, default ' + str(Hourglass.get_defaults("use_xla"))
+    )
 
     parser.add_argument(
         '--image', default=False, action="store_true",
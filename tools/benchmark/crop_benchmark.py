@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark per-sample geometric transform cost of legacy flip + crop_image()
+path and the fused single affine warp crop_image_affine(). Keypoint placement
+is checked by rendering dots at random keypoints of the source image, and
+comparing the dot locations in the legacy & fused output images.
+"""
+import os, sys, argparse
+import time
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from common.data_utils import crop_image, crop_image_affine, horizontal_flip_keypoints, vertical_flip_keypoints, transform_keypoints, MPII_SCALE_REFERENCE
+
+
+def get_test_image(image_path, image_size):
+    if image_path:
+        image = np.array(Image.open(image_path).convert('RGB'))
+        return cv2.resize(image, image_size, interpolation=cv2.INTER_CUBIC)
+
+    # smooth random image, so that geometric mismatch
+    # show up clearly in pixel difference
+    small_image = np.random.randint(0, 256, size=(image_size[1]//40 + 2, image_size[0]//40 + 2, 3), dtype=np.uint8)
+    return cv2.resize(small_image, image_size, interpolation=cv2.INTER_CUBIC)
+
+
+def get_random_params(image, input_shape, num_samples):
+    height, width = image.shape[0:2]
+    params = []
+    for _ in range(num_samples):
+        # object scale & center like MPII/COCO records, then
+        # same augment range as hourglass_dataset
+        scale = np.random.uniform(0.5, 0.9) * min(height, width) / MPII_SCALE_REFERENCE
+        scale = scale * np.random.uniform(0.8, 1.2)
+        center = np.array([np.random.uniform(0.3, 0.7) * width, np.random.uniform(0.3, 0.7) * height])
+        rotate_angle = np.random.randint(-30, 30) if np.random.rand() < 0.5 else 0
+        h_flip = np.random.rand() < 0.5
+        v_flip = np.random.rand() < 0.5
+        params.append((center, scale, rotate_angle, h_flip, v_flip))
+    return params
+
+
+def get_dot_image(image, center, scale, input_shape):
+    """
+    black image with 3 dots around the object, one in each color channel
+    so they don't overlap. dot radius grows with the crop downscale, to
+    still be a few pixels in output image
+
+    # Returns
+        dot_image: uint8 image same size as source image
+        keypoints: dot centers array, shape=(3, 3)
+    """
+    height, width = image.shape[0:2]
+    box_size = scale * MPII_SCALE_REFERENCE
+    radius = int(max(3, np.ceil(3 * box_size / input_shape[0])))
+
+    dot_image = np.zeros_like(image)
+    keypoints = []
+    for channel in range(3):
+        x = np.clip(center[0] + np.random.uniform(-0.3, 0.3) * box_size, radius, width - radius - 1)
+        y = np.clip(center[1] + np.random.uniform(-0.3, 0.3) * box_size, radius, height - radius - 1)
+        channel_image = np.ascontiguousarray(dot_image[..., channel])
+        # sub-pixel dot center with 8x fixed point coordinate
+        cv2.circle(channel_image, (int(round(x * 8)), int(round(y * 8))), radius * 8, 255, thickness=-1, lineType=cv2.LINE_AA, shift=3)
+        dot_image[..., channel] = channel_image
+        keypoints.append([x, y, 1.0])
+    return dot_image, np.array(keypoints)
+
+
+def get_dot_locations(image, margin):
+    """
+    intensity weighted centroid (x, y) of the dot in each channel, None for
+    a dot cropped out or within margin pixels of the image border
+    """
+    height, width = image.shape[0:2]
+    grid_y, grid_x = np.mgrid[0:height, 0:width]
+    locations = []
+    for channel in range(3):
+        weights = image[..., channel].astype(np.float64)
+        total = weights.sum()
+        if total == 0:
+            locations.append(None)
+            continue
+        x, y = (weights * grid_x).sum() / total, (weights * grid_y).sum() / total
+        if margin <= x < width - margin and margin <= y < height - margin:
+            locations.append(np.array([x, y]))
+        else:
+            locations.append(None)
+    return locations
+
+
+def check_keypoints(image, input_shape, output_shape, center, scale, rotate_angle, h_flip, v_flip):
+    """
+    distances (in input image pixel) between the legacy & fused
+    output locations of dots rendered at source keypoints
+    """
+    dot_image, keypoints = get_dot_image(image, center, scale, input_shape)
+    legacy_image, _ = run_legacy(dot_image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip)
+    fused_image, _ = run_fused(dot_image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip)
+    if legacy_image is None:
+        return []
+
+    # skip dots near the crop border, whose centroid
+    # is biased by the part cropped out
+    margin = max(4, 4 * scale * MPII_SCALE_REFERENCE / input_shape[0])
+    distances = []
+    for legacy_location, fused_location in zip(get_dot_locations(legacy_image, margin), get_dot_locations(fused_image, margin)):
+        if legacy_location is not None and fused_location is not None:
+            distances.append(np.linalg.norm(legacy_location - fused_location))
+    return distances
+
+
+def run_legacy(image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip):
+    height, width = image.shape[0:2]
+    center = np.copy(center)
+    if h_flip:
+        image = cv2.flip(image, flipCode=1)
+        keypoints, center = horizontal_flip_keypoints(keypoints, center, width)
+    if v_flip:
+        image = cv2.flip(image, flipCode=0)
+        keypoints, center = vertical_flip_keypoints(keypoints, center, height)
+    image = crop_image(image, center, scale, input_shape, rotate_angle)
+    keypoints = transform_keypoints(keypoints, center, scale, output_shape, rotate_angle)
+    return image, keypoints
+
+
+def run_fused(image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip):
+    height, width = image.shape[0:2]
+    center = np.copy(center)
+    if h_flip:
+        keypoints, center = horizontal_flip_keypoints(keypoints, center, width)
+    if v_flip:
+        keypoints, center = vertical_flip_keypoints(keypoints, center, height)
+    image = crop_image_affine(image, center, scale, input_shape, rotate_angle, h_flip, v_flip)
+    keypoints = transform_keypoints(keypoints, center, scale, output_shape, rotate_angle)
+    return image, keypoints
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Benchmark legacy & fused crop transform for data augment')
+    parser.add_argument('--image_path', type=str, required=False, help='test image file, default use random image', default=None)
+    parser.add_argument('--image_sizes', type=str, required=False, help='comma separated test image sizes as <width>x<height>, default=%(default)s', default='640x480,1920x1080,4000x3000')
+    parser.add_argument('--model_input_shape', type=str, required=False, help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--num_samples', type=int, required=False, help='number of random samples for each image size, default=%(default)s', default=100)
+    args = parser.parse_args()
+
+    height, width = args.model_input_shape.split('x')
+    input_shape = (int(height), int(width))
+    output_shape = (input_shape[0]//4, input_shape[1]//4)
+
+    print('{:>10} {:>12} {:>12} {:>8} {:>10} {:>13} {:>12}'.format('image', 'legacy(ms)', 'fused(ms)', 'speedup', 'pixel_diff', 'kpt_err(px)', 'kpt_max(px)'))
+    for image_size in args.image_sizes.split(','):
+        image_width, image_height = image_size.split('x')
+        image = get_test_image(args.image_path, (int(image_width), int(image_height)))
+        params = get_random_params(image, input_shape, args.num_samples)
+        keypoints = np.array([[image.shape[1] * 0.5, image.shape[0] * 0.5, 1.0]] * 16)
+
+        legacy_time, fused_time = 0.0, 0.0
+        pixel_diffs, keypoint_distances = [], []
+        for center, scale, rotate_angle, h_flip, v_flip in params:
+            start = time.perf_counter()
+            legacy_image, legacy_keypoints = run_legacy(image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip)
+            legacy_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            fused_image, fused_keypoints = run_fused(image, input_shape, output_shape, keypoints, center, scale, rotate_angle, h_flip, v_flip)
+            fused_time += time.perf_counter() - start
+
+            if legacy_image is not None:
+                pixel_diffs.append(np.mean(np.abs(legacy_image.astype(np.float32) - fused_image.astype(np.float32))))
+            keypoint_distances += check_keypoints(image, input_shape, output_shape, center, scale, rotate_angle, h_flip, v_flip)
+
+        legacy_ms = legacy_time * 1000 / args.num_samples
+        fused_ms = fused_time * 1000 / args.num_samples
+        print('{:>10} {:>12.3f} {:>12.3f} {:>7.2f}x {:>10.3f} {:>13.3f} {:>12.3f}'.format(image_size, legacy_ms, fused_ms, legacy_ms / fused_ms, np.mean(pixel_diffs),
+                                                                             np.mean(keypoint_distances), np.max(keypoint_distances)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check & benchmark batched gt heatmap rendering render_gt_heatmaps()
+against per-sample generate_gt_heatmap()
+"""
+import os, sys, argparse
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from common.data_utils import generate_gt_heatmap, render_gt_heatmaps
+
+
+def get_random_keypoints(batch_size, num_keypoints, heatmap_shape, border_ratio=0.3):
+    """
+    random integer keypoints like transform_keypoints() output, some of
+    them near or out of heatmap border, some invisible
+    """
+    height, width = heatmap_shape
+    keypoints = np.zeros((batch_size, num_keypoints, 3))
+    keypoints[..., 0] = np.random.randint(3, width - 4, size=(batch_size, num_keypoints))
+    keypoints[..., 1] = np.random.randint(3, height - 4, size=(batch_size, num_keypoints))
+
+    border = np.random.rand(batch_size, num_keypoints) < border_ratio
+    keypoints[..., 0] = np.where(border, np.random.randint(-5, width + 5, size=(batch_size, num_keypoints)), keypoints[..., 0])
+    keypoints[..., 1] = np.where(border, np.random.randint(-5, height + 5, size=(batch_size, num_keypoints)), keypoints[..., 1])
+    keypoints[..., 2] = np.random.rand(batch_size, num_keypoints) < 0.9
+    return keypoints
+
+
+def render_legacy(batch_keypoints, batch_heatmaps, sigma):
+    for n in range(batch_keypoints.shape[0]):
+        batch_heatmaps[n] = generate_gt_heatmap(batch_keypoints[n], batch_heatmaps.shape[1:3], sigma)
+    return batch_heatmaps
+
+
+def check_match(heatmap_shape, num_keypoints, sigma, batch_size=32, num_batches=50):
+    for _ in range(num_batches):
+        batch_keypoints = get_random_keypoints(batch_size, num_keypoints, heatmap_shape)
+        legacy = render_legacy(batch_keypoints, np.zeros((batch_size,) + heatmap_shape + (num_keypoints,), dtype=np.float32), sigma)
+        batched = render_gt_heatmaps(batch_keypoints, np.ones((batch_size,) + heatmap_shape + (num_keypoints,), dtype=np.float32), sigma)
+        if not np.array_equal(legacy, batched):
+            return False
+    return True
+
+
+def check_cases(heatmap_shape):
+    """
+    hand picked interior & border keypoints for sigma=1
+    """
+    height, width = heatmap_shape
+    keypoints = np.array([[[width//2, height//2, 1.0],   # interior
+                           [3, 3, 1.0],                  # gaussian just inside top-left
+                           [2, 10, 1.0],                 # gaussian over left border
+                           [width-5, height-5, 1.0],     # gaussian just inside bottom-right
+                           [width-4, 10, 1.0],           # gaussian touch right border
+                           [10, height-4, 1.0],          # gaussian touch bottom border
+                           [-1, -1, 1.0],                # out of heatmap
+                           [20, 20, 0.0],                # invisible
+                           [20.7, 30.2, 1.0]]])          # non-integer
+    legacy = render_legacy(keypoints, np.zeros((1,) + heatmap_shape + (keypoints.shape[1],), dtype=np.float32), 1)
+    batched = render_gt_heatmaps(keypoints, np.zeros((1,) + heatmap_shape + (keypoints.shape[1],), dtype=np.float32), 1)
+    return np.array_equal(legacy, batched)
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Check & benchmark batched gt heatmap rendering')
+    parser.add_argument('--heatmap_shape', type=str, required=False, help='heatmap shape as <height>x<width>, default=%(default)s', default='64x64')
+    parser.add_argument('--num_keypoints', type=int, required=False, help='number of keypoints, default=%(default)s', default=16)
+    parser.add_argument('--batch_size', type=int, required=False, help='batch size, default=%(default)s', default=16)
+    parser.add_argument('--num_batches', type=int, required=False, help='number of batches to benchmark, default=%(default)s', default=200)
+    args = parser.parse_args()
+
+    height, width = args.heatmap_shape.split('x')
+    heatmap_shape = (int(height), int(width))
+
+    print('hand picked interior/border cases match:', check_cases(heatmap_shape))
+    for sigma in [1, 2, 1.5]:
+        print('random keypoints match with sigma {}:'.format(sigma), check_match(heatmap_shape, args.num_keypoints, sigma))
+
+    batch_heatmaps = np.zeros((args.batch_size,) + heatmap_shape + (args.num_keypoints,), dtype=np.float32)
+    batches = [get_random_keypoints(args.batch_size, args.num_keypoints, heatmap_shape, border_ratio=0.1) for _ in range(args.num_batches)]
+
+    start = time.perf_counter()
+    for batch_keypoints in batches:
+        render_legacy(batch_keypoints, batch_heatmaps, 1)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for batch_keypoints in batches:
+        render_gt_heatmaps(batch_keypoints, batch_heatmaps, 1)
+    batched_time = time.perf_counter() - start
+
+    print('generate_gt_heatmap: {:.3f} ms/batch'.format(legacy_time * 1000 / args.num_batches))
+    print('render_gt_heatmaps:  {:.3f} ms/batch'.format(batched_time * 1000 / args.num_batches))
+    print('speedup: {:.2f}x'.format(legacy_time / batched_time))
+
+
+if __name__ == "__main__":
+    main()
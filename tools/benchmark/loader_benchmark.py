@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark training data loading with & without shared decoded image cache.
+Report image decode time per epoch in main process, then full epoch time
+with multi-process data loader, together with cache hit/miss counters and
+the decodes saved by image affinity shuffle (--image_affinity). Remote
+storage could be simulated with --read_latency, to check the byte prefetcher
+(--read_ahead) and local file cache (--local_cache_path)
+"""
+import os, sys, argparse
+import time
+import shutil
+import pickle
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from hourglass.data import hourglass_dataset
+from hourglass.loader import ParallelDataLoader
+from common.image_cache import SharedImageCache
+from common.prefetcher import BytePrefetcher, LocalFileCache
+from common.utils import get_classes, get_matchpoints
+
+
+def get_stats_string(image_cache):
+    if image_cache is None:
+        return ''
+    stats = image_cache.get_stats()
+    image_cache.reset_stats()
+    return 'hits {}, misses {}, evictions {}, used {:.1f}MB'.format(stats['hits'], stats['misses'], stats['evictions'], stats['used_bytes']/1024/1024)
+
+
+def get_sampler_string(dataset):
+    if dataset.sampler is None or dataset.sampler.get_stats() is None:
+        return ''
+    stats = dataset.sampler.get_stats()
+    return 'affinity saved {}/{} decodes'.format(stats['decodes_saved'], stats['samples'])
+
+
+def get_prefetcher_string(dataset):
+    if dataset.prefetcher is None:
+        return ''
+    stats = dataset.prefetcher.get_stats()
+    dataset.prefetcher.reset_stats()
+    return 'prefetch hits {}, waits {}, misses {}'.format(stats['hits'], stats['waits'], stats['misses'])
+
+
+def add_read_latency(dataset, latency):
+    # simulate remote storage by sleeping in every file read
+    read_image_file = dataset.read_image_file
+    def read_remote_image_file(img_path):
+        time.sleep(latency)
+        return read_image_file(img_path)
+    dataset.read_image_file = read_remote_image_file
+    if dataset.prefetcher is None:
+        # not scheduled prefetcher, just read files synchronously
+        dataset.prefetcher = BytePrefetcher(read_remote_image_file, max_items=1)
+    dataset.prefetcher.read_func = read_remote_image_file
+
+
+def check_pickled_prefetcher(dataset):
+    """
+    read a file through byte prefetcher & local cache of a pickled dataset,
+    like in a spawned loader worker, and check it matches the source file
+    """
+    img_path = dataset.get_annotations()[0]['img_paths']
+    worker_dataset = pickle.loads(pickle.dumps(dataset))
+    data = worker_dataset.prefetcher.get(img_path)
+    worker_dataset.prefetcher.close()
+    if data != dataset.read_image_file(img_path):
+        raise ValueError('file {} read by pickled prefetcher mismatch'.format(img_path))
+    print('pickled prefetcher & local cache check passed')
+
+
+def decode_benchmark(dataset, image_cache, epochs):
+    annotations = dataset.get_annotations()
+    for epoch in range(epochs):
+        dataset.on_epoch_end()
+        start = time.perf_counter()
+        # decode in batches, same as get_batch()
+        for i in range(len(dataset)):
+            if dataset.read_ahead > 0:
+                dataset.prefetch_batches(i, dataset.read_ahead + 1)
+            decoded_images = dict()
+            for annotation in annotations[i*dataset.batch_size:(i+1)*dataset.batch_size]:
+                dataset.load_image(annotation, decoded_images)
+        decode_time = time.perf_counter() - start
+        num_samples = len(dataset) * dataset.batch_size
+        print('  epoch {}: decode {:.3f}s ({:.2f}ms/sample) {} {} {}'.format(epoch, decode_time, decode_time*1000/num_samples, get_stats_string(image_cache), get_sampler_string(dataset), get_prefetcher_string(dataset)))
+
+
+def loader_benchmark(dataset, image_cache, epochs, workers):
+    loader = ParallelDataLoader(dataset, workers=workers, max_queue_size=10)
+    for epoch in range(epochs):
+        start = time.perf_counter()
+        for _ in range(len(loader)):
+            next(loader)
+        epoch_time = time.perf_counter() - start
+        print('  epoch {}: loader {:.3f}s ({:.2f}ms/batch) {} {} {}'.format(epoch, epoch_time, epoch_time*1000/len(loader), get_stats_string(image_cache), get_sampler_string(dataset), get_prefetcher_string(dataset)))
+    loader.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Benchmark data loading with shared decoded image cache')
+    parser.add_argument('--dataset_path', type=str, required=False, help='dataset path containing images and annotation file, default=%(default)s', default='data/mpii')
+    parser.add_argument('--classes_path', type=str, required=False, help='path to keypoint class definitions, default=%(default)s', default='configs/mpii_classes.txt')
+    parser.add_argument('--matchpoint_path', type=str, required=False, help='path to matching keypoint definitions for horizontal/vertical flipping image, default=%(default)s', default='configs/mpii_match_point.txt')
+    parser.add_argument('--model_input_shape', type=str, required=False, help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--batch_size', type=int, required=False, help='batch size for loader benchmark, default=%(default)s', default=16)
+    parser.add_argument('--workers', type=int, required=False, help='number of loader worker processes, 0 to skip loader benchmark. default=%(default)s', default=4)
+    parser.add_argument('--epochs', type=int, required=False, help='number of epochs to run, default=%(default)s', default=3)
+    parser.add_argument('--image_cache_size', type=float, required=False, help='size in MB of shared image cache, 0 to skip cache benchmark. default=%(default)s', default=1024)
+    parser.add_argument('--image_affinity', type=float, required=False, help='locality (0~1) of image affinity shuffle, default=%(default)s, plain random shuffle', default=None)
+    parser.add_argument('--read_ahead', type=int, required=False, help='number of batches to read image files ahead, default=%(default)s', default=0)
+    parser.add_argument('--local_cache_path', type=str, required=False, help='local dir to cache image files, removed before benchmark. default=%(default)s', default=None)
+    parser.add_argument('--read_latency', type=float, required=False, help='simulated remote storage latency in ms for every image file read, default=%(default)s', default=0)
+    args = parser.parse_args()
+
+    height, width = args.model_input_shape.split('x')
+    input_shape = (int(height), int(width))
+    class_names = get_classes(args.classes_path)
+    matchpoints = get_matchpoints(args.matchpoint_path) if args.matchpoint_path else None
+
+    for use_cache in [False, True] if args.image_cache_size > 0 else [False]:
+        image_cache = SharedImageCache(int(args.image_cache_size*1024*1024)) if use_cache else None
+        local_cache = None
+        if args.local_cache_path:
+            # start with an empty local cache
+            shutil.rmtree(args.local_cache_path, ignore_errors=True)
+            local_cache = LocalFileCache(args.local_cache_path, 1024*1024*1024)
+        dataset = hourglass_dataset(args.dataset_path, args.batch_size, class_names, input_shape=input_shape,
+                                    num_hgstack=1, is_train=True, with_meta=False, matchpoints=matchpoints,
+                                    image_cache=image_cache, image_affinity=args.image_affinity,
+                                    read_ahead=args.read_ahead, local_cache=local_cache)
+        if local_cache is not None:
+            check_pickled_prefetcher(dataset)
+        if args.read_latency > 0:
+            add_read_latency(dataset, args.read_latency / 1000)
+        print('{} image cache, {} samples:'.format('with' if use_cache else 'without', dataset.get_dataset_size()))
+        decode_benchmark(dataset, image_cache, args.epochs)
+
+        if args.workers > 0:
+            if image_cache is not None:
+                # start loader with a cold cache
+                image_cache.close()
+                image_cache = dataset.image_cache = SharedImageCache(int(args.image_cache_size*1024*1024))
+            loader_benchmark(dataset, image_cache, args.epochs, args.workers)
+
+        if image_cache is not None:
+            image_cache.close()
+        if dataset.prefetcher is not None:
+            dataset.prefetcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Profile training data loading without a model, to check whether training
+is input bound. Run N batches with a loader backend, then report samples/sec,
+per-stage time statistics & histograms (file read, decode, geometric augment,
+photometric augment, normalize and heatmap rendering), and the slowest
+samples by image path.
+"""
+import os, sys, argparse
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from hourglass.data import hourglass_dataset
+from hourglass.loader import ParallelDataLoader
+from hourglass.profiler import LoaderProfiler
+from common.utils import get_classes, get_matchpoints
+
+
+def get_batch_iterator(dataset, backend, workers):
+    """
+    get an endless batch iterator of the loader backend, and its stop function
+    """
+    if backend == 'sequence':
+        def sequence_iterator():
+            while True:
+                for i in range(len(dataset)):
+                    yield dataset[i]
+                dataset.on_epoch_end()
+        return sequence_iterator(), lambda: None
+    elif backend == 'parallel':
+        loader = ParallelDataLoader(dataset, workers=workers, max_queue_size=10)
+        return loader, loader.stop
+    elif backend == 'tf_data':
+        from hourglass.tfdata import get_tf_dataset
+        return iter(get_tf_dataset(dataset, repeat=True)), lambda: None
+    else:
+        raise ValueError('Unsupported loader backend', backend)
+
+
+def profile_loader(dataset, backend, num_batches, workers, warmup_batches):
+    iterator, stop = get_batch_iterator(dataset, backend, workers)
+    try:
+        # skip worker startup & cold file cache
+        for _ in range(warmup_batches):
+            next(iterator)
+        dataset.profiler.reset()
+
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            next(iterator)
+        elapsed = time.perf_counter() - start
+    finally:
+        stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Profile training data loading stages without model')
+    parser.add_argument('--dataset_path', type=str, required=False, help='dataset path containing images and annotation file, default=%(default)s', default='data/mpii')
+    parser.add_argument('--classes_path', type=str, required=False, help='path to keypoint class definitions, default=%(default)s', default='configs/mpii_classes.txt')
+    parser.add_argument('--matchpoint_path', type=str, required=False, help='path to matching keypoint definitions for horizontal/vertical flipping image, default=%(default)s', default='configs/mpii_match_point.txt')
+    parser.add_argument('--model_input_shape', type=str, required=False, help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--batch_size', type=int, required=False, help='batch size, default=%(default)s', default=16)
+    parser.add_argument('--backend', type=str, required=False, help='loader backend to profile, default=%(default)s', default='sequence', choices=['sequence', 'parallel', 'tf_data'])
+    parser.add_argument('--workers', type=int, required=False, help='number of worker processes for parallel backend, default=%(default)s', default=4)
+    parser.add_argument('--num_batches', type=int, required=False, help='number of batches to profile, default=%(default)s', default=100)
+    parser.add_argument('--warmup_batches', type=int, required=False, help='number of batches to run before profiling, default=%(default)s', default=2)
+    parser.add_argument('--num_slowest', type=int, required=False, help='number of slowest samples to report, default=%(default)s', default=10)
+    parser.add_argument('--read_ahead', type=int, required=False, help='number of batches to read image files ahead, default=%(default)s', default=0)
+    args = parser.parse_args()
+
+    height, width = args.model_input_shape.split('x')
+    input_shape = (int(height), int(width))
+    class_names = get_classes(args.classes_path)
+    matchpoints = get_matchpoints(args.matchpoint_path) if args.matchpoint_path else None
+
+    profiler = LoaderProfiler(num_slowest=args.num_slowest)
+    dataset = hourglass_dataset(args.dataset_path, args.batch_size, class_names, input_shape=input_shape,
+                                num_hgstack=1, is_train=True, with_meta=False, matchpoints=matchpoints,
+                                read_ahead=args.read_ahead, profiler=profiler)
+
+    elapsed = profile_loader(dataset, args.backend, args.num_batches, args.workers, args.warmup_batches)
+    print('{} backend, batch size {}:'.format(args.backend, args.batch_size))
+    print(profiler.format_report(elapsed, args.num_batches * args.batch_size))
+
+    if dataset.prefetcher is not None:
+        dataset.prefetcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark XLA (jit) compiled training step & inference against plain
+tf.function for Stacked Hourglass model variants (get_model_type()), with
+random weights & input. Also check XLA inference output matches, and the
+loss & gradients of a training step from same weights, against a float64
+reference (float32 gradients of plain tf.function are not exact either,
+so XLA & non-XLA gradients are not compared with each other).
+"""
+import os, sys, argparse
+import time
+import itertools
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from hourglass.model import get_hourglass_model
+from hourglass.loss import get_loss
+from hourglass.trainer import HourglassTrainer
+from common.model_utils import get_optimizer, XLAPredictor
+from common.utils import get_model_type
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+
+def benchmark_inference(model, jit_compile, num_runs, warmup_runs=3):
+    """
+    batch 1 inference latency in ms, and final stack output
+    """
+    predictor = XLAPredictor(model, jit_compile=jit_compile)
+    image_data = np.random.RandomState(0).rand(1, *model.input_shape[1:]).astype(np.float32)
+    for _ in range(warmup_runs):
+        prediction = predictor.predict(image_data)
+
+    latency = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        predictor.predict(image_data)
+        latency.append(time.perf_counter() - start)
+    if isinstance(prediction, list):
+        prediction = prediction[-1]
+    return np.array(latency) * 1000, prediction, predictor.jit_compile
+
+
+def get_train_batch(model, batch_size):
+    """
+    random float64 input images & gt heatmaps of a training batch
+    """
+    random_state = np.random.RandomState(0)
+    images = random_state.rand(batch_size, *model.input_shape[1:])
+    heatmaps = random_state.rand(batch_size, *model.outputs[-1].shape[1:])
+    return images, heatmaps
+
+
+def get_reference_gradients(model_kwargs, weights, images, heatmaps):
+    """
+    loss & gradients of a training step on a float64 copy of the model
+    """
+    floatx = tf.keras.backend.floatx()
+    tf.keras.backend.set_floatx('float64')
+    try:
+        model = get_hourglass_model(**model_kwargs)
+    finally:
+        tf.keras.backend.set_floatx(floatx)
+    model.set_weights([weight.astype(np.float64) for weight in weights])
+
+    loss_func = get_loss('mse')
+    with tf.GradientTape() as tape:
+        y_pred = model(images, training=True)
+        if not isinstance(y_pred, list):
+            y_pred = [y_pred]
+        loss = tf.add_n([tf.reduce_mean(loss_func(heatmaps, stack_pred)) for stack_pred in y_pred])
+    gradients = tape.gradient(loss, model.trainable_variables)
+    return float(loss), [gradient.numpy() for gradient in gradients]
+
+
+def check_train_parity(model, jit_compile, images, heatmaps, reference_loss, reference_gradients):
+    """
+    loss diff & relative gradient error (global norm) of a training step
+    of HourglassTrainer, against the float64 reference
+    """
+    num_stacks = len(model.outputs)
+    batch = (tf.constant(images, tf.float32), tuple([tf.constant(heatmaps, tf.float32)] * num_stacks))
+
+    optimizer = get_optimizer('rmsprop', 5e-4, decay_type=None)
+    trainer = HourglassTrainer(model, optimizer, get_loss('mse'), jit_compile=jit_compile)
+    trainer.make_train_function()
+    gradients = trainer.get_gradients(batch)
+    loss = float(trainer.loss_metrics[0].result())
+
+    error = np.sqrt(sum(np.sum(np.square(gradient.numpy() - reference)) for gradient, reference in zip(gradients, reference_gradients)))
+    norm = np.sqrt(sum(np.sum(np.square(reference)) for reference in reference_gradients))
+    return abs(loss - reference_loss), error / norm
+
+
+def benchmark_train(model, jit_compile, batch_size, num_steps):
+    """
+    mean training step time in ms, timed on second epoch
+    """
+    num_stacks = len(model.outputs)
+    images = tf.random.uniform((batch_size,) + tuple(model.input_shape[1:]))
+    heatmaps = tf.random.uniform((batch_size,) + tuple(model.outputs[-1].shape[1:]))
+    dataset = tf.data.Dataset.from_tensors((images, tuple([heatmaps] * num_stacks))).repeat()
+
+    optimizer = get_optimizer('rmsprop', 5e-4, decay_type=None)
+    trainer = HourglassTrainer(model, optimizer, get_loss('mse'), jit_compile=jit_compile)
+    history = trainer.fit(dataset, steps_per_epoch=num_steps, epochs=2, verbose=0)
+    return history.history['step_time'][-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Benchmark XLA compiled training step & inference of hourglass model variants')
+    parser.add_argument('--num_stacks', type=str, required=False, help='comma separated hourglass stack numbers, default=%(default)s', default='1,2')
+    parser.add_argument('--model_input_shape', type=str, required=False, help='comma separated model input shapes as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--num_classes', type=int, required=False, help='number of keypoint classes, default=%(default)s', default=16)
+    parser.add_argument('--batch_size', type=int, required=False, help='batch size for training step, default=%(default)s', default=4)
+    parser.add_argument('--num_steps', type=int, required=False, help='number of training steps to time, default=%(default)s', default=10)
+    parser.add_argument('--num_runs', type=int, required=False, help='number of inference runs to time, default=%(default)s', default=30)
+    parser.add_argument('--skip_train', default=False, action="store_true", help='only benchmark inference')
+    args = parser.parse_args()
+
+    num_stacks_list = [int(num_stacks) for num_stacks in args.num_stacks.split(',')]
+    input_shapes = [tuple(int(dim) for dim in input_shape.split('x')) for input_shape in args.model_input_shape.split(',')]
+
+    results = []
+    for num_stacks, mobile, tiny, input_shape in itertools.product(num_stacks_list, [False, True], [False, True], input_shapes):
+        model_type = get_model_type(num_stacks, mobile, tiny, input_shape)
+        num_channels = 128 if tiny else 256
+        model_kwargs = {'num_classes': args.num_classes, 'num_stacks': num_stacks, 'num_channels': num_channels,
+                        'model_input_shape': input_shape, 'mobile': mobile}
+        model = get_hourglass_model(**model_kwargs)
+        weights = model.get_weights()
+
+        result = {'model_type': model_type}
+        latency, graph_prediction, _ = benchmark_inference(model, False, args.num_runs)
+        result['latency_graph'] = float(np.mean(latency))
+        latency, xla_prediction, result['xla_used'] = benchmark_inference(model, True, args.num_runs)
+        result['latency_xla'] = float(np.mean(latency))
+        result['max_diff'] = float(np.max(np.abs(xla_prediction - graph_prediction)))
+
+        if not args.skip_train:
+            images, heatmaps = get_train_batch(model, args.batch_size)
+            reference_loss, reference_gradients = get_reference_gradients(model_kwargs, weights, images, heatmaps)
+            for jit_compile in [False, True]:
+                name = 'xla' if jit_compile else 'graph'
+                model.set_weights(weights)
+                result['loss_diff_' + name], result['grad_err_' + name] = check_train_parity(model, jit_compile, images, heatmaps, reference_loss, reference_gradients)
+                model.set_weights(weights)
+                result['step_' + name] = benchmark_train(model, jit_compile, args.batch_size, args.num_steps)
+        print(result)
+        results.append(result)
+        tf.keras.backend.clear_session()
+
+    # max diff: XLA vs non-XLA inference output. grad err: relative
+    # gradient error of a training step against float64 reference
+    print('\n{:<28}{:>14}{:>14}{:>9}{:>14}{:>14}{:>9}{:>12}{:>12}{:>12}'.format('model type', 'infer(ms)', 'infer xla', 'speedup', 'step(ms)', 'step xla', 'speedup', 'max diff', 'grad err', 'grad xla'))
+    for result in results:
+        line = '{:<28}{:>14.2f}{:>14.2f}{:>8.2f}x'.format(result['model_type'], result['latency_graph'], result['latency_xla'], result['latency_graph'] / result['latency_xla'])
+        if 'step_graph' in result:
+            line += '{:>14.2f}{:>14.2f}{:>8.2f}x'.format(result['step_graph'], result['step_xla'], result['step_graph'] / result['step_xla'])
+        else:
+            line += '{:>14}{:>14}{:>9}'.format('-', '-', '-')
+        line += '{:>12.2e}'.format(result['max_diff'])
+        if 'grad_err_graph' in result:
+            line += '{:>12.2e}{:>12.2e}'.format(result['grad_err_graph'], result['grad_err_xla'])
+        else:
+            line += '{:>12}{:>12}'.format('-', '-')
+        if not result['xla_used']:
+            line += ' (XLA fallback)'
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Materialize person crops of a dataset (images/ + annotations.json) into a
+new dataset, which could be used by hourglass_dataset like the origin one.
+
+Each person record is cropped around its (adjusted) center with enough
+margin for the max random scale & rotate augment, and stored at a capped
+resolution which is still no less than the model input resolution with
+the smallest random scale. Keypoints, center, scale & headboxes in the
+annotation are rewritten to the crop image reference, so training get
+same augment space with much smaller images to decode & crop.
+"""
+import os, sys, argparse
+import json
+import numpy as np
+import cv2
+from PIL import Image
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from common.data_utils import MPII_SCALE_REFERENCE
+
+
+def get_crop_margin(max_scale, max_rotate):
+    """
+    crop size ratio to cover the object square with max
+    random scale, rotated with max random rotate angle
+    """
+    angle = np.deg2rad(max_rotate)
+    return max_scale * (np.cos(angle) + np.sin(angle))
+
+
+def get_center_scale(annotation):
+    # same adjustment as hourglass_dataset.get_center_scale()
+    center = np.array(annotation['objpos'])
+    scale = annotation['scale_provided']
+    center[1] = center[1] + 15 * scale
+    scale = scale * 1.25
+    return center, scale
+
+
+def get_crop_box(annotation, crop_margin, input_size, min_scale):
+    """
+    get square crop box (x, y, size) on origin image, and
+    the resized crop size for an annotation record
+    """
+    center, scale = get_center_scale(annotation)
+    object_size = scale * MPII_SCALE_REFERENCE
+
+    box_size = int(np.ceil(object_size * crop_margin))
+    box_x = int(np.round(center[0] - box_size / 2))
+    box_y = int(np.round(center[1] - box_size / 2))
+
+    # model input will show at most (object_size * min_scale)
+    # of origin image, so don't keep more pixels than that
+    resize_ratio = min(1.0, input_size / (object_size * min_scale))
+    crop_size = max(1, int(np.ceil(box_size * resize_ratio)))
+    return box_x, box_y, box_size, crop_size
+
+
+def crop_box(image, box_x, box_y, box_size, crop_size):
+    # pad with 0 for area out of image, same as affine crop border
+    height, width = image.shape[0:2]
+    x0, y0 = max(box_x, 0), max(box_y, 0)
+    x1, y1 = min(box_x + box_size, width), min(box_y + box_size, height)
+
+    box_image = np.zeros((box_size, box_size, 3), dtype=np.uint8)
+    if x1 > x0 and y1 > y0:
+        box_image[y0-box_y:y1-box_y, x0-box_x:x1-box_x] = image[y0:y1, x0:x1]
+
+    if crop_size != box_size:
+        box_image = cv2.resize(box_image, (crop_size, crop_size), interpolation=cv2.INTER_AREA)
+    return box_image
+
+
+def transform_points(points, box_x, box_y, resize_ratio):
+    # map points to the resized crop, on continuous
+    # coordinate (pixel i cover [i, i+1)) like get_crop_matrix()
+    points = np.array(points, dtype=np.float64)
+    points[..., 0] = (points[..., 0] - box_x) * resize_ratio
+    points[..., 1] = (points[..., 1] - box_y) * resize_ratio
+    return points
+
+
+def rewrite_annotation(annotation, img_path, box_x, box_y, box_size, crop_size):
+    resize_ratio = crop_size / box_size
+    new_annotation = dict(annotation)
+    new_annotation['img_paths'] = img_path
+    new_annotation['origin_img_paths'] = annotation['img_paths']
+    new_annotation['img_width'] = float(crop_size)
+    new_annotation['img_height'] = float(crop_size)
+
+    keypoints = np.array(annotation['joint_self'], dtype=np.float64)
+    valid = (keypoints[:, 0] > 0) & (keypoints[:, 1] > 0)
+    new_keypoints = transform_points(keypoints, box_x, box_y, resize_ratio)
+    # keypoints out of crop box is also out of model input
+    valid = valid & (new_keypoints[:, 0] > 0) & (new_keypoints[:, 1] > 0) & (new_keypoints[:, 0] < crop_size) & (new_keypoints[:, 1] < crop_size)
+    new_keypoints[~valid] = [-1.0, -1.0, 0.0]
+    new_annotation['joint_self'] = new_keypoints.tolist()
+
+    new_annotation['objpos'] = transform_points(annotation['objpos'], box_x, box_y, resize_ratio).tolist()
+    new_annotation['scale_provided'] = annotation['scale_provided'] * resize_ratio
+    if 'headboxes' in annotation:
+        new_annotation['headboxes'] = transform_points(annotation['headboxes'], box_x, box_y, resize_ratio).tolist()
+    return new_annotation
+
+
+def materialize_dataset(dataset_path, output_path, input_size, min_scale, max_scale, max_rotate, jpeg_quality):
+    with open(os.path.join(dataset_path, 'annotations.json')) as anno_file:
+        annotations = json.load(anno_file)
+
+    os.makedirs(os.path.join(output_path, 'images'), exist_ok=True)
+    crop_margin = get_crop_margin(max_scale, max_rotate)
+
+    new_annotations = []
+    image, image_path = None, None
+    skipped = 0
+    for i, annotation in enumerate(tqdm(annotations, desc='Crop objects')):
+        if annotation['objpos'][0] == -1:
+            # no object center to crop around
+            skipped += 1
+            continue
+
+        # records of one image are mostly continuous, so
+        # only decode the image once for them
+        if annotation['img_paths'] != image_path:
+            image_path = annotation['img_paths']
+            image = np.array(Image.open(os.path.join(dataset_path, 'images', image_path)).convert('RGB'))
+
+        box_x, box_y, box_size, crop_size = get_crop_box(annotation, crop_margin, input_size, min_scale)
+        crop_image = crop_box(image, box_x, box_y, box_size, crop_size)
+
+        crop_path = '{}_{:06d}.jpg'.format(os.path.splitext(os.path.basename(image_path))[0], i)
+        Image.fromarray(crop_image).save(os.path.join(output_path, 'images', crop_path), quality=jpeg_quality)
+        new_annotations.append(rewrite_annotation(annotation, crop_path, box_x, box_y, box_size, crop_size))
+
+    with open(os.path.join(output_path, 'annotations.json'), 'w') as anno_file:
+        json.dump(new_annotations, anno_file)
+    return len(new_annotations), skipped
+
+
+def verify_dataset(dataset_path, output_path, class_names, input_shape, num_samples):
+    """
+    run same random augment on origin & materialized dataset records,
+    and compare the model input images & transformed keypoints
+    """
+    import random
+    from hourglass.data import hourglass_dataset
+
+    origin_dataset = hourglass_dataset(dataset_path, 1, class_names, input_shape=input_shape, num_hgstack=1, is_train=True)
+    crop_dataset = hourglass_dataset(output_path, 1, class_names, input_shape=input_shape, num_hgstack=1, is_train=True)
+    # materialized records keep origin order, except the skipped ones
+    origin_annotations = [annotation for annotation in origin_dataset.get_annotations() if annotation['objpos'][0] != -1]
+    crop_annotations = crop_dataset.get_annotations()
+
+    image_diffs, keypoint_diffs = [], []
+    for i in np.random.permutation(len(crop_annotations))[:num_samples]:
+        seed = np.random.randint(2**31)
+        results = []
+        for dataset, annotation in [(origin_dataset, origin_annotations[i]), (crop_dataset, crop_annotations[i])]:
+            np.random.seed(seed)
+            random.seed(seed)
+            image, _, meta = dataset.process_image(0, annotation, with_heatmap=False)
+            results.append((image, meta['tpts']))
+
+        # image diff in 0~255 pixel value
+        image_diffs.append(np.mean(np.abs(results[0][0] - results[1][0])) * 255)
+        valid = (results[0][1][:, 2] > 0) & (results[1][1][:, 2] > 0)
+        if np.any(valid):
+            keypoint_diffs.append(np.mean(np.abs(results[0][1][valid, 0:2] - results[1][1][valid, 0:2])))
+    return np.mean(image_diffs), np.mean(keypoint_diffs) if keypoint_diffs else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Materialize person crops of dataset for faster training')
+    parser.add_argument('--dataset_path', type=str, required=True, help='dataset path containing images and annotation file')
+    parser.add_argument('--output_path', type=str, required=True, help='output path for materialized dataset')
+    parser.add_argument('--model_input_shape', type=str, required=False, help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--scale_range', type=str, required=False, help='random scale augment range as <min>,<max>, default=%(default)s', default='0.8,1.2')
+    parser.add_argument('--rotate_range', type=float, required=False, help='max random rotate angle in degree, default=%(default)s', default=30)
+    parser.add_argument('--jpeg_quality', type=int, required=False, help='JPEG quality of crop images, default=%(default)s', default=95)
+    parser.add_argument('--classes_path', type=str, required=False, help='path to keypoint class definitions, for verify. default=%(default)s', default='configs/mpii_classes.txt')
+    parser.add_argument('--verify', type=int, required=False, help='number of records to compare augmented sample with origin dataset, default=%(default)s', default=0)
+    args = parser.parse_args()
+
+    height, width = args.model_input_shape.split('x')
+    input_shape = (int(height), int(width))
+    min_scale, max_scale = [float(x) for x in args.scale_range.split(',')]
+
+    num_records, skipped = materialize_dataset(args.dataset_path, args.output_path, max(input_shape), min_scale, max_scale, args.rotate_range, args.jpeg_quality)
+    print('Done. materialized {} records ({} skipped without center) in {}'.format(num_records, skipped, args.output_path))
+
+    if args.verify > 0:
+        from common.utils import get_classes
+        image_diff, keypoint_diff = verify_dataset(args.dataset_path, args.output_path, get_classes(args.classes_path), input_shape, args.verify)
+        print('verify finished, mean image diff {:.3f}, mean keypoint diff {:.3f}'.format(image_diff, keypoint_diff))
+
+
+if __name__ == '__main__':
+    main()
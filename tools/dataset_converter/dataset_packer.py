@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pack a dataset (images/ + annotations.json) into a few large shard files
+with an offset index, which could be read by hourglass_dataset with mmap.
+Images are packed in annotation order, so records of one shard are mostly
+contiguous and could be shuffled shard-locally.
+"""
+import os, sys, argparse
+import shutil
+from tqdm import tqdm
+import json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from common.shard_utils import ShardWriter, ShardReader
+
+
+def pack_dataset(dataset_path, output_path, shard_size):
+    with open(os.path.join(dataset_path, 'annotations.json')) as anno_file:
+        annotations = json.load(anno_file)
+
+    os.makedirs(output_path, exist_ok=True)
+    # annotation file is kept unchanged
+    shutil.copyfile(os.path.join(dataset_path, 'annotations.json'), os.path.join(output_path, 'annotations.json'))
+
+    shard_writer = ShardWriter(output_path, shard_size)
+    for annotation in tqdm(annotations, desc='Pack images'):
+        img_path = annotation['img_paths']
+        # images may be shared by several person records
+        if img_path in shard_writer:
+            continue
+        with open(os.path.join(dataset_path, 'images', img_path), 'rb') as image_file:
+            shard_writer.write(img_path, image_file.read())
+    shard_writer.close()
+
+    return len(shard_writer.shards), len(shard_writer.images)
+
+
+def verify_dataset(dataset_path, output_path):
+    shard_reader = ShardReader(output_path)
+    mismatch = 0
+    for img_path in tqdm(shard_reader.images, desc='Verify images'):
+        with open(os.path.join(dataset_path, 'images', img_path), 'rb') as image_file:
+            if shard_reader.read(img_path) != image_file.read():
+                mismatch += 1
+    shard_reader.close()
+    return mismatch
+
+
+def main():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Pack dataset images & annotations into shard files')
+    parser.add_argument('--dataset_path', type=str, required=True, help='dataset path containing images and annotation file')
+    parser.add_argument('--output_path', type=str, required=True, help='output path for packed dataset')
+    parser.add_argument('--shard_size', type=float, required=False, help='max size of each shard file in MB, default=%(default)s', default=512)
+    parser.add_argument('--verify', default=False, action="store_true", help='read back packed images and compare with origin files')
+    args = parser.parse_args()
+
+    num_shards, num_images = pack_dataset(args.dataset_path, args.output_path, int(args.shard_size*1024*1024))
+    print('Done. packed {} images into {} shards in {}'.format(num_images, num_shards, args.output_path))
+
+    if args.verify:
+        mismatch = verify_dataset(args.dataset_path, args.output_path)
+        print('verify finished, {} mismatch images'.format(mismatch))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,42 @@
 test data argument process
 """
 import os, sys, argparse
+import numpy as np
 import cv2
 from PIL import Image
 from tqdm import tqdm
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
 from hourglass.data import hourglass_dataset, HG_OUTPUT_STRIDE
-from common.data_utils import denormalize_image
+from common.data_utils import denormalize_image, random_brightness, random_chroma, random_contrast, random_sharpness, random_grayscale, random_blur, random_histeq, random_photometric
 from common.utils import get_classes, get_skeleton, render_skeleton
 
 
+def photometric_compare(data_generator, output_path, num_images):
+    """
+    apply legacy PIL photometric augment chain and the fused random_photometric()
+    on same origin image with same random seed, save them side by side and
+    report pixel difference
+    """
+    annotations = data_generator.get_annotations()
+    pixel_diffs = []
+    for i in tqdm(range(min(num_images, len(annotations))), desc='Compare photometric augment'):
+        image = np.array(Image.open(os.path.join(data_generator.image_path, annotations[i]['img_paths'])).convert('RGB'))
+
+        np.random.seed(i)
+        legacy_image = image
+        for augment in [random_brightness, random_chroma, random_contrast, random_sharpness, random_grayscale, random_blur, random_histeq]:
+            legacy_image = augment(legacy_image)
+
+        np.random.seed(i)
+        fused_image = random_photometric(image)
+
+        pixel_diffs.append(np.mean(np.abs(legacy_image.astype(np.float32) - fused_image.astype(np.float32))))
+        Image.fromarray(np.concatenate([image, legacy_image, fused_image], axis=1)).save(os.path.join(output_path, 'photometric_'+str(i)+'.jpg'))
+
+    print('mean pixel difference between legacy & fused photometric augment: {:.3f}'.format(np.mean(pixel_diffs)))
+
+
 def main():
     parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS, description='Test tool for data augment process')
     parser.add_argument('--dataset_path', type=str, required=True, help='dataset path containing images and annotation file')
@@ -23,6 +49,7 @@ def main():
     parser.add_argument('--output_path', type=str, required=False,  help='output path for augmented images, default=%(default)s', default='./test')
     parser.add_argument('--batch_size', type=int, required=False, help = "batch size for test data, default=%(default)s", default=16)
     parser.add_argument('--model_input_shape', type=str, required=False, help='model image input shape as <height>x<width>, default=%(default)s', default='256x256')
+    parser.add_argument('--photometric_compare', default=False, action="store_true", help='compare legacy & fused photometric augment (origin|legacy|fused) instead of full augment')
 
     args = parser.parse_args()
 
@@ -39,6 +66,10 @@ def main():
     # prepare train dataset (having augmented data process)
     data_generator = hourglass_dataset(args.dataset_path, batch_size=1, class_names=class_names, input_shape=model_input_shape, num_hgstack=1, is_train=True, with_meta=True)
 
+    if args.photometric_compare:
+        photometric_compare(data_generator, args.output_path, args.batch_size)
+        return
+
     pbar = tqdm(total=args.batch_size, desc='Generate augment image')
     for i, (image_data, gt_heatmap, metainfo) in enumerate(data_generator):
         if i >= args.batch_size:
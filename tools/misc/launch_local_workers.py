@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Launch a multi-worker training on local host, to try out or debug the
+MultiWorkerMirroredStrategy training without a CPU cluster. N worker
+processes are started with a localhost cluster spec on free ports, like:
+
+    python tools/misc/launch_local_workers.py --num_workers 2 train.py --batch_size 4 ...
+
+which runs "train.py ... --cluster_spec localhost:<port0>,localhost:<port1>
+--task_index <i>" for every worker. Output lines are prefixed with worker index.
+"""
+import sys, argparse
+import socket
+import subprocess
+import threading
+
+
+def get_free_ports(num_ports):
+    """
+    pick free localhost ports, keep sockets open until all
+    are picked to avoid getting same port twice
+    """
+    sockets = []
+    for _ in range(num_ports):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def forward_output(process, prefix):
+    for line in iter(process.stdout.readline, b''):
+        sys.stdout.write(prefix + line.decode('utf-8', errors='replace'))
+        sys.stdout.flush()
+
+
+def launch_workers(num_workers, script_args):
+    cluster_spec = ','.join('localhost:{}'.format(port) for port in get_free_ports(num_workers))
+    print('Launch {} workers with cluster spec {}'.format(num_workers, cluster_spec))
+
+    processes, threads = [], []
+    for task_index in range(num_workers):
+        command = [sys.executable] + script_args + ['--cluster_spec', cluster_spec, '--task_index', str(task_index)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        thread = threading.Thread(target=forward_output, args=(process, '[worker {}] '.format(task_index)), daemon=True)
+        thread.start()
+        processes.append(process)
+        threads.append(thread)
+
+    try:
+        return_codes = [process.wait() for process in processes]
+    except KeyboardInterrupt:
+        # workers block in collective ops once one exits, so stop them all
+        for process in processes:
+            process.terminate()
+        return_codes = [process.wait() for process in processes]
+    for thread in threads:
+        thread.join()
+    return return_codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch multi-worker training processes on local host')
+    parser.add_argument('--num_workers', type=int, required=False, help='number of worker processes, default=%(default)s', default=2)
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='training script and its arguments, like "train.py --batch_size 4"')
+    args = parser.parse_args()
+
+    if not args.script_args:
+        parser.error('training script is required')
+
+    return_codes = launch_workers(args.num_workers, args.script_args)
+    print('Worker exit codes: {}'.format(return_codes))
+    sys.exit(max(return_codes, key=abs))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,23 +7,67 @@ from tensorflow.keras.callbacks import TensorBoard, TerminateOnNaN
 
 from hourglass.model import get_hourglass_model
 from hourglass.data import hourglass_dataset
-from hourglass.loss import get_loss
-from hourglass.callbacks import EvalCallBack, CheckpointCleanCallBack
+from hourglass.loader import ParallelDataLoader
+from hourglass.tfdata import get_tf_dataset
+from hourglass.loss import get_loss, get_keypoint_target_loss
+from hourglass.callbacks import EvalCallBack, LoaderProfileCallBack
+from hourglass.profiler import LoaderProfiler
+from hourglass.checkpoint import StateCheckpointer, AsyncCheckpointWriter, get_latest_state, load_training_state
+from hourglass.autotune import get_loader_config
+from hourglass.trainer import HourglassTrainer, get_multi_worker_strategy, get_num_workers, is_chief, get_local_model
 from common.utils import get_classes, get_matchpoints, get_model_type, optimize_tf_gpu
 from common.model_utils import get_optimizer
+from common.image_cache import SharedImageCache
+from common.prefetcher import LocalFileCache
 
 # Try to enable Auto Mixed Precision on TF 2.0
 os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
 os.environ['TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_IGNORE_PERFORMANCE'] = '1'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+import numpy as np
 import tensorflow as tf
 optimize_tf_gpu(tf, K)
 
 
 def main(args):
+    # multi-worker data parallel training on CPU nodes. strategy
+    # should be created before any other TF op
+    if args.cluster_spec:
+        strategy = get_multi_worker_strategy(args.cluster_spec, args.task_index)
+    else:
+        strategy = None
+    num_workers = get_num_workers(strategy)
+    # evaluation, checkpoints & logs are only on chief worker
+    chief = is_chief(strategy)
+
     log_dir = 'logs/000'
-    os.makedirs(log_dir, exist_ok=True)
+    if chief:
+        os.makedirs(log_dir, exist_ok=True)
+
+    # training state to resume, which also has the train data shuffle seed
+    state_dir = os.path.join(log_dir, 'state')
+    resume_state = None
+    if args.resume:
+        state_path = get_latest_state(state_dir)
+        if state_path:
+            resume_state = load_training_state(state_path)
+            print('Load training state {}.'.format(state_path))
+        else:
+            print('No training state in {}, start new training.'.format(state_dir))
+
+    # seed of train data shuffle & augment. pick a random one for new
+    # training, and reuse the saved one to resume exactly
+    if resume_state is not None and 'shuffle_seed' in resume_state:
+        shuffle_seed = resume_state['shuffle_seed']
+    elif args.shuffle_seed is not None:
+        shuffle_seed = args.shuffle_seed
+    elif num_workers > 1:
+        # all workers need same shuffle order to take disjoint data shards
+        shuffle_seed = 0
+    else:
+        shuffle_seed = int.from_bytes(os.urandom(4), 'little')
+    print('Train data shuffle seed {}.'.format(shuffle_seed))
 
     class_names = get_classes(args.classes_path)
     num_classes = len(class_names)
@@ -50,44 +94,124 @@ def main(args):
             raise ValueError('Tensorflow {} does not support mixed precision'.format(tf.__version__))
 
 
-    # get train/val dataset
-    train_generator = hourglass_dataset(args.dataset_path, args.batch_size, class_names,
-                                        input_shape=args.model_input_shape,
-                                        num_hgstack=args.num_stacks,
-                                        is_train=True,
-                                        with_meta=False,
-                                        matchpoints=matchpoints)
+    # local disk cache for image files on remote storage
+    if args.local_cache_path:
+        local_cache = LocalFileCache(args.local_cache_path, int(args.local_cache_size*1024*1024))
+    else:
+        local_cache = None
+
+    # training dataset options except the loader settings
+    dataset_kwargs = {'dataset_path': args.dataset_path,
+                      'batch_size': args.batch_size,
+                      'class_names': class_names,
+                      'input_shape': args.model_input_shape,
+                      'num_hgstack': args.num_stacks,
+                      'is_train': True,
+                      'with_meta': False,
+                      'matchpoints': matchpoints,
+                      'image_affinity': args.image_affinity,
+                      'shard_local_shuffle': not args.global_shuffle,
+                      'single_target': args.single_target,
+                      'keypoint_target': args.keypoint_target,
+                      'local_cache': local_cache,
+                      # every worker read a disjoint shard of train set
+                      'num_data_shards': num_workers,
+                      'data_shard_index': args.task_index,
+                      # shuffle & augment seeded with shuffle_seed, epoch &
+                      # batch index, to reproduce them for exact resume
+                      'shuffle_seed': shuffle_seed,
+                      'deterministic': True}
+
+    # pick loader settings with timed trials on this host, or reuse tuned ones
+    if args.autotune and not args.tf_data:
+        loader_config = get_loader_config(dataset_kwargs, int(args.autotune_memory*1024*1024))
+        args.workers = loader_config['workers']
+        args.max_queue_size = loader_config['max_queue_size']
+        args.read_ahead = loader_config['read_ahead']
+        args.image_cache_size = loader_config['image_cache_size']
+
+    # shared decoded image cache for loader workers & eval callback
+    if args.image_cache_size > 0:
+        image_cache = SharedImageCache(int(args.image_cache_size*1024*1024))
+    else:
+        image_cache = None
+
+    # profile training data loading stages
+    loader_profiler = LoaderProfiler() if args.profile_loader > 0 else None
+
+    # get train/val dataset. trained in process, batches are fed in batch
+    # slots without copy, so hold a slot for each of one training call
+    in_process = not args.tf_data and args.workers <= 1
+    train_generator = hourglass_dataset(image_cache=image_cache,
+                                        read_ahead=args.read_ahead,
+                                        profiler=loader_profiler,
+                                        num_batch_slots=args.steps_per_execution*args.accumulation_steps+2 if in_process else 1,
+                                        **dataset_kwargs)
+
+    # use tf.data pipeline, or multi-process loader to spread sample processing over worker processes
+    if args.tf_data:
+        train_loader = get_tf_dataset(train_generator, batch_augment=args.batch_augment)
+    elif args.workers > 1:
+        train_loader = ParallelDataLoader(train_generator, workers=args.workers, max_queue_size=args.max_queue_size)
+    else:
+        train_loader = train_generator
 
     num_train = train_generator.get_dataset_size()
     num_val = len(train_generator.get_val_annotations())
 
     model_type = get_model_type(args.num_stacks, args.mobile, args.tiny, args.model_input_shape)
 
+    # model & training state checkpoints are serialized, fsync-ed
+    # and cleaned up on a background thread, to not stall training
+    checkpoint_writer = AsyncCheckpointWriter(max_in_flight=2)
+
     # callbacks for training process
-    tensorboard = TensorBoard(log_dir=log_dir, histogram_freq=0, write_graph=False, write_grads=False, write_images=False, update_freq='batch')
-    eval_callback = EvalCallBack(log_dir, args.dataset_path, class_names, args.model_input_shape, model_type)
-    checkpoint_clean = CheckpointCleanCallBack(log_dir, max_val_keep=5)
     terminate_on_nan = TerminateOnNaN()
+    if chief:
+        tensorboard = TensorBoard(log_dir=log_dir, histogram_freq=0, write_graph=False, write_grads=False, write_images=False, update_freq='batch')
+        eval_callback = EvalCallBack(log_dir, args.dataset_path, class_names, args.model_input_shape, model_type, image_cache=image_cache,
+                                     checkpoint_writer=checkpoint_writer, max_val_keep=5,
+                                     val_cache=args.val_cache, val_cache_path=args.val_cache_path)
 
-    callbacks = [tensorboard, eval_callback, terminate_on_nan, checkpoint_clean]
+        callbacks = [tensorboard, eval_callback, terminate_on_nan]
+        if loader_profiler is not None:
+            callbacks.append(LoaderProfileCallBack(log_dir, loader_profiler, log_freq=args.profile_loader))
+    else:
+        callbacks = [terminate_on_nan]
+
+    # batch_size is per worker in multi-worker training, and
+    # learning rate is scaled with the global batch size
+    global_batch_size = args.batch_size * num_workers
+    if args.lr_scaling == 'linear':
+        learning_rate = args.learning_rate * num_workers
+    elif args.lr_scaling == 'sqrt':
+        learning_rate = args.learning_rate * np.sqrt(num_workers)
+    else:
+        learning_rate = args.learning_rate
 
-    # prepare optimizer
+    # prepare optimizer, decay with optimizer steps, which
+    # is fewer than batches with gradient accumulation.
+    # num_train is the data shard size of one worker
     steps_per_epoch = max(1, num_train//args.batch_size)
-    decay_steps = steps_per_epoch * (args.total_epoch - args.init_epoch)
-    optimizer = get_optimizer(args.optimizer, args.learning_rate, decay_type=args.decay_type, decay_steps=decay_steps)
+    decay_steps = max(1, steps_per_epoch // args.accumulation_steps) * (args.total_epoch - args.init_epoch)
+    optimizer = get_optimizer(args.optimizer, learning_rate, decay_type=args.decay_type, decay_steps=decay_steps)
     #optimizer = RMSprop(lr=5e-4)
 
     # prepare loss function
     loss_func = get_loss(args.loss_type)
+    if args.keypoint_target:
+        # render gt heatmaps from keypoint target in loss
+        loss_func = get_keypoint_target_loss(loss_func, train_generator.output_shape)
 
     # support multi-gpu training
-    if args.gpu_num >= 2:
+    if args.gpu_num >= 2 and strategy is None:
         # devices_list=["/gpu:0", "/gpu:1"]
         devices_list=["/gpu:{}".format(n) for n in range(args.gpu_num)]
         strategy = tf.distribute.MirroredStrategy(devices=devices_list)
-        print ('Number of devices: {}'.format(strategy.num_replicas_in_sync))
+    if strategy is not None:
+        print ('Number of devices: {}, workers: {}'.format(strategy.num_replicas_in_sync, num_workers))
         with strategy.scope():
-            # get multi-gpu train model. you can also use "model_input_shape=None" to create a dynamic input shape model,
+            # get multi-gpu/multi-worker train model. you can also use "model_input_shape=None" to create a dynamic input shape model,
             # but multiscale train/inference doesn't work for it
             model = get_hourglass_model(num_classes, args.num_stacks, num_channels, model_input_shape=args.model_input_shape, mobile=args.mobile)
             # compile model
@@ -106,18 +230,41 @@ def main(args):
         model.load_weights(args.weights_path, by_name=True)#, skip_mismatch=True)
         print('Load weights {}.'.format(args.weights_path))
 
+    # full training state checkpoints, to resume exactly after preemption
+    checkpointer = StateCheckpointer(state_dir, save_freq=args.checkpoint_steps, max_keep=2, is_writer=chief, save_on_signal=(num_workers == 1), writer=checkpoint_writer,
+                                     extra_state={'shuffle_seed': shuffle_seed})
+
     # start training
-    print('Train on {} samples, val on {} samples, with batch size {}, model input shape {}.'.format(num_train, num_val, args.batch_size, args.model_input_shape))
-    model.fit_generator(generator=train_generator,
-                        steps_per_epoch=num_train // args.batch_size,
-                        epochs=args.total_epoch,
-                        initial_epoch=args.init_epoch,
-                        workers=1,
-                        use_multiprocessing=False,
-                        max_queue_size=10,
-                        callbacks=callbacks)
-
-    model.save(os.path.join(log_dir, 'trained_final.h5'))
+    print('Train on {} samples, val on {} samples, with batch size {}, model input shape {}.'.format(num_train * num_workers, num_val, global_batch_size, args.model_input_shape))
+    # compiled training loop with intermediate supervision loss on all the stacks.
+    # use model.optimizer, which is wrapped for loss scaling in mixed precision
+    trainer = HourglassTrainer(model, model.optimizer, loss_func,
+                               steps_per_execution=args.steps_per_execution,
+                               accumulation_steps=args.accumulation_steps,
+                               strategy=strategy,
+                               jit_compile=args.use_xla)
+    try:
+        trainer.fit(train_loader,
+                    steps_per_epoch=steps_per_epoch,
+                    epochs=args.total_epoch,
+                    initial_epoch=args.init_epoch,
+                    callbacks=callbacks,
+                    checkpointer=checkpointer,
+                    resume_state=resume_state)
+    finally:
+        # write pending checkpoints, also when preempted
+        checkpoint_writer.close()
+
+    if trainer.preempted:
+        print('Training stopped by signal, continue it with --resume.')
+    elif chief:
+        get_local_model(model).save(os.path.join(log_dir, 'trained_final.h5'))
+    if image_cache is not None:
+        print('Image cache stats:', image_cache.get_stats())
+        image_cache.close()
+    if train_generator.prefetcher is not None:
+        print('Byte prefetcher stats:', train_generator.prefetcher.get_stats())
+        train_generator.prefetcher.close()
     return
 
 
@@ -143,6 +290,40 @@ if __name__ == "__main__":
         help='path to keypoint class definitions, default=%(default)s')
     parser.add_argument('--matchpoint_path', type=str, required=False, default='configs/mpii_match_point.txt',
         help='path to matching keypoint definitions for horizontal/vertical flipping image, default=%(default)s')
+    parser.add_argument('--workers', type=int, required=False, default=1,
+        help='number of worker processes for training data loading, default=%(default)s')
+    parser.add_argument('--max_queue_size', type=int, required=False, default=10,
+        help='max number of prefetched batches for training data loading, default=%(default)s')
+    parser.add_argument('--tf_data', default=False, action="store_true",
+        help='use tf.data input pipeline for training data loading')
+    parser.add_argument('--batch_augment', default=False, action="store_true",
+        help='apply data augment on batch tensor in tf.data pipeline, only valid with --tf_data')
+    parser.add_argument('--val_cache', default=False, action="store_true",
+        help='evaluate from preprocessed validation tensor cache file (num_val*height*width*3 float32, shared with eval.py), instead of preprocessing validation images every epoch')
+    parser.add_argument('--val_cache_path', type=str, required=False, default=None,
+        help='dir to store validation tensor cache, default=%(default)s for dataset path')
+    parser.add_argument('--image_cache_size', type=float, required=False, default=0,
+        help='size in MB of shared memory cache for decoded images used by data loader workers & eval callback, 0 to disable. default=%(default)s')
+    parser.add_argument('--image_affinity', type=float, required=False, default=None,
+        help='shuffle training data with image affinity (locality 0~1) to put people on same image into one batch, so the image is decoded once. default=%(default)s, plain random shuffle')
+    parser.add_argument('--global_shuffle', default=False, action="store_true",
+        help='shuffle packed dataset globally over all shards. default is shard-local shuffle (shard order, then records in each shard), which reads shard files one by one but every batch only mixes samples of one or two shards')
+    parser.add_argument('--single_target', default=False, action="store_true",
+        help='feed one gt heatmap batch as target for all hourglass stacks, instead of num_stacks copies')
+    parser.add_argument('--keypoint_target', default=False, action="store_true",
+        help='feed transformed keypoints as target and render gt heatmaps on device in loss, instead of in data loader')
+    parser.add_argument('--read_ahead', type=int, required=False, default=0,
+        help='number of batches to read image files ahead with a thread pool, for dataset on remote storage. 0 to disable, default=%(default)s')
+    parser.add_argument('--local_cache_path', type=str, required=False, default=None,
+        help='local dir to cache image files read from remote storage, default=%(default)s')
+    parser.add_argument('--local_cache_size', type=float, required=False, default=10240,
+        help='size in MB of local image file cache, default=%(default)s')
+    parser.add_argument('--profile_loader', type=int, required=False, default=0,
+        help='log data loader throughput & stage time to TensorBoard every N batches, 0 to disable. default=%(default)s')
+    parser.add_argument('--autotune', default=False, action="store_true",
+        help='pick workers, max_queue_size, read_ahead & image_cache_size with timed loader trials on this host, and reuse the tuned ones stored in ~/.cache/hourglass/loader_autotune.json')
+    parser.add_argument('--autotune_memory', type=float, required=False, default=4096,
+        help='memory budget in MB of data loader for autotune, default=%(default)s')
 
     # Training options
     parser.add_argument("--batch_size", type=int, required=False, default=16,
@@ -157,12 +338,30 @@ if __name__ == "__main__":
         help = "Learning rate decay type, default=%(default)s")
     parser.add_argument('--mixed_precision', default=False, action="store_true",
         help='Use mixed precision mode in training, only for TF>2.1')
+    parser.add_argument('--steps_per_execution', type=int, required=False, default=1,
+        help='number of training steps in one compiled call of training loop, default=%(default)s')
+    parser.add_argument('--accumulation_steps', type=int, required=False, default=1,
+        help='number of batches to accumulate gradients for one optimizer step, for large effective batch size. default=%(default)s')
+    parser.add_argument('--use_xla', default=False, action="store_true",
+        help='XLA compile forward & backward pass of training step, fall back to non-XLA for dynamic input shape. Gradients differ from non-XLA training by float32 rounding, check them with tools/benchmark/xla_benchmark.py')
     parser.add_argument("--init_epoch", type=int, required=False, default=0,
         help="initial training epochs for fine tune training, default=%(default)s")
     parser.add_argument("--total_epoch", type=int, required=False, default=100,
         help="total training epochs, default=%(default)s")
+    parser.add_argument('--checkpoint_steps', type=int, required=False, default=0,
+        help='save full training state every N optimizer steps, besides the end of every epoch. 0 to only save at epoch end, default=%(default)s')
+    parser.add_argument('--resume', default=False, action="store_true",
+        help='resume training exactly from latest training state in logs/000/state, with same training options')
+    parser.add_argument('--shuffle_seed', type=int, required=False, default=None,
+        help='random seed of train data shuffle & augment. default=%(default)s, a random one for single worker training (0 for multi-worker), which is saved in training state and reused with --resume')
     parser.add_argument('--gpu_num', type=int, required=False, default=1,
         help='Number of GPU to use, default=%(default)s')
+    parser.add_argument('--cluster_spec', type=str, required=False, default=None,
+        help='multi-worker training cluster spec, as json file like {"worker": ["host1:port", "host2:port"]} or comma separated worker addresses. default=%(default)s, local training')
+    parser.add_argument('--task_index', type=int, required=False, default=0,
+        help='index of this worker in cluster spec, worker 0 is chief. default=%(default)s')
+    parser.add_argument('--lr_scaling', type=str, required=False, default='linear', choices=['none', 'linear', 'sqrt'],
+        help='scale learning rate with worker number for multi-worker global batch size (none/linear/sqrt), default=%(default)s')
 
     args = parser.parse_args()
     height, width = args.model_input_shape.split('x')